@@ -0,0 +1,356 @@
+"""Static assets under content-hashed URLs, precompressed.
+
+At startup every file under static/ is read once, fingerprinted by a hash
+of its content and compressed with gzip (and brotli, when the "brotli"
+package is installed). Templates link files through ``static_url()``,
+which returns /static/<name>.<hash>.<ext>: the content behind such a URL
+never changes, so it is served with "Cache-Control: immutable" and in the
+best encoding the client accepts. Unhashed URLs keep working and are
+revalidated by ETag.
+
+ES modules import each other by relative URL. The import map written by
+``import_map()`` points those URLs at the hashed files, so a module that
+did not change keeps its cached copy. ``module_tags()`` loads a page's
+entry module: with ASSETS_BUNDLE its local imports are joined into one
+file when they allow it (named imports and exports, plain top-level
+declarations with no clashing names, external imports all evaluated before
+any local module), otherwise each one is preloaded so the browser fetches
+them in parallel instead of one import level at a time.
+"""
+import gzip
+import hashlib
+import json
+import logging
+import mimetypes
+import posixpath
+import re
+from pathlib import Path
+from typing import Dict, List, Optional, Set, Tuple
+
+from markupsafe import Markup
+from starlette.datastructures import Headers
+from starlette.responses import Response
+from starlette.staticfiles import StaticFiles
+from starlette.types import Scope
+
+from app.conf import *
+
+logger = logging.getLogger(__name__)
+
+STATIC_PREFIX = "/static/"
+COMPRESSIBLE = {".js", ".mjs", ".css", ".html", ".svg", ".json", ".txt", ".map"}
+
+# Static ES module syntax, one statement per match (clauses may span lines)
+_IMPORT_RE = re.compile(r"""^import\s+(?:(?P<clause>[^'"]*?)\s*from\s*)?(?P<q>['"])(?P<spec>[^'"]+)(?P=q)[ \t]*;?[ \t]*$""",
+                        re.M)
+_EXPORT_RE = re.compile(r"^export\s+(?=(?:async\s+)?(?:function\b|class\b|const\b|let\b|var\b))", re.M)
+_OTHER_EXPORT_RE = re.compile(r"^export\b", re.M)
+_RENAME_RE = re.compile(r"\bas\b")
+_DECLARATION_RE = re.compile(r"^(?:export\s+)?(?:async\s+)?(?:function\*?|class|const|let|var)\s+([\w$]+)", re.M)
+_STATEMENT_RE = re.compile(r"^(?:export\s+)?(?:async\s+)?(?P<kind>function\b|class\b|const\b|let\b|var\b).*$", re.M)
+_BRACKETS = {"(": 1, "[": 1, "{": 1, ")": -1, "]": -1, "}": -1}
+
+
+def _brotli():
+    try:
+        import brotli
+    except ImportError:
+        return None
+    return brotli
+
+
+class Asset:
+    """One servable file and its encodings"""
+
+    __slots__ = ("path", "url", "content", "encodings", "media_type", "etag")
+
+    def __init__(self, path: str, hashed_path: str, digest: str, content: bytes, encodings: Dict[str, bytes]):
+        self.path = path
+        self.url = STATIC_PREFIX + hashed_path
+        self.content = content
+        self.encodings = encodings  # "br" / "gzip" -> body, only when smaller
+        self.media_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        if self.media_type.startswith("text/") or self.media_type in ("application/javascript", "text/javascript"):
+            self.media_type += "; charset=utf-8"
+        self.etag = f'"{digest}"'
+
+
+def imported_names(clause: str) -> List[str]:
+    """Local bindings created by an import clause (``a, { b, c as d }``, ``* as e``)"""
+    head, brace, rest = clause.partition("{")
+    specifiers = head.split(",") + (rest.partition("}")[0].split(",") if brace else [])
+    return [part.split()[-1] for part in specifiers if part.strip()]
+
+
+def declared_names(source: str) -> Optional[List[str]]:
+    """Names declared at the top level of a module (unindented statements);
+    None if one declares something else than a single plain name"""
+    names = []
+    for statement in _STATEMENT_RE.finditer(source):
+        match = _DECLARATION_RE.match(statement.group(0))
+        if match is None:
+            return None  # destructuring: const { a, b } = ...
+        if statement.group("kind") in ("const", "let", "var") and _more_declarators(statement.group(0)[match.end():]):
+            return None  # let a = 1, b = 2
+        names.append(match.group(1))
+    return names
+
+
+def _more_declarators(rest: str) -> bool:
+    """Whether the line after a declared name has a comma outside brackets and strings"""
+    depth = 0
+    quote = None
+    for char in rest:
+        if quote:
+            quote = None if char == quote else quote
+        elif char in "'\"`":
+            quote = char
+        elif char in _BRACKETS:
+            depth += _BRACKETS[char]
+        elif char == "," and depth == 0:
+            return True
+        elif char == ";" and depth == 0:
+            return False
+    return False
+
+
+class AssetPipeline:
+    """Content-hashed, precompressed copies of the files in a static directory"""
+
+    def __init__(self, directory: Path, enabled: bool = ASSETS_FINGERPRINT, bundle: bool = ASSETS_BUNDLE):
+        self.directory = Path(directory)
+        self.enabled = enabled
+        self.bundle = bundle
+        self.brotli = _brotli() if ASSETS_BROTLI else None
+        self.by_path: Dict[str, Asset] = {}  # "js/app.js" -> asset
+        self.by_hashed: Dict[str, Asset] = {}  # "js/app.1a2b3c4d5e.js" -> asset
+        self._modules: Dict[str, Markup] = {}  # entry -> tags, computed once
+
+    def build(self):
+        """Read, fingerprint and compress every file"""
+        if not self.enabled:
+            return
+        if ASSETS_BROTLI and self.brotli is None:
+            logger.info("The 'brotli' package is not installed, static files are precompressed with gzip only")
+        by_path, by_hashed = {}, {}
+        for file in sorted(self.directory.rglob("*")):
+            if file.is_file():
+                path = file.relative_to(self.directory).as_posix()
+                asset = self._asset(path, file.read_bytes())
+                by_path[path] = asset
+                by_hashed[asset.url[len(STATIC_PREFIX):]] = asset
+        self.by_path, self.by_hashed, self._modules = by_path, by_hashed, {}
+        total = sum(len(a.content) for a in by_path.values())
+        compressed = sum(min([len(a.content)] + [len(b) for b in a.encodings.values()]) for a in by_path.values())
+        logger.info("Static assets: %d files, %d bytes, %d compressed", len(by_path), total, compressed)
+
+    def _asset(self, path: str, content: bytes) -> Asset:
+        digest = hashlib.sha256(content).hexdigest()[:ASSETS_HASH_LENGTH]
+        stem, dot, extension = path.rpartition(".")
+        hashed_path = f"{stem}.{digest}.{extension}" if dot and "/" not in extension else f"{path}.{digest}"
+        encodings = {}
+        if posixpath.splitext(path)[1].lower() in COMPRESSIBLE and len(content) >= ASSETS_COMPRESS_MIN_SIZE:
+            variants = {"gzip": gzip.compress(content, compresslevel=9, mtime=0)}
+            if self.brotli is not None:
+                variants["br"] = self.brotli.compress(content, quality=11)
+            encodings = {name: body for name, body in variants.items() if len(body) < len(content)}
+        return Asset(path, hashed_path, digest, content, encodings)
+
+    # Template helpers
+
+    def static_url(self, path: str) -> str:
+        """URL of a static file; hashed when the file is known"""
+        asset = self.by_path.get(path)
+        return asset.url if asset is not None else STATIC_PREFIX + path
+
+    def import_map(self, imports: Optional[Dict[str, str]] = None) -> Markup:
+        """Import map JSON: ``imports`` plus the unhashed URL of every module mapped to its hashed one"""
+        mapping = dict(imports or {})
+        for path, asset in self.by_path.items():
+            if path.endswith((".js", ".mjs")):
+                mapping[STATIC_PREFIX + path] = asset.url
+        # Safe inside <script>: "<" cannot close the tag once escaped
+        return Markup(json.dumps({"imports": mapping}, indent=2).replace("<", "\\u003c"))
+
+    def module_tags(self, entry: str) -> Markup:
+        """Script tag for a page's entry module, with its local imports bundled or preloaded"""
+        tags = self._modules.get(entry)
+        if tags is None:
+            tags = self._modules[entry] = self._module_tags(entry)
+        return tags
+
+    def _module_tags(self, entry: str) -> Markup:
+        script = '<script type="module" src="{}"></script>'
+        order = self._module_order(entry)
+        if order is None or not self.enabled:
+            return Markup(script).format(self.static_url(entry))
+
+        if self.bundle and len(order) > 1:
+            bundled = self._bundle(order)
+            if bundled is not None:
+                asset = self._asset(entry[:-len(".js")] + ".bundle.js", bundled.encode("utf-8"))
+                self.by_hashed[asset.url[len(STATIC_PREFIX):]] = asset
+                return Markup(script).format(asset.url)
+
+        preload = '<link rel="modulepreload" href="{}">'
+        tags = [Markup(preload).format(self.static_url(path)) for path in order if path != entry]
+        tags.append(Markup(script).format(self.static_url(entry)))
+        return Markup("\n    ").join(tags)
+
+    # Module graph
+
+    def _imports(self, path: str) -> List[Tuple[str, str, str, Optional[str]]]:
+        """(statement, clause, specifier, local module path or None) of each static import"""
+        source = self.by_path[path].content.decode("utf-8")
+        imports = []
+        for match in _IMPORT_RE.finditer(source):
+            spec = match.group("spec")
+            local = None
+            if spec.startswith(("./", "../")):
+                local = posixpath.normpath(posixpath.join(posixpath.dirname(path), spec))
+            imports.append((match.group(0), match.group("clause") or "", spec, local))
+        return imports
+
+    def _module_order(self, entry: str) -> Optional[List[str]]:
+        """Local modules reachable from ``entry``, dependencies first; None if one is missing"""
+        order: List[str] = []
+        visiting = set()
+
+        def visit(path: str) -> bool:
+            if path in order:
+                return True
+            if path in visiting or path not in self.by_path:
+                return path in visiting  # an import cycle is fine for preloading
+            visiting.add(path)
+            for _, _, _, local in self._imports(path):
+                if local is not None and not visit(local):
+                    return False
+            visiting.discard(path)
+            order.append(path)
+            return True
+
+        return order if visit(entry) else None
+
+    def _external_imports(self, entry: str) -> Optional[List[str]]:
+        """External import statements in the order the page evaluates them; None if
+        one is evaluated after a local module, which the bundle would reverse"""
+        statements: List[str] = []
+        specs: Set[str] = set()
+        evaluated: Set[str] = set()
+
+        def visit(path: str) -> bool:
+            for statement, _, spec, local in self._imports(path):
+                if local is None:
+                    if spec not in specs:
+                        if evaluated:
+                            return False
+                        specs.add(spec)
+                    if statement.strip() not in statements:
+                        statements.append(statement.strip())
+                elif local not in evaluated and not visit(local):
+                    return False
+            evaluated.add(path)
+            return True
+
+        return statements if visit(entry) else None
+
+    def _bundle(self, order: List[str]) -> Optional[str]:
+        """The modules joined into one, or None when they cannot be joined safely"""
+        # Hoisted into one module, external imports run before every module body
+        external = self._external_imports(order[-1])
+        if external is None:
+            return None
+        bodies: List[str] = []
+        names: Set[str] = set()
+        exported: Dict[str, set] = {}
+        imported: Set[str] = set()
+        for path in order:
+            source = self.by_path[path].content.decode("utf-8")
+            if len(_OTHER_EXPORT_RE.findall(source)) != len(_EXPORT_RE.findall(source)):
+                return None  # default exports, export lists, re-exports
+            declared = declared_names(source)
+            if declared is None:
+                return None  # a declaration whose names are not known
+            exported[path] = set(_DECLARATION_RE.findall("\n".join(
+                line for line in source.splitlines() if line.startswith("export"))))
+            for statement, clause, _, local in self._imports(path):
+                if local is None:
+                    if statement.strip() not in imported:
+                        imported.add(statement.strip())
+                        declared += imported_names(clause)
+                    continue
+                if order.index(local) > order.index(path):
+                    return None  # import cycle
+                if clause.strip() and (not clause.strip().startswith("{") or _RENAME_RE.search(clause)
+                                       or not set(imported_names(clause)) <= exported[local]):
+                    return None  # default, namespace or renamed import
+            if names & set(declared) or len(set(declared)) != len(declared):
+                return None  # top-level names would clash in one scope
+            names.update(declared)
+            body = _EXPORT_RE.sub("", _IMPORT_RE.sub("", source))
+            bodies.append(f"// {path}\n{body.strip()}\n")
+        return "\n".join(external) + "\n\n" + "\n".join(bodies)
+
+    # Serving
+
+    def response(self, hashed_path: str, scope: Scope) -> Optional[Response]:
+        """Response for a hashed URL, or None if the path is not one"""
+        asset = self.by_hashed.get(hashed_path)
+        if asset is None:
+            return None
+        headers = {
+            "Cache-Control": f"public, max-age={ASSETS_MAX_AGE}, immutable",
+            "ETag": asset.etag,
+            "Vary": "Accept-Encoding",
+        }
+        request_headers = Headers(scope=scope)
+        if request_headers.get("if-none-match") == asset.etag:
+            return Response(status_code=304, headers=headers)
+
+        encoding = choose_encoding(request_headers.get("accept-encoding", ""), asset.encodings)
+        body = asset.content
+        if encoding is not None:
+            body = asset.encodings[encoding]
+            headers["Content-Encoding"] = encoding
+        if scope["method"] == "HEAD":
+            headers["Content-Length"] = str(len(body))
+            body = b""
+        return Response(body, media_type=asset.media_type, headers=headers)
+
+
+def choose_encoding(accept_encoding: str, available: Dict[str, bytes]) -> Optional[str]:
+    """Best of brotli and gzip that the client accepts (q > 0)"""
+    accepted: Dict[str, float] = {}
+    for item in accept_encoding.lower().split(","):
+        name, _, params = item.strip().partition(";")
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[name.strip()] = quality
+    for encoding in ("br", "gzip"):
+        quality = accepted.get(encoding, accepted.get("*", 0.0))
+        if encoding in available and quality > 0:
+            return encoding
+    return None
+
+
+class AssetFiles(StaticFiles):
+    """StaticFiles that serves hashed URLs from the pipeline, from memory"""
+
+    def __init__(self, pipeline: AssetPipeline, **kwargs):
+        super().__init__(directory=pipeline.directory, **kwargs)
+        self.pipeline = pipeline
+
+    async def get_response(self, path: str, scope: Scope) -> Response:
+        if scope["method"] in ("GET", "HEAD"):
+            response = self.pipeline.response(path.replace("\\", "/"), scope)
+            if response is not None:
+                return response
+        response = await super().get_response(path, scope)
+        if response.status_code < 400:
+            response.headers.setdefault("Cache-Control", "no-cache")
+        return response
@@ -0,0 +1,280 @@
+"""Caching helpers: LRU/TTL cache, singleflight and the completion cache"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from app.conf import *
+from app.generation import GenerationCancelled
+
+logger = logging.getLogger(__name__)
+
+
+class LRUCache:
+    """In-memory LRU cache with an entry cap, a size cap and a TTL"""
+
+    def __init__(self, max_entries: int, max_bytes: int = 0, ttl: float = 0):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.bytes = 0
+        self.evictions = 0
+        self._data: "OrderedDict[str, Tuple[float, int, Any]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: str) -> Optional[Any]:
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        stored_at, size, value = entry
+        if self.ttl and time.monotonic() - stored_at > self.ttl:
+            self._drop(key)
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key: str, value: Any, size: int = 0):
+        if key in self._data:
+            self._drop(key)
+        if self.max_bytes and size > self.max_bytes:
+            return  # would evict everything else
+        self._data[key] = (time.monotonic(), size, value)
+        self.bytes += size
+        while len(self._data) > self.max_entries or (self.max_bytes and self.bytes > self.max_bytes):
+            oldest = next(iter(self._data))
+            self._drop(oldest)
+            self.evictions += 1
+
+    def _drop(self, key: str):
+        _, size, _ = self._data.pop(key)
+        self.bytes -= size
+
+
+class SingleFlight:
+    """Collapses concurrent calls for the same key into one.
+
+    Errors of the call are shared with every waiter, except the leader's own
+    cancellation (CancelledError, GenerationCancelled): then a waiter runs
+    the call again instead.
+    """
+
+    def __init__(self):
+        self._calls: Dict[str, asyncio.Future] = {}
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """Run ``fn`` once per key; returns (result, shared)"""
+        while True:
+            future = self._calls.get(key)
+            if future is None:
+                break
+            # asyncio.wait does not raise if the leader was cancelled
+            await asyncio.wait({future})
+            if not future.cancelled():
+                return future.result(), True
+            # The leader went away; try again, possibly as the new leader
+
+        future = asyncio.get_running_loop().create_future()
+        self._calls[key] = future
+        try:
+            result = await fn()
+        except (asyncio.CancelledError, GenerationCancelled):
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # retrieved here, followers read it too
+            raise
+        else:
+            future.set_result(result)
+            return result, False
+        finally:
+            self._calls.pop(key, None)
+
+
+class RefreshingValue:
+    """One value kept fresh in the background (stale-while-revalidate).
+
+    A fresh value is returned as is. Once older than ``ttl`` the stale value
+    is still returned immediately while a single background refresh runs;
+    only a value older than ``max_stale`` (or none at all) makes callers
+    wait, and concurrent waiters share one load. The value is serialized
+    and its ETag computed once per refresh, not per request.
+    """
+
+    def __init__(self, loader: Callable[[], Awaitable[Any]], ttl: float, max_stale: float):
+        self.loader = loader
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self.value: Any = None
+        self.body = b""
+        self.etag = ""
+        self.loaded_at = 0.0
+        self._flight = SingleFlight()
+        self._refresh: Optional[asyncio.Task] = None
+
+    async def get(self) -> Any:
+        age = time.monotonic() - self.loaded_at
+        if self.loaded_at and age <= self.ttl:
+            return self.value
+        if self.loaded_at and age <= self.max_stale:
+            self.refresh_in_background()
+            return self.value
+        try:
+            await self._flight.do("value", self._load)
+        except Exception:
+            if not self.loaded_at:
+                raise
+            logger.warning("Refresh failed, serving stale value", exc_info=True)
+        return self.value
+
+    def refresh_in_background(self):
+        if self._refresh is None or self._refresh.done():
+            self._refresh = asyncio.create_task(self._background_load())
+
+    async def _background_load(self):
+        try:
+            await self._flight.do("value", self._load)
+        except Exception:
+            logger.warning("Background refresh failed", exc_info=True)
+
+    async def _load(self):
+        value = await self.loader()
+        body = json.dumps(value, separators=(",", ":")).encode("utf-8")
+        if body != self.body:
+            self.body = body
+            self.etag = '"%s"' % hashlib.sha1(body).hexdigest()
+        self.value = value
+        self.loaded_at = time.monotonic()
+
+
+class CompletionCache:
+    """Opt-in cache of deterministic non-streaming chat completions.
+
+    Keys hash the model, the normalized prompt messages and the sampling
+    parameters. Lookups try the memory LRU first and then the optional disk
+    tier; identical requests in flight at the same time share one upstream
+    call.
+    """
+
+    def __init__(self, enabled: bool = COMPLETION_CACHE_ENABLED, directory: Optional[str] = COMPLETION_CACHE_DIR):
+        self.enabled = enabled
+        self.memory = LRUCache(COMPLETION_CACHE_MAX_ENTRIES, COMPLETION_CACHE_MAX_BYTES, COMPLETION_CACHE_TTL)
+        self.directory = Path(directory) if directory else None
+        self.flights = SingleFlight()
+        self.stats = {"hits": 0, "disk_hits": 0, "misses": 0, "shared": 0, "bypassed": 0}
+        self._disk_writes = 0
+
+    def accepts(self, temperature: Optional[float], cache_control: str = "") -> bool:
+        """Whether a request may be answered from the cache"""
+        if not self.enabled:
+            return False
+        if "no-cache" in cache_control or "no-store" in cache_control \
+                or temperature is None or temperature > COMPLETION_CACHE_MAX_TEMPERATURE:
+            self.stats["bypassed"] += 1
+            return False
+        return True
+
+    @staticmethod
+    def key(model: Optional[str], messages: List[dict], params: dict) -> str:
+        normalized = [
+            {"role": m["role"].strip().lower(), "content": m["content"].replace("\r\n", "\n").strip()}
+            for m in messages
+        ]
+        payload = json.dumps(
+            {"model": model, "messages": normalized, "params": params},
+            sort_keys=True, separators=(",", ":"), ensure_ascii=False
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    async def get_or_compute(self, key: str, compute: Callable[[], Awaitable[str]]) -> Tuple[str, str]:
+        """Cached content or the result of ``compute``; second item is HIT, MISS or SHARED"""
+        content = self.memory.get(key)
+        if content is not None:
+            self.stats["hits"] += 1
+            return content, "HIT"
+
+        async def load_or_compute():
+            cached = await self._disk_get(key)
+            if cached is not None:
+                self.stats["disk_hits"] += 1
+                self.memory.set(key, cached, len(cached))
+                return cached, "HIT"
+            self.stats["misses"] += 1
+            result = await compute()
+            self.memory.set(key, result, len(result))
+            await self._disk_set(key, result)
+            return result, "MISS"
+
+        (content, status), shared = await self.flights.do(key, load_or_compute)
+        if shared:
+            self.stats["shared"] += 1
+            return content, "SHARED"
+        return content, status
+
+    def snapshot(self) -> dict:
+        return dict(self.stats, entries=len(self.memory), bytes=self.memory.bytes, evictions=self.memory.evictions)
+
+    # Disk tier
+
+    def _path(self, key: str) -> Path:
+        return self.directory / key[:2] / f"{key}.json"
+
+    async def _disk_get(self, key: str) -> Optional[str]:
+        if self.directory is None:
+            return None
+        return await asyncio.to_thread(self._read, self._path(key))
+
+    async def _disk_set(self, key: str, content: str):
+        if self.directory is None:
+            return
+        self._disk_writes += 1
+        prune = self._disk_writes % 100 == 0
+        try:
+            await asyncio.to_thread(self._write, self._path(key), content, prune)
+        except OSError as e:
+            logger.warning("Could not write completion cache entry: %s", e)
+
+    @staticmethod
+    def _read(path: Path) -> Optional[str]:
+        try:
+            if COMPLETION_CACHE_TTL and time.time() - path.stat().st_mtime > COMPLETION_CACHE_TTL:
+                return None
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f)["content"]
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def _write(self, path: Path, content: str, prune: bool):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"content": content}, f, ensure_ascii=False)
+        os.replace(tmp, path)
+        if prune:
+            self._prune()
+
+    def _prune(self):
+        """Drop expired entries and the oldest ones above the disk cap"""
+        entries = []
+        for path in self.directory.glob("*/*.json"):
+            try:
+                entries.append((path.stat().st_mtime, path))
+            except OSError:
+                continue
+        entries.sort()
+        now = time.time()
+        excess = len(entries) - COMPLETION_CACHE_DISK_MAX_ENTRIES
+        for index, (mtime, path) in enumerate(entries):
+            expired = COMPLETION_CACHE_TTL and now - mtime > COMPLETION_CACHE_TTL
+            if index < excess or expired:
+                try:
+                    path.unlink()
+                except OSError:
+                    pass
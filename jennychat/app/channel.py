@@ -0,0 +1,104 @@
+"""Multiplexed chat generation over one WebSocket (/ws/chat).
+
+A socket runs up to WS_CHAT_MAX_GENERATIONS generations at once, each
+tagged with an id chosen by the client:
+
+    -> {"type": "generate", "id": "1", "message": "...", "chat_id": null, "max_tokens": 2048}
+    <- {"type": "started", "id": "1", "chat_id": "...", "seq": 7}
+    <- {"type": "queued", "id": "1", "position": 2}
+    <- ["1", "Hello"]
+    <- {"type": "done", "id": "1", "chat_id": "..."}      (or "cancelled" / "error")
+    -> {"type": "cancel", "id": "1"}
+    -> {"type": "ping"}                                    <- {"type": "pong"}
+
+Token frames are most of the traffic, so they are a bare JSON array
+``[id, text]``. With ``/ws/chat?frames=binary`` they are binary frames
+instead: a 0x01 byte, the id length in one byte, the id, then the UTF-8
+text. uvicorn also negotiates permessage-deflate with clients that offer
+it (--ws-per-message-deflate, on by default).
+
+Chat list changes made on any worker are pushed to every socket as
+{"type": "chat", "chat": {...}} (created, renamed, new message) and
+{"type": "chat_deleted", "chat_id": ...}.
+"""
+import asyncio
+import json
+from typing import Callable, Dict, Set
+
+from fastapi import WebSocket
+
+from app.conf import *
+from app.connections import Connection
+from app.generation import Generation
+
+TOKEN_FRAME = 0x01
+MAX_ID_BYTES = 64
+
+
+class ChatChannel:
+    """One /ws/chat socket: its send queue and the generations it started"""
+
+    def __init__(self, websocket: WebSocket, binary: bool, on_close: Callable[["ChatChannel"], None]):
+        self.binary = binary
+        self.tasks: Dict[str, asyncio.Task] = {}
+        self.generations: Dict[str, Generation] = {}  # once streaming has started
+        self.cancelled: Set[str] = set()  # cancelled before streaming started
+        self._on_close = on_close
+        # Dropping token frames would corrupt replies: a client that cannot keep up is disconnected
+        self.connection = Connection(websocket, "ws/chat", self._closed, policy="disconnect")
+
+    def send(self, message: dict):
+        self.connection.send(json.dumps(message))
+
+    def send_token(self, request_id: str, content: str):
+        if self.binary:
+            encoded = request_id.encode("utf-8")
+            self.connection.send(bytes((TOKEN_FRAME, len(encoded))) + encoded + content.encode("utf-8"))
+        else:
+            self.connection.send(json.dumps([request_id, content]))
+
+    def send_event(self, request_id: str, event: dict) -> bool:
+        """Forward one streamed chat event; True if it ended the generation"""
+        if "content" in event:
+            self.send_token(request_id, event["content"])
+            return False
+        if event.get("queued"):
+            self.send({"type": "queued", "id": request_id, "position": event["position"]})
+            return False
+        if event.get("cancelled"):
+            self.send({"type": "cancelled", "id": request_id, "truncated": event.get("truncated", False)})
+        elif "error" in event:
+            self.send({"type": "error", "id": request_id, "error": event["error"]})
+        else:
+            self.send({"type": "done", "id": request_id, "chat_id": event.get("chat_id")})
+        return True
+
+    def start(self, request_id: str, coroutine):
+        task = asyncio.create_task(coroutine)
+        self.tasks[request_id] = task
+        task.add_done_callback(lambda _: self._finished(request_id))
+
+    def cancel(self, request_id: str, reason: str = "cancelled") -> bool:
+        """Stop one generation of this socket; False if there is none with that id"""
+        generation = self.generations.get(request_id)
+        if generation is not None:
+            generation.cancel(reason)
+            return True
+        if request_id in self.tasks:
+            self.cancelled.add(request_id)
+            return True
+        return False
+
+    def close(self):
+        self.connection.close()
+
+    def _finished(self, request_id: str):
+        self.tasks.pop(request_id, None)
+        self.generations.pop(request_id, None)
+        self.cancelled.discard(request_id)
+
+    def _closed(self, connection: Connection):
+        # Replies generated so far are kept, as when an HTTP client goes away
+        for request_id in list(self.tasks):
+            self.cancel(request_id, "disconnected")
+        self._on_close(self)
@@ -1 +1,143 @@
 LLAMA_CPP_SERVER_URL = "http://127.0.0.1:8080"
+
+# Upstream connection pool (shared by every request to LLama-Cpp Server)
+LLAMA_CPP_MAX_CONNECTIONS = 100
+LLAMA_CPP_MAX_KEEPALIVE_CONNECTIONS = 20
+LLAMA_CPP_KEEPALIVE_EXPIRY = 30.0
+LLAMA_CPP_CONNECT_TIMEOUT = 5.0
+LLAMA_CPP_READ_TIMEOUT = 60.0
+LLAMA_CPP_POOL_TIMEOUT = 10.0
+LLAMA_CPP_HTTP2 = False  # requires the "h2" package (pip install httpx[http2])
+
+# Streaming: coalesce tokens and flush every N ms or N tokens, whichever comes first
+STREAM_FLUSH_INTERVAL_MS = 40
+STREAM_FLUSH_MAX_TOKENS = 16
+
+# Chat history persistence: "jsonl" (durable, CHAT_HISTORY_DIR) or "memory"
+CHAT_STORE_BACKEND = "jsonl"
+CHAT_HISTORY_DIR = "chat_history"
+CHAT_STORE_FLUSH_INTERVAL = 0.5  # seconds between write-behind batches
+CHAT_LOAD_RETRIES = 4  # flush intervals to wait for messages other workers have not written yet
+CHAT_STORE_COMPACT_INTERVAL = 600.0  # seconds between catalog compaction checks
+CHAT_MEMORY_BUDGET = 256 * 1024 * 1024  # estimated bytes of loaded chats before idle ones are evicted (0 = no limit)
+CHAT_EVICT_IDLE = 300.0  # seconds a chat must be unused before it may be evicted
+
+# Prompt context window (keep CONTEXT_SIZE in sync with llama-server --ctx-size)
+CONTEXT_SIZE = 4096
+CONTEXT_SAFETY_MARGIN = 64  # tokens kept free on top of max_tokens
+CONTEXT_MIN_RECENT_MESSAGES = 2  # newest turns that are always sent
+CONTEXT_MESSAGE_OVERHEAD = 4  # chat template tokens per message
+CONTEXT_TOKENIZER = "estimate"  # "estimate" (local) or "server" (llama-server /tokenize)
+CONTEXT_TOKEN_CACHE_SIZE = 50000
+CONTEXT_SUMMARY_ENABLED = False  # replace dropped turns with a rolling summary
+CONTEXT_SUMMARY_MAX_TOKENS = 256
+
+# Prompt cache reuse: pin each chat to a llama-server slot (cache_prompt + id_slot)
+LLAMA_CPP_SLOT_AFFINITY = True
+LLAMA_CPP_SLOTS = 1  # replaced by total_slots from /props at startup when available
+CONTEXT_TRIM_SLACK = 0.25  # share of the budget freed when the window has to move
+
+# Backends: one entry per llama-server process (e.g. one per NUMA node)
+LLAMA_CPP_SERVER_URLS = [LLAMA_CPP_SERVER_URL]
+LLAMA_CPP_HEALTH_INTERVAL = 5.0  # seconds between /health + /v1/models probes
+LLAMA_CPP_HEALTH_TIMEOUT = 2.0
+LLAMA_CPP_EJECT_AFTER_FAILURES = 2  # consecutive failures before a backend is ejected
+LLAMA_CPP_STICKY_MAX_IMBALANCE = 2  # extra requests tolerated to keep a chat on its backend
+LLAMA_CPP_STICKY_SESSIONS = 10000
+
+# Generation scheduler (admission control in front of the backends)
+SCHEDULER_CONCURRENCY = 0  # 0 = total llama-server slots across backends
+SCHEDULER_MAX_QUEUE = 256  # waiting requests before answering 503
+SCHEDULER_MAX_QUEUE_PER_USER = 8  # waiting requests per user before answering 429
+SCHEDULER_QUEUE_TIMEOUT = 120.0  # seconds a request may wait for a slot
+SCHEDULER_POSITION_INTERVAL = 2.0  # max seconds between queue position events
+
+# Seconds between client disconnect checks while a generation runs
+CANCEL_POLL_INTERVAL = 0.25
+
+# Completion cache for deterministic (temperature <= max) non-streaming requests
+COMPLETION_CACHE_ENABLED = False
+COMPLETION_CACHE_MAX_TEMPERATURE = 0.0
+COMPLETION_CACHE_MAX_ENTRIES = 2048
+COMPLETION_CACHE_MAX_BYTES = 64 * 1024 * 1024
+COMPLETION_CACHE_TTL = 3600.0  # seconds, 0 = never expire
+COMPLETION_CACHE_DIR = None  # e.g. "completion_cache" to also keep entries on disk
+COMPLETION_CACHE_DISK_MAX_ENTRIES = 100000
+
+# /api/models cache: served fresh for TTL seconds, then stale while refreshing in the background
+MODELS_CACHE_TTL = 30.0
+MODELS_CACHE_MAX_STALE = 600.0
+
+# Chat list (/api/chats) paging
+CHATS_PAGE_SIZE = 50
+CHATS_PAGE_MAX = 500
+
+# WebSocket fan-out
+WS_SEND_QUEUE_SIZE = 256  # messages queued per connection
+WS_SLOW_CONSUMER_POLICY = "drop_oldest"  # "drop_oldest" or "disconnect"
+WS_MAX_LAG = 10.0  # seconds behind before a slow client is disconnected ("disconnect" policy)
+WS_SEND_TIMEOUT = 10.0
+
+# Chat generation over one WebSocket (/ws/chat). Sockets that fall behind are
+# disconnected rather than losing tokens; uvicorn compresses frames with
+# permessage-deflate when the client offers it (--ws-per-message-deflate)
+WS_CHAT_MAX_GENERATIONS = 8  # running at once per socket
+
+# Collaborative rooms
+ROOM_HISTORY_DIR = "chat_history/rooms"  # durable room backlog (CHAT_STORE_BACKEND="jsonl")
+ROOM_HISTORY_SIZE = 200  # newest messages kept in memory per room
+ROOM_JOIN_HISTORY = 50  # messages sent when joining a room
+ROOM_HISTORY_PAGE_MAX = 100  # largest load_history page
+
+# AI participant in rooms ("ask_ai"): one upstream stream per answer, fanned out to every member
+ROOM_AI_USER_ID = "jenny"
+ROOM_AI_USERNAME = "Jenny"
+ROOM_AI_SYSTEM_PROMPT = (
+    "You are Jenny, an assistant taking part in a group chat. "
+    "Each user message starts with the name of the person who wrote it."
+)
+ROOM_AI_CONTEXT_MESSAGES = 30  # newest room messages the prompt is built from
+ROOM_AI_MAX_TOKENS = 512
+ROOM_AI_TEMPERATURE = 0.7
+# Every flush is a broadcast to the whole room, so chunks are larger than for /api/chat
+ROOM_AI_FLUSH_INTERVAL_MS = 100
+ROOM_AI_FLUSH_MAX_TOKENS = 32
+
+# Events between uvicorn workers: "local" (one process) or "unix" (several workers on one host)
+PUBSUB_BACKEND = "local"
+PUBSUB_SOCKET = "chat_history/events.sock"
+PUBSUB_CONNECT_TIMEOUT = 10.0
+PUBSUB_RETRY_INTERVAL = 0.2  # seconds between attempts to reach or replace the relay
+PUBSUB_MAX_MESSAGE = 16 * 1024 * 1024
+PUBSUB_MAX_BUFFER = 64 * 1024 * 1024  # unsent bytes before a peer that is not reading is dropped
+
+# Observability: /metrics (Prometheus text format) and per-generation timing logs
+METRICS_TRACE_LOG = False  # one JSON line per generation on the "app.metrics" logger
+REQUEST_ID_HEADER = "X-Request-ID"  # taken from the client (or generated) and forwarded to llama-server
+
+# Message search (/api/search): an inverted index in memory, plus message embeddings from
+# llama-server's /embedding endpoint (start it with --embedding) kept in SEARCH_DIR
+SEARCH_DIR = "chat_history/search"
+SEARCH_SEMANTIC = False  # requires the "numpy" package (pip install numpy) and llama-server --embedding
+SEARCH_EMBED_BATCH = 64  # messages per /embedding request
+SEARCH_EMBED_INTERVAL = 1.0  # seconds between embedding batches
+SEARCH_EMBED_MAX_CHARS = 2000  # longer messages are embedded by their beginning
+SEARCH_EMBED_TIMEOUT = 30.0
+SEARCH_VECTOR_CHUNK = 4096  # rows the embedding matrix grows by
+SEARCH_PERSIST_INDEX = True  # save the text index in SEARCH_DIR; off, every start reads every chat once
+SEARCH_INDEX_SAVE_INTERVAL = 300.0  # seconds between saves of the text index (by the leader)
+SEARCH_BUILD_BATCH = 2000  # messages indexed at startup between yields to the event loop
+SEARCH_MAX_POSTINGS = 20000  # a word in more messages than this is only matched in the newest ones
+SEARCH_CANDIDATES = 100  # hits taken from each index before they are merged
+SEARCH_PAGE_SIZE = 20
+SEARCH_PAGE_MAX = 100
+SEARCH_QUERY_MAX = 500  # characters
+SEARCH_SNIPPET_CHARS = 200
+
+# Static files: content-hashed URLs served with "Cache-Control: immutable", precompressed
+ASSETS_FINGERPRINT = True  # False serves plain /static URLs, e.g. while editing the frontend
+ASSETS_BUNDLE = True  # join a page's local ES modules into one file when they allow it
+ASSETS_BROTLI = True  # also brotli variants; requires the "brotli" package (gzip only without it)
+ASSETS_HASH_LENGTH = 10
+ASSETS_MAX_AGE = 31536000  # seconds, for hashed URLs
+ASSETS_COMPRESS_MIN_SIZE = 512  # bytes; smaller files are served as they are
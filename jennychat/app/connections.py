@@ -0,0 +1,172 @@
+"""WebSocket connections with per-connection send queues.
+
+Messages are serialized once and handed to every recipient's bounded
+queue; a writer task per connection drains it. A broadcast therefore never
+awaits a client, and a slow client only delays itself: when its queue is
+full it either loses its oldest messages or is disconnected, depending on
+WS_SLOW_CONSUMER_POLICY.
+
+Room broadcasts go through the event broker, and each worker process writes
+them to the sockets connected to it.
+"""
+import asyncio
+import json
+import logging
+import time
+from collections import deque
+from typing import Callable, Deque, Dict, Optional, Tuple, Union
+
+from fastapi import WebSocket
+
+from app.conf import *
+from app.metrics import ERRORS, WS_DROPPED, WS_FANOUT
+from app.pubsub import Broker
+
+logger = logging.getLogger(__name__)
+
+
+class Connection:
+    """One WebSocket, its outbound queue and the task writing it"""
+
+    def __init__(self, websocket: WebSocket, user_id: str, on_close: Callable[["Connection"], None],
+                 policy: str = WS_SLOW_CONSUMER_POLICY):
+        self.websocket = websocket
+        self.user_id = user_id
+        self.policy = policy  # "drop_oldest" or "disconnect"
+        self.closed = False
+        self.dropped = 0
+        self._on_close = on_close
+        self._queue: Deque[Tuple[float, Union[str, bytes]]] = deque()
+        self._ready = asyncio.Event()
+        self._writer = asyncio.create_task(self._write())
+
+    @property
+    def lag(self) -> float:
+        """Seconds the oldest queued message has been waiting"""
+        return time.monotonic() - self._queue[0][0] if self._queue else 0.0
+
+    def send(self, data: Union[str, bytes]):
+        """Queue an already serialized message (bytes go out as a binary frame); never waits"""
+        if self.closed:
+            return
+        if self.policy == "disconnect" and self._queue and self.lag > WS_MAX_LAG:
+            ERRORS.inc("ws_slow_consumer")
+            self.abort("lagging %.1fs behind" % self.lag)
+            return
+        if len(self._queue) >= WS_SEND_QUEUE_SIZE:
+            if self.policy == "disconnect":
+                ERRORS.inc("ws_slow_consumer")
+                self.abort("send queue full")
+                return
+            self._queue.popleft()
+            self.dropped += 1
+            WS_DROPPED.inc()
+        self._queue.append((time.monotonic(), data))
+        self._ready.set()
+
+    async def _write(self):
+        try:
+            while True:
+                while not self._queue:
+                    self._ready.clear()
+                    await self._ready.wait()
+                queued_at, data = self._queue.popleft()
+                if isinstance(data, bytes):
+                    await asyncio.wait_for(self.websocket.send_bytes(data), WS_SEND_TIMEOUT)
+                else:
+                    await asyncio.wait_for(self.websocket.send_text(data), WS_SEND_TIMEOUT)
+                WS_FANOUT.observe(time.monotonic() - queued_at)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            ERRORS.inc("ws_send")
+            self.abort(f"send failed: {e!r}")
+
+    def abort(self, reason: str):
+        """Stop writing and close the socket; the receive loop then sees the disconnect"""
+        if self.closed:
+            return
+        logger.info("Dropping WebSocket of %s: %s", self.user_id, reason)
+        self.close()
+        asyncio.ensure_future(self._close_socket())
+
+    async def _close_socket(self):
+        try:
+            await asyncio.wait_for(self.websocket.close(code=1008), WS_SEND_TIMEOUT)
+        except Exception:
+            pass
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self._queue.clear()
+        if self._writer is not asyncio.current_task():
+            self._writer.cancel()
+        self._on_close(self)
+
+
+class ConnectionManager:
+    """Users connected to this worker and fan-out to the members of a room"""
+
+    def __init__(self, rooms, broker: Broker):
+        self.rooms = rooms  # anything whose get(room_id) yields the member ids
+        self.broker = broker
+        self.active_connections: Dict[str, Connection] = {}
+        broker.subscribe("room.broadcast", self._on_broadcast)
+
+    def attach(self, websocket: WebSocket, user_id: str) -> Connection:
+        """Start the writer for an accepted WebSocket"""
+        previous = self.active_connections.get(user_id)
+        if previous is not None and previous.websocket is not websocket:
+            previous.close()
+        elif previous is not None:
+            return previous
+        connection = Connection(websocket, user_id, self._closed)
+        self.active_connections[user_id] = connection
+        return connection
+
+    def disconnect(self, user_id: str, websocket: Optional[WebSocket] = None):
+        """Forget a user; with ``websocket``, only if it is still that user's socket"""
+        connection = self.active_connections.get(user_id)
+        if connection is None or (websocket is not None and connection.websocket is not websocket):
+            return
+        connection.close()
+
+    def _closed(self, connection: Connection):
+        if self.active_connections.get(connection.user_id) is connection:
+            del self.active_connections[connection.user_id]
+
+    def send_personal_message(self, message: dict, user_id: str):
+        connection = self.active_connections.get(user_id)
+        if connection is not None:
+            connection.send(json.dumps(message))
+
+    def broadcast_to_room(self, message: dict, room_id: str, exclude_user: Optional[str] = None):
+        """Send to the room's members on every worker"""
+        self.broker.publish("room.broadcast", {
+            "room_id": room_id,
+            "text": json.dumps(message),  # once for the whole room
+            "exclude": exclude_user
+        })
+
+    def deliver_to_room(self, message: dict, room_id: str, exclude_user: Optional[str] = None):
+        """Send to the room's members connected to this worker"""
+        self._deliver(json.dumps(message), room_id, exclude_user)
+
+    def _on_broadcast(self, payload: dict, origin: str):
+        self._deliver(payload["text"], payload["room_id"], payload["exclude"])
+
+    def _deliver(self, text: str, room_id: str, exclude_user: Optional[str]):
+        members = self.rooms.get(room_id)
+        if not members:
+            return
+        for user_id in members:
+            if user_id != exclude_user:
+                connection = self.active_connections.get(user_id)
+                if connection is not None:
+                    connection.send(text)
+
+    def close(self):
+        for connection in list(self.active_connections.values()):
+            connection.close()
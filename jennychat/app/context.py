@@ -0,0 +1,216 @@
+"""Prompt context window management for chat completions"""
+import asyncio
+import logging
+import re
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+import httpx
+
+from app.conf import *
+from app.metrics import new_request_id
+from app.scheduler import GenerationScheduler, SchedulerFull, PRIORITY_BATCH
+from app.upstream import backend_pool, get_llama_client, post_completion
+
+logger = logging.getLogger(__name__)
+
+_TOKEN_RE = re.compile(r"\w+|[^\w\s]", re.UNICODE)
+
+SUMMARY_PROMPT = (
+    "Summarize the conversation below in a few sentences. Keep the facts, "
+    "names, decisions and open questions needed to continue it."
+)
+
+
+def estimate_tokens(text: str) -> int:
+    """Cheap local token estimate (words and punctuation, long words split)"""
+    count = 0
+    for piece in _TOKEN_RE.findall(text):
+        count += 1 + len(piece) // 6
+    return count
+
+
+class ContextBuilder:
+    """Selects which chat messages fit in the model context.
+
+    System messages and the most recent turns are always kept. Older turns
+    are added newest first while they fit in the budget, which is the
+    context size minus the room reserved for the reply. Token counts are
+    cached per message, so each message is only tokenized once. When
+    summaries are enabled, turns that fall out of the window are replaced by
+    a rolling summary that is refreshed in the background, admitted by the
+    scheduler at batch priority like any other generation.
+    """
+
+    def __init__(self, scheduler: GenerationScheduler, context_size: int = CONTEXT_SIZE,
+                 tokenizer: str = CONTEXT_TOKENIZER, cache_size: int = CONTEXT_TOKEN_CACHE_SIZE):
+        self.scheduler = scheduler
+        self.context_size = context_size
+        self.tokenizer = tokenizer
+        self.cache_size = cache_size
+        self._counts: "OrderedDict[Tuple[str, str], int]" = OrderedDict()
+        self._summaries: Dict[str, Tuple[int, str, int]] = {}  # chat_id -> (covered, text, tokens)
+        self._summarizing: Dict[str, asyncio.Task] = {}
+        self._anchors: Dict[str, int] = {}  # chat_id -> first turn of the window
+
+    # Token counting
+
+    async def count(self, role: str, content: str) -> int:
+        """Tokens used by one message, including chat template overhead"""
+        key = (role, content)
+        cached = self._counts.get(key)
+        if cached is not None:
+            self._counts.move_to_end(key)
+            return cached
+
+        tokens = None
+        if self.tokenizer == "server":
+            tokens = await self._count_on_server(content)
+        if tokens is None:
+            tokens = estimate_tokens(content)
+        tokens += CONTEXT_MESSAGE_OVERHEAD
+
+        self._counts[key] = tokens
+        if len(self._counts) > self.cache_size:
+            self._counts.popitem(last=False)
+        return tokens
+
+    async def _count_on_server(self, content: str) -> Optional[int]:
+        try:
+            response = await get_llama_client().post("/tokenize", json={"content": content}, timeout=5.0)
+            if response.status_code == 200:
+                return len(response.json().get("tokens", []))
+        except (httpx.HTTPError, ValueError):
+            pass
+        return None
+
+    # Window selection
+
+    async def build(self, chat_id: str, messages: list, max_tokens: Optional[int],
+                    sliding: bool = False) -> Tuple[List[dict], int]:
+        """Return the messages to send upstream and their token count.
+
+        ``sliding`` means ``messages`` are only the newest part of a longer
+        history (a room's recent messages), so turn indexes are not stable:
+        the window is not anchored and no summary is kept.
+        """
+        budget = self.context_size - (max_tokens or 0) - CONTEXT_SAFETY_MARGIN
+        counts = await asyncio.gather(*(self.count(m.role, m.content) for m in messages))
+
+        system = [i for i, m in enumerate(messages) if m.role == "system"]
+        turns = [i for i, m in enumerate(messages) if m.role != "system"]
+        used = sum(counts[i] for i in system)
+
+        if sliding:
+            summary = None
+            start = self._window_start(turns, counts, budget - used)
+        else:
+            summary = self._summaries.get(chat_id) if CONTEXT_SUMMARY_ENABLED else None
+            start = self._stable_start(chat_id, turns, counts, budget - used - (summary[2] if summary else 0))
+        if summary and summary[0] > start:
+            # Summary overlaps the window, it is not needed
+            summary = None
+            start = self._stable_start(chat_id, turns, counts, budget - used)
+
+        selected = [{"role": messages[i].role, "content": messages[i].content} for i in system]
+        if summary:
+            selected.append({"role": "system", "content": summary[1]})
+            used += summary[2]
+        for i in turns[start:]:
+            selected.append({"role": messages[i].role, "content": messages[i].content})
+            used += counts[i]
+
+        if start > 0:
+            logger.debug("Chat %s: dropped %d old messages to fit %d tokens", chat_id, start, budget)
+            if CONTEXT_SUMMARY_ENABLED and not sliding and (summary is None or summary[0] < start):
+                self._schedule_summary(chat_id, [messages[i] for i in turns[:start]])
+        if used > budget:
+            logger.warning("Chat %s: prompt of %d tokens exceeds the %d token budget", chat_id, used, budget)
+
+        return selected, used
+
+    def _stable_start(self, chat_id: str, turns: List[int], counts: List[int], budget: int) -> int:
+        """Window start that only moves in steps, keeping the prompt prefix stable.
+
+        llama-server can only reuse its cached prompt if the beginning of the
+        prompt is unchanged, so instead of sliding by one turn every time the
+        window moves past enough turns to free CONTEXT_TRIM_SLACK of the budget.
+        """
+        fits = self._window_start(turns, counts, budget)
+        anchor = self._anchors.get(chat_id, 0)
+        if fits <= anchor:
+            return anchor
+        anchor = max(fits, self._window_start(turns, counts, int(budget * (1 - CONTEXT_TRIM_SLACK))))
+        self._anchors[chat_id] = anchor
+        return anchor
+
+    @staticmethod
+    def _window_start(turns: List[int], counts: List[int], budget: int) -> int:
+        """Index into ``turns`` of the oldest turn that still fits"""
+        start = len(turns)
+        used = 0
+        for position in range(len(turns) - 1, -1, -1):
+            tokens = counts[turns[position]]
+            always_keep = len(turns) - position <= CONTEXT_MIN_RECENT_MESSAGES
+            if not always_keep and used + tokens > budget:
+                break
+            used += tokens
+            start = position
+        return start
+
+    # Rolling summary
+
+    def forget(self, chat_id: str):
+        """Drop cached state of a deleted chat"""
+        self._summaries.pop(chat_id, None)
+        self._anchors.pop(chat_id, None)
+        task = self._summarizing.pop(chat_id, None)
+        if task is not None:
+            task.cancel()
+
+    def _schedule_summary(self, chat_id: str, dropped: list):
+        if chat_id in self._summarizing:
+            return
+        task = asyncio.create_task(self._summarize(chat_id, dropped))
+        self._summarizing[chat_id] = task
+        task.add_done_callback(lambda _: self._summarizing.pop(chat_id, None))
+
+    async def _summarize(self, chat_id: str, dropped: list):
+        previous = self._summaries.get(chat_id)
+        covered = previous[0] if previous else 0
+        lines = [f"{m.role}: {m.content}" for m in dropped[covered:]]
+        if previous:
+            lines.insert(0, f"(earlier summary) {previous[1]}")
+
+        llama_request = {
+            "messages": [
+                {"role": "system", "content": SUMMARY_PROMPT},
+                {"role": "user", "content": "\n".join(lines)},
+            ],
+            "max_tokens": CONTEXT_SUMMARY_MAX_TOKENS,
+            "temperature": 0.2,
+            "stream": False,
+        }
+        try:
+            ticket = self.scheduler.submit(f"summary:{chat_id}", PRIORITY_BATCH)
+        except SchedulerFull:
+            # Busy: the window is simply used without a fresh summary, the next turn retries
+            logger.debug("Skipped summary of chat %s, generation queue is full", chat_id)
+            return
+        try:
+            if not await self.scheduler.wait(ticket):
+                logger.debug("Skipped summary of chat %s, timed out waiting for a slot", chat_id)
+                return
+            async with backend_pool.lease(chat_id) as lease:
+                response = await post_completion(lease, llama_request, new_request_id())
+            response.raise_for_status()
+            text = response.json()["choices"][0]["message"]["content"].strip()
+        except (httpx.HTTPError, KeyError, IndexError, ValueError) as e:
+            logger.warning("Could not summarize chat %s: %s", chat_id, e)
+            return
+        finally:
+            self.scheduler.release(ticket)
+
+        if text:
+            content = f"Summary of the earlier conversation: {text}"
+            self._summaries[chat_id] = (len(dropped), content, await self.count("system", content))
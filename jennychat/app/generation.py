@@ -0,0 +1,130 @@
+"""Tracking and cancellation of in-flight generations"""
+import asyncio
+from typing import AsyncIterator, Dict, Optional, Set
+
+from fastapi import Request
+
+from app.conf import *
+
+
+class Generation:
+    """One running chat completion that can be stopped"""
+
+    def __init__(self, chat_id: str):
+        self.chat_id = chat_id
+        self.reason: Optional[str] = None
+        self.cancelled = asyncio.Event()
+        self._watcher: Optional[asyncio.Task] = None
+
+    def cancel(self, reason: str = "cancelled"):
+        if self.reason is None:
+            self.reason = reason
+        self.cancelled.set()
+
+    def watch_disconnect(self, request: Request):
+        """Cancel as soon as the HTTP client goes away"""
+        async def watch():
+            while not self.cancelled.is_set():
+                if await request.is_disconnected():
+                    self.cancel("disconnected")
+                    return
+                try:
+                    await asyncio.wait_for(self.cancelled.wait(), CANCEL_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+        self._watcher = asyncio.create_task(watch())
+
+    def stop_watching(self):
+        if self._watcher is not None:
+            self._watcher.cancel()
+            self._watcher = None
+
+
+class ActiveGenerations:
+    """Generations currently running, by chat_id"""
+
+    def __init__(self):
+        self._by_chat: Dict[str, Set[Generation]] = {}
+
+    def start(self, chat_id: str) -> Generation:
+        generation = Generation(chat_id)
+        self._by_chat.setdefault(chat_id, set()).add(generation)
+        return generation
+
+    def finish(self, generation: Generation):
+        generation.stop_watching()
+        running = self._by_chat.get(generation.chat_id)
+        if running is not None:
+            running.discard(generation)
+            if not running:
+                del self._by_chat[generation.chat_id]
+
+    def cancel(self, chat_id: str, reason: str = "cancelled") -> bool:
+        """Stop every generation of a chat; False if none was running"""
+        running = self._by_chat.get(chat_id)
+        if not running:
+            return False
+        for generation in list(running):
+            generation.cancel(reason)
+        return True
+
+
+async def until_cancelled(iterator: AsyncIterator, generation: Generation) -> AsyncIterator:
+    """Iterate until exhausted or until the generation is cancelled.
+
+    The pending read is cancelled right away, which closes the upstream
+    stream instead of waiting for its next token.
+    """
+    iterator = iterator.__aiter__()
+    stop = asyncio.ensure_future(generation.cancelled.wait())
+    step = None
+    try:
+        while not generation.cancelled.is_set():
+            step = asyncio.ensure_future(iterator.__anext__())
+            await asyncio.wait({step, stop}, return_when=asyncio.FIRST_COMPLETED)
+            if not step.done():
+                return
+            try:
+                item = step.result()
+            except StopAsyncIteration:
+                return
+            finally:
+                step = None
+            yield item
+    finally:
+        stop.cancel()
+        if step is not None and not step.done():
+            step.cancel()
+            try:
+                await step
+            except (asyncio.CancelledError, StopAsyncIteration):
+                pass
+        aclose = getattr(iterator, "aclose", None)
+        if aclose is not None:
+            await aclose()
+
+
+class GenerationCancelled(Exception):
+    """Raised by ``cancellable`` when the generation was stopped"""
+
+
+async def cancellable(awaitable, generation: Generation):
+    """Await something unless the generation is cancelled first"""
+    task = asyncio.ensure_future(awaitable)
+    stop = asyncio.ensure_future(generation.cancelled.wait())
+    try:
+        try:
+            await asyncio.wait({task, stop}, return_when=asyncio.FIRST_COMPLETED)
+        except asyncio.CancelledError:
+            task.cancel()
+            raise
+        if not task.done():
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+            raise GenerationCancelled(generation.reason)
+        return task.result()
+    finally:
+        stop.cancel()
@@ -1,21 +1,74 @@
 
 from fastapi import FastAPI, HTTPException, Query, FastAPI, Request, Form, WebSocket, WebSocketDisconnect
-from fastapi.responses import StreamingResponse, HTMLResponse
+from fastapi.responses import StreamingResponse, HTMLResponse, JSONResponse, Response
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from typing import List, Optional, Dict, Any
+from starlette.background import BackgroundTask
+from pydantic import BaseModel, ValidationError
+from typing import List, Optional, Dict, Any, Set
 import httpx
 import json
 import asyncio
+import time
 from datetime import datetime
 import uuid
 from pathlib import Path
 import os, sys
+from contextlib import aclosing, asynccontextmanager
 from app.conf import *
-
-app = FastAPI(title="Jenny AI Chat", version="1.0.0")
+from app.upstream import backend_pool, post_completion, open_completion_stream
+from app.sse import iter_completion_deltas, coalesce, sse_event
+from app.models import *
+from app.storage import create_session_store
+from app.sessions import Session, SessionRegistry, message_to_dict
+from app.rooms import Room, RoomRegistry
+from app.search import SearchService
+from app.assets import AssetFiles, AssetPipeline
+from app.context import ContextBuilder
+from app.generation import ActiveGenerations, Generation, GenerationCancelled, cancellable, until_cancelled
+from app.cache import CompletionCache, RefreshingValue
+from app.connections import ConnectionManager
+from app.channel import ChatChannel, MAX_ID_BYTES
+from app.pubsub import create_broker
+from app import metrics
+from app.metrics import Trace, error_kind, new_request_id, timed_tokens
+from app.scheduler import GenerationScheduler, SchedulerFull, Ticket, PRIORITY_INTERACTIVE, PRIORITY_BATCH
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Static files are fingerprinted and compressed once, before the first page is rendered
+    await asyncio.to_thread(assets.build)
+    # One pooled keep-alive client per backend, plus background health probes
+    await backend_pool.start()
+    app.state.backends = backend_pool
+    scheduler.configure(SCHEDULER_CONCURRENCY or backend_pool.total_slots())
+    models_cache.refresh_in_background()
+    # Chat catalog is read here; messages are loaded lazily per chat
+    await chat_sessions.start()
+    await rooms.start()
+    # Built in the background; events received meanwhile are applied once it is done
+    await search_service.start()
+    # Joined once local state is loaded, so other workers' replies apply on top of it
+    await broker.start()
+    try:
+        yield
+    finally:
+        for task in list(room_answers):
+            task.cancel()
+        manager.close()
+        for channel in list(chat_channels):
+            channel.close()
+        # Saves the search index, on the leader, so it goes before the broker
+        await search_service.close()
+        await broker.close()
+        await rooms.close()
+        await chat_sessions.close()
+        await backend_pool.close()
+
+
+app = FastAPI(title="Jenny AI Chat", version="1.0.0", lifespan=lifespan)
 
 # CORS
 app.add_middleware(
@@ -26,204 +79,222 @@ app.add_middleware(
 )
 
 
-# Montar frontend estático
-app.mount("/static", StaticFiles(directory=os.path.join(os.path.dirname(__file__), "static")), name="static")
+# Montar frontend estático: hashed, precompressed copies (see ASSETS_* in conf.py), plain files otherwise
+assets = AssetPipeline(Path(__file__).parent / "static")
+app.mount("/static", AssetFiles(assets), name="static")
 templates = Jinja2Templates(directory=os.path.join(os.path.dirname(__file__), "templates"))
-
-
-# Configurations
-CHAT_HISTORY_DIR = Path("chat_history")
-CHAT_HISTORY_DIR.mkdir(exist_ok=True)
-
-class ChatMessage(BaseModel):
-    role: str  # "user", "assistant", "system"
-    content: str
-    timestamp: datetime = None
-
-class ChatRequest(BaseModel):
-    message: str
-    chat_id: Optional[str] = None
-    model: Optional[str] = "default"
-    stream: bool = True
-    max_tokens: Optional[int] = 2048
-    temperature: Optional[float] = 0.7
-
-class ChatResponse(BaseModel):
-    chat_id: str
-    message: ChatMessage
-    model: str
-
-class ChatSession(BaseModel):
-    chat_id: str
-    title: str
-    messages: List[ChatMessage]
-    created_at: datetime
-    updated_at: datetime
-
-# Collaborative chat models
-class CollaborativeMessage(BaseModel):
-    id: str
-    roomId: str
-    userId: str
-    username: str
-    content: str
-    timestamp: datetime
-
-class CollaborativeRoom(BaseModel):
-    id: str
-    name: str
-    description: Optional[str] = ""
-    private: bool = False
-    created_at: datetime
-
-    created_by: str
-
-class ConnectedUser(BaseModel):
-    userId: str
-    username: str
-    websocket: WebSocket
-    currentRoom: Optional[str] = None
-    model_config = {"arbitrary_types_allowed": True}
-
-
-# In-memory storage for chat sessions (replace with database in production)
-chat_sessions: Dict[str, ChatSession] = {}
-
-# Collaborative chat storage
-collaborative_rooms: Dict[str, CollaborativeRoom] = {}
-collaborative_messages: Dict[str, List[CollaborativeMessage]] = {}
-connected_users: Dict[str, ConnectedUser] = {}
-room_users: Dict[str, List[str]] = {}  # roomId -> list of userIds
-
-# WebSocket connection manager
-class ConnectionManager:
-    def __init__(self):
-        self.active_connections: Dict[str, WebSocket] = {}
-
-    async def connect(self, websocket: WebSocket, user_id: str):
-        await websocket.accept()
-        self.active_connections[user_id] = websocket
-
-    def disconnect(self, user_id: str):
-        if user_id in self.active_connections:
-            del self.active_connections[user_id]
-
-    async def send_personal_message(self, message: dict, user_id: str):
-        if user_id in self.active_connections:
-            try:
-                await self.active_connections[user_id].send_text(json.dumps(message))
-            except:
-                self.disconnect(user_id)
-
-    async def broadcast_to_room(self, message: dict, room_id: str, exclude_user: str = None):
-        if room_id in room_users:
-            for user_id in room_users[room_id]:
-                if user_id != exclude_user and user_id in self.active_connections:
-                    try:
-                        await self.active_connections[user_id].send_text(json.dumps(message))
-                    except:
-                        self.disconnect(user_id)
-
-manager = ConnectionManager()
+templates.env.globals.update(static_url=assets.static_url, import_map=assets.import_map,
+                             module_tags=assets.module_tags)
+
+
+# Shares rooms, presence and chat metadata between uvicorn workers (see PUBSUB_* in conf.py)
+broker = create_broker()
+
+# Chat sessions, persisted through the backend selected by CHAT_STORE_BACKEND
+chat_sessions = SessionRegistry(create_session_store(is_leader=lambda: broker.is_leader), broker)
+
+# Full-text and semantic search over every chat (see SEARCH_* in conf.py)
+search_service = SearchService(chat_sessions, broker)
+
+# Admission control: one running generation per llama-server slot, the rest queue fairly
+scheduler = GenerationScheduler()
+
+# Keeps prompts within the model context (see CONTEXT_* in conf.py)
+context_builder = ContextBuilder(scheduler)
+
+# Answers to repeated deterministic requests (see COMPLETION_CACHE_* in conf.py)
+completion_cache = CompletionCache()
+
+# Running generations, so they can be stopped on disconnect or on request
+generations = ActiveGenerations()
+broker.subscribe("generation.cancel", lambda payload, origin: generations.cancel(payload["chat_id"]))
+
+
+def client_key(request: Request) -> str:
+    """Identity used for per-user fair queuing"""
+    return request.headers.get("x-user-id") or (request.client.host if request.client else "anonymous")
+
+# Collaborative rooms: bounded recent history in memory, the rest in ROOM_HISTORY_DIR
+rooms = RoomRegistry(create_session_store(ROOM_HISTORY_DIR, is_leader=lambda: broker.is_leader), broker)
+connected_users: Dict[str, ConnectedUser] = {}  # users connected to this worker
+
+# WebSocket fan-out: serialized once per message, written by one task per connection
+manager = ConnectionManager(rooms, broker)
+rooms.on_message = lambda room, message: manager.deliver_to_room({"type": "new_message", "message": message}, room.id)
+rooms.on_roster = lambda room: manager.deliver_to_room({"type": "room_users", "users": room.roster}, room.id)
+rooms.on_ai_lost = lambda room, request_id: manager.deliver_to_room({
+    "type": "ai_done", "roomId": room.id, "requestId": request_id, "truncated": True, "error": "Generation lost"
+}, room.id)
+room_answers = set()  # running ask_ai tasks
+
+# /ws/chat sockets of this worker; chat list changes from every worker are pushed to them
+chat_channels: Set[ChatChannel] = set()
+
+def push_to_channels(message: dict):
+    text = json.dumps(message)  # once for every socket
+    for channel in chat_channels:
+        channel.connection.send(text)
+
+broker.subscribe("session.meta", lambda record, origin: push_to_channels({"type": "chat", "chat": record}))
+broker.subscribe("session.deleted", lambda payload, origin: push_to_channels({
+    "type": "chat_deleted", "chat_id": payload["chat_id"]
+}))
+
+# Gauges read at scrape time from the state they describe
+metrics.SCHEDULER_RUNNING.collect = lambda: {(): scheduler.running}
+metrics.SCHEDULER_QUEUED.collect = lambda: {(): scheduler.queued}
+metrics.SESSIONS_LOADED.collect = lambda: {(): len(chat_sessions.sessions)}
+metrics.SESSION_MEMORY.collect = lambda: {(): chat_sessions.memory}
+metrics.SEARCH_INDEXED.collect = lambda: {
+    ("text",): len(search_service.text),
+    ("vector",): len(search_service.vectors) if search_service.vectors is not None else 0,
+}
+metrics.WS_CONNECTIONS.collect = lambda: {(): len(manager.active_connections)}
+metrics.WS_CHAT_CONNECTIONS.collect = lambda: {(): len(chat_channels)}
+metrics.WS_CHAT_GENERATIONS.collect = lambda: {(): sum(len(channel.tasks) for channel in chat_channels)}
+metrics.WS_ROOM_CONNECTIONS.collect = lambda: {
+    (room.id,): sum(1 for user_id in room if user_id in manager.active_connections)
+    for room in rooms.rooms.values() if len(room)
+}
 
 @app.get("/", response_class=HTMLResponse)
 def index(request: Request):
-    return templates.TemplateResponse(
-        "jennychat_index.html",
-        {"request": request}
-    )
+    return templates.TemplateResponse(request, "jennychat_index.html")
   
 
 
 @app.get("/api/chats")
-async def get_chats():
-    """Get list of all chat sessions"""
+async def get_chats(request: Request, limit: int = Query(CHATS_PAGE_SIZE, ge=1, le=CHATS_PAGE_MAX),
+                    before: Optional[str] = None):
+    """Get chat sessions, most recently updated first, one page at a time"""
+    etag = chat_sessions.etag
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+
     try:
-        chat_list = []
-        for chat_id, session in chat_sessions.items():
-            chat_list.append({
-                "chat_id": chat_id,
-                "title": session.title,
-                "message_count": len(session.messages),
-                "updated_at": session.updated_at.isoformat()
-            })
-        
-        # Sort by updated_at descending
-        chat_list.sort(key=lambda x: x["updated_at"], reverse=True)
-        
-        return {"chats": chat_list}
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        chats, next_cursor = chat_sessions.index.page(limit, before)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+    body = json.dumps({"chats": chats, "next_cursor": next_cursor})
+    return Response(content=body, media_type="application/json", headers=headers)
 
 @app.get("/api/chats/{chat_id}")
-async def get_chat(chat_id: str):
-    """Get a specific chat session"""
-    if chat_id not in chat_sessions:
+async def get_chat(request: Request, chat_id: str, limit: Optional[int] = Query(None, ge=1),
+                   before: Optional[int] = Query(None, ge=1), since: Optional[int] = Query(None, ge=0)):
+    """Get a chat session: all messages, the last ``limit`` ones, older pages
+    (``before`` a seq) or only the messages added ``since`` a seq"""
+    etag = chat_sessions.session_etag(chat_id)
+    if etag is None:
         raise HTTPException(status_code=404, detail="Chat not found")
-    
-    return chat_sessions[chat_id]
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+
+    session = await chat_sessions.get(chat_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail="Chat not found")
+
+    messages, has_more = chat_sessions.window(session, limit, before, since)
+    body = json.dumps({
+        "chat_id": session.chat_id,
+        "title": session.title,
+        "created_at": session.created_at.isoformat(),
+        "updated_at": session.updated_at.isoformat(),
+        "last_seq": len(session.messages),
+        "has_more": has_more,
+        "messages": [message_to_dict(m) for m in messages],
+    })
+    return Response(content=body, media_type="application/json", headers=headers)
 
 @app.post("/api/chats")
 async def create_chat():
     """Create a new chat session"""
-    chat_id = str(uuid.uuid4())
-    now = datetime.now()
-    
-    session = ChatSession(
-        chat_id=chat_id,
-        title=f"Chat {len(chat_sessions) + 1}",
-        messages=[],
-        created_at=now,
-        updated_at=now
-    )
-    
-    chat_sessions[chat_id] = session
-    return {"chat_id": chat_id, "title": session.title}
+    session = chat_sessions.create()
+    return {"chat_id": session.chat_id, "title": session.title}
 
 @app.delete("/api/chats/{chat_id}")
 async def delete_chat(chat_id: str):
     """Delete a chat session"""
-    if chat_id not in chat_sessions:
+    if not chat_sessions.delete(chat_id):
         raise HTTPException(status_code=404, detail="Chat not found")
+    context_builder.forget(chat_id)
+    backend_pool.forget(chat_id)
     
-    del chat_sessions[chat_id]
     return {"message": "Chat deleted successfully"}
 
+@app.get("/api/search")
+async def search_messages(q: str = Query(..., min_length=1, max_length=SEARCH_QUERY_MAX),
+                          limit: int = Query(SEARCH_PAGE_SIZE, ge=1, le=SEARCH_PAGE_MAX), mode: str = "hybrid"):
+    """Messages of every chat matching a query, by words (text), meaning (semantic) or both (hybrid)"""
+    if mode not in ("hybrid", "text", "semantic"):
+        raise HTTPException(status_code=400, detail="mode must be hybrid, text or semantic")
+    started = time.monotonic()
+    hits = await search_service.search(q, limit, mode)
+    elapsed = time.monotonic() - started
+    metrics.SEARCH_TIME.observe(elapsed, mode)
+    return {
+        "query": q,
+        "mode": mode,
+        "hits": hits,
+        "indexing": search_service.indexing,
+        "semantic": search_service.semantic,
+        "took_ms": round(elapsed * 1000, 1),
+    }
+
+def admit(http_request: Request, priority: int) -> Ticket:
+    """Take a scheduler ticket or refuse the request right away"""
+    try:
+        return scheduler.submit(client_key(http_request), priority)
+    except SchedulerFull as e:
+        metrics.ERRORS.inc("queue_full")
+        raise HTTPException(status_code=e.status_code, detail=e.detail, headers={"Retry-After": str(e.retry_after)})
+
 @app.post("/api/chat")
-async def send_message(request: ChatRequest):
+async def send_message(request: ChatRequest, http_request: Request, http_response: Response):
     """Send a message to the AI and get response"""
+    # Tags the logs of this request here and in llama-server
+    request_id = http_request.headers.get(REQUEST_ID_HEADER) or new_request_id()
+    http_response.headers[REQUEST_ID_HEADER] = request_id
+    trace = Trace(request_id, request.chat_id or "", "stream" if request.stream else "batch")
+    outcome = "error"
+
+    # Deterministic non-streaming requests may be answered from the cache, so
+    # they are only admitted once they actually need the model
+    cacheable = not request.stream and completion_cache.accepts(
+        request.temperature, http_request.headers.get("cache-control", "")
+    )
+    ticket = None
+    if not cacheable:
+        # Admission first: refuse fast instead of piling up behind busy slots
+        ticket = admit(http_request, PRIORITY_INTERACTIVE if request.stream else PRIORITY_BATCH)
+
+    handed_off = False
     try:
         # Create new chat if none specified
-        if not request.chat_id or request.chat_id not in chat_sessions:
-            chat_id = str(uuid.uuid4())
-            now = datetime.now()
-            session = ChatSession(
-                chat_id=chat_id,
-                title=f"Chat {len(chat_sessions) + 1}",
-                messages=[],
-                created_at=now,
-                updated_at=now
-            )
-            chat_sessions[chat_id] = session
-        else:
-            chat_id = request.chat_id
-            session = chat_sessions[chat_id]
+        session = await chat_sessions.get(request.chat_id) if request.chat_id else None
+        if session is None:
+            session = chat_sessions.create()
+        chat_id = session.chat_id
+        trace.chat_id = chat_id
 
-        # Add user message to session
         user_message = ChatMessage(
             role="user",
             content=request.message,
             timestamp=datetime.now()
         )
-        session.messages.append(user_message)
-
-        # Prepare messages for LLama-Cpp Server
-        messages = []
-        for msg in session.messages:
-            messages.append({
-                "role": msg.role,
-                "content": msg.content
-            })
+        if request.stream:
+            # Add user message to session
+            chat_sessions.append(session, user_message)
+            history = session.messages
+        else:
+            # Only kept once the reply arrives
+            history = session.messages + [user_message]
+
+        # Prepare messages for LLama-Cpp Server, trimmed to the context budget
+        messages, prompt_tokens = await context_builder.build(chat_id, history, request.max_tokens)
+        trace.prompt(len(messages), prompt_tokens)
 
         # Send request to LLama-Cpp Server
         llama_request = {
@@ -233,119 +304,370 @@ async def send_message(request: ChatRequest):
             "stream": request.stream
         }
 
-        async with httpx.AsyncClient() as client:
-            if request.stream:
-                return StreamingResponse(
-                    stream_chat_response(client, chat_id, llama_request),
-                    media_type="text/plain"
-                )
-            else:
-                response = await client.post(
-                    f"{LLAMA_CPP_SERVER_URL}/v1/chat/completions",
-                    json=llama_request,
-                    timeout=60.0
-                )
-                
-                if response.status_code != 200:
-                    raise HTTPException(status_code=response.status_code, detail="LLama-Cpp Server error")
-                
-                result = response.json()
-                assistant_content = result["choices"][0]["message"]["content"]
-                
-                # Add assistant response to session
-                assistant_message = ChatMessage(
-                    role="assistant",
-                    content=assistant_content,
-                    timestamp=datetime.now()
-                )
-                session.messages.append(assistant_message)
-                session.updated_at = datetime.now()
-                
-                return ChatResponse(
-                    chat_id=chat_id,
-                    message=assistant_message,
-                    model=request.model
-                )
+        if request.stream:
+            # The stream waits for its turn itself; the background task frees the
+            # ticket even if the client goes away before the stream starts
+            handed_off = True
+            return StreamingResponse(
+                stream_chat_response(session, llama_request, ticket, http_request, trace),
+                media_type="text/event-stream",
+                headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no", REQUEST_ID_HEADER: request_id},
+                background=BackgroundTask(scheduler.release, ticket)
+            )
 
+        async def generate() -> str:
+            nonlocal ticket
+            if ticket is None:
+                ticket = admit(http_request, PRIORITY_BATCH)
+
+            generation = generations.start(chat_id)
+            generation.watch_disconnect(http_request)
+            try:
+                if not await cancellable(scheduler.wait(ticket), generation):
+                    metrics.ERRORS.inc("queue_timeout")
+                    raise HTTPException(status_code=503, detail="Timed out waiting for a generation slot",
+                                        headers={"Retry-After": str(scheduler.retry_after())})
+                trace.admitted()
+
+                # Same backend and slot as the previous turn, so the cached prefix is reused
+                async with backend_pool.lease(chat_id) as lease:
+                    trace.sent()
+                    response = await cancellable(post_completion(lease, llama_request, request_id), generation)
+            finally:
+                generations.finish(generation)
+
+            if response.status_code != 200:
+                metrics.ERRORS.inc("upstream_status")
+                raise HTTPException(status_code=response.status_code, detail="LLama-Cpp Server error")
+
+            result = response.json()
+            trace.completed((result.get("usage") or {}).get("completion_tokens", 0))
+            return result["choices"][0]["message"]["content"]
+
+        if cacheable:
+            key = completion_cache.key(request.model, messages, {
+                "max_tokens": request.max_tokens,
+                "temperature": request.temperature
+            })
+            assistant_content, cache_status = await completion_cache.get_or_compute(key, generate)
+            http_response.headers["X-Cache"] = cache_status
+            outcome = "ok" if cache_status == "MISS" else "cached"
+        else:
+            assistant_content = await generate()
+            outcome = "ok"
+
+        # Add the turn to the session
+        assistant_message = ChatMessage(
+            role="assistant",
+            content=assistant_content,
+            timestamp=datetime.now()
+        )
+        chat_sessions.append(session, user_message)
+        chat_sessions.append(session, assistant_message)
+
+        return ChatResponse(
+            chat_id=chat_id,
+            message=assistant_message,
+            model=request.model
+        )
+
+    except GenerationCancelled:
+        # Not shared with requests waiting on the same completion: one of them takes over
+        outcome = "cancelled"
+        raise HTTPException(status_code=499, detail="Generation cancelled")
+    except HTTPException:
+        raise
     except httpx.RequestError as e:
+        metrics.ERRORS.inc(error_kind(e))
         raise HTTPException(status_code=503, detail=f"Failed to connect to LLama-Cpp Server: {str(e)}")
     except Exception as e:
+        metrics.ERRORS.inc(error_kind(e))
         raise HTTPException(status_code=500, detail=str(e))
-
-async def stream_chat_response(client: httpx.AsyncClient, chat_id: str, llama_request: dict):
+    finally:
+        if not handed_off:
+            # A stream finishes its own trace
+            trace.finish(outcome)
+            if ticket is not None:
+                scheduler.release(ticket)
+
+@app.get("/metrics")
+async def get_metrics():
+    """Prometheus metrics of this worker"""
+    return Response(content=metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.get("/api/cache/stats")
+async def get_cache_stats():
+    """Completion cache counters"""
+    return completion_cache.snapshot()
+
+async def stream_chat_response(session: Session, llama_request: dict, ticket: Ticket, http_request: Request,
+                               trace: Trace):
     """Stream chat response from LLama-Cpp Server"""
+    generation = generations.start(session.chat_id)
+    generation.watch_disconnect(http_request)
+    async with aclosing(stream_chat_events(session, llama_request, ticket, generation, trace)) as events:
+        async for event in events:
+            yield sse_event(event)
+
+async def stream_chat_events(session: Session, llama_request: dict, ticket: Ticket, generation: Generation,
+                             trace: Trace):
+    """Events of one streamed reply: queue positions, content, then how it ended.
+    Shared by the SSE stream of /api/chat and the /ws/chat channel"""
+    chat_id = session.chat_id
+    metrics.ACTIVE_STREAMS.inc()
+    parts = []
+    saved = False
+    outcome = "error"
+
+    def save_reply():
+        # Add the (possibly partial) response to the session
+        nonlocal saved
+        full_content = "".join(parts)
+        if full_content and not saved:
+            saved = True
+            chat_sessions.append(session, ChatMessage(
+                role="assistant",
+                content=full_content,
+                timestamp=datetime.now(),
+                truncated=generation.cancelled.is_set()
+            ))
+        return full_content
+
     try:
-        async with client.stream(
-            "POST",
-            f"{LLAMA_CPP_SERVER_URL}/v1/chat/completions",
-            json=llama_request,
-            timeout=60.0
-        ) as response:
-            if response.status_code != 200:
-                yield f"data: {json.dumps({'error': 'LLama-Cpp Server error'})}\n\n"
-                return
-            
-            full_content = ""
-            async for chunk in response.aiter_text():
-                if chunk.strip():
-                    try:
-                        # Parse SSE format
-                        if chunk.startswith("data: "):
-                            data = chunk[6:].strip()
-                            if data == "[DONE]":
-                                break
-                            
-                            parsed = json.loads(data)
-                            if "choices" in parsed and len(parsed["choices"]) > 0:
-                                delta = parsed["choices"][0].get("delta", {})
-                                if "content" in delta:
-                                    content = delta["content"]
-                                    full_content += content
-                                    yield f"data: {json.dumps({'content': content, 'chat_id': chat_id})}\n\n"
-                    except json.JSONDecodeError:
-                        continue
-            
-            # Add complete response to session
-            if full_content:
-                session = chat_sessions[chat_id]
-                assistant_message = ChatMessage(
-                    role="assistant",
-                    content=full_content,
-                    timestamp=datetime.now()
-                )
-                session.messages.append(assistant_message)
-                session.updated_at = datetime.now()
-                
-                yield f"data: {json.dumps({'done': True, 'chat_id': chat_id})}\n\n"
-    
+        async for position in until_cancelled(scheduler.positions(ticket), generation):
+            yield {'queued': True, 'position': position, 'chat_id': chat_id}
+        if generation.cancelled.is_set():
+            outcome = generation.reason
+            yield {'cancelled': True, 'chat_id': chat_id}
+            return
+        if not ticket.granted:
+            metrics.ERRORS.inc("queue_timeout")
+            outcome = "queue_timeout"
+            yield {'error': 'Timed out waiting for a generation slot'}
+            return
+        trace.admitted()
+
+        # Leased here, not in send_message, so it is released even if the stream never starts
+        async with backend_pool.lease(chat_id) as lease:
+            trace.sent()
+            response = await open_completion_stream(lease, llama_request, trace.request_id)
+            trace.headers()
+            try:
+                if response.status_code != 200:
+                    metrics.ERRORS.inc("upstream_status")
+                    yield {'error': 'LLama-Cpp Server error'}
+                    return
+
+                # Tokens are grouped so each HTTP write carries several of them; a
+                # cancellation closes the upstream stream so the slot stops generating
+                deltas = timed_tokens(iter_completion_deltas(response.aiter_lines()), trace)
+                tokens = coalesce(deltas, STREAM_FLUSH_INTERVAL_MS, STREAM_FLUSH_MAX_TOKENS)
+                async for content in until_cancelled(tokens, generation):
+                    parts.append(content)
+                    yield {'content': content, 'chat_id': chat_id}
+            finally:
+                await response.aclose()
+
+        full_content = save_reply()
+        outcome = generation.reason or "ok"
+        if generation.cancelled.is_set():
+            yield {'cancelled': True, 'truncated': bool(full_content), 'chat_id': chat_id}
+        elif full_content:
+            yield {'done': True, 'chat_id': chat_id}
+
+    except asyncio.CancelledError:
+        # Torn down by the server after a disconnect: keep what was generated
+        generation.cancel("disconnected")
+        outcome = generation.reason
+        save_reply()
+        raise
     except Exception as e:
-        yield f"data: {json.dumps({'error': str(e)})}\n\n"
+        metrics.ERRORS.inc(error_kind(e))
+        yield {'error': str(e)}
+    finally:
+        generations.finish(generation)
+        scheduler.release(ticket)
+        metrics.ACTIVE_STREAMS.dec()
+        trace.finish(outcome)
+
+@app.post("/api/chat/{chat_id}/cancel")
+async def cancel_generation(chat_id: str):
+    """Stop the generation running for a chat"""
+    if generations.cancel(chat_id):
+        return {"message": "Generation cancelled"}
+    if broker.shared:
+        # It may be running on another worker
+        broker.publish("generation.cancel", {"chat_id": chat_id})
+        return JSONResponse({"message": "Cancellation requested"}, status_code=202)
+    raise HTTPException(status_code=404, detail="No generation in progress")
+
+async def load_models() -> dict:
+    """Model list merged across every healthy backend"""
+    models = await backend_pool.list_models()
+    if models:
+        return {"object": "list", "data": models}
+    else:
+        return {"data": [{"id": "default", "object": "model"}]}
+
+# Page loads read a cached copy; llama-server is asked at most once per refresh
+models_cache = RefreshingValue(load_models, MODELS_CACHE_TTL, MODELS_CACHE_MAX_STALE)
 
 @app.get("/api/models")
-async def get_models():
+async def get_models(request: Request):
     """Get available models from LLama-Cpp Server"""
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(f"{LLAMA_CPP_SERVER_URL}/v1/models", timeout=10.0)
-            if response.status_code == 200:
-                return response.json()
-            else:
-                return {"data": [{"id": "default", "object": "model"}]}
-    except:
+        await models_cache.get()
+    except Exception:
         return {"data": [{"id": "default", "object": "model"}]}
 
+    headers = {"ETag": models_cache.etag, "Cache-Control": f"max-age={int(MODELS_CACHE_TTL)}"}
+    if request.headers.get("if-none-match") == models_cache.etag:
+        return Response(status_code=304, headers=headers)
+    return Response(content=models_cache.body, media_type="application/json", headers=headers)
+
 @app.put("/api/chats/{chat_id}/title")
 async def update_chat_title(chat_id: str, title: dict):
     """Update chat title"""
-    if chat_id not in chat_sessions:
+    if not chat_sessions.rename(chat_id, title.get("title", "Untitled Chat")):
         raise HTTPException(status_code=404, detail="Chat not found")
     
-    chat_sessions[chat_id].title = title.get("title", "Untitled Chat")
-    chat_sessions[chat_id].updated_at = datetime.now()
-    
     return {"message": "Title updated successfully"}
 
 # Collaborative chat WebSocket endpoint
+def leave_current_room(user_id: str):
+    """Take a user out of their room and tell the others"""
+    user = connected_users[user_id]
+    room = rooms.get(user.currentRoom) if user.currentRoom else None
+    user.currentRoom = None
+    if room is not None and rooms.leave(room, user_id):
+        manager.broadcast_to_room({
+            "type": "user_left",
+            "username": user.username,
+            "users": room.roster
+        }, room.id, user_id)
+    return room
+
+WS_MESSAGE_TYPES = {"user_connect", "get_rooms", "create_room", "join_room", "leave_room",
+                    "send_message", "load_history", "ask_ai", "cancel_ai", "update_username"}
+
+def room_prompt(history: List[dict]) -> List[ChatMessage]:
+    """A room's recent messages as a chat, with the AI's own messages as assistant turns"""
+    prompt = [ChatMessage(role="system", content=ROOM_AI_SYSTEM_PROMPT, timestamp=datetime.now())]
+    for message in history:
+        timestamp = datetime.fromisoformat(message["timestamp"])
+        if message["userId"] == ROOM_AI_USER_ID:
+            prompt.append(ChatMessage(role="assistant", content=message["content"], timestamp=timestamp))
+        else:
+            prompt.append(ChatMessage(role="user", content=f"{message['username']}: {message['content']}",
+                                      timestamp=timestamp))
+    return prompt
+
+def ask_room_ai(room: Room, user: ConnectedUser, question: str):
+    """Start one AI answer for a whole room, or tell the user why not"""
+    if room.ai_request is not None:
+        manager.send_personal_message({"type": "error", "message": f"{ROOM_AI_USERNAME} is already answering"},
+                                      user.userId)
+        return
+    try:
+        ticket = scheduler.submit(user.userId, PRIORITY_INTERACTIVE)
+    except SchedulerFull as e:
+        metrics.ERRORS.inc("queue_full")
+        manager.send_personal_message({"type": "error", "message": e.detail}, user.userId)
+        return
+
+    request_id = new_request_id()
+    rooms.ai_started(room, request_id)
+    # Snapshot first: the question may be appended to room.recent before post returns
+    history = list(room.recent)[-ROOM_AI_CONTEXT_MESSAGES:]
+    if question:
+        rooms.post(room, user.userId, user.username, question)
+        history.append({"userId": user.userId, "username": user.username, "content": question,
+                        "timestamp": datetime.now().isoformat()})
+    manager.broadcast_to_room({
+        "type": "ai_started", "roomId": room.id, "requestId": request_id, "askedBy": user.username
+    }, room.id)
+
+    task = asyncio.create_task(answer_in_room(room, history, ticket, request_id))
+    room_answers.add(task)
+    task.add_done_callback(room_answers.discard)
+
+async def answer_in_room(room: Room, history: List[dict], ticket: Ticket, request_id: str):
+    """Generate once and broadcast the tokens to every member of the room"""
+    generation = generations.start(room.id)
+    trace = Trace(request_id, room.id, "room")
+    metrics.ACTIVE_STREAMS.inc()
+    parts = []
+    outcome = "error"
+    error = None
+    try:
+        messages, prompt_tokens = await context_builder.build(room.id, room_prompt(history), ROOM_AI_MAX_TOKENS,
+                                                              sliding=True)
+        trace.prompt(len(messages), prompt_tokens)
+        if not await cancellable(scheduler.wait(ticket), generation):
+            metrics.ERRORS.inc("queue_timeout")
+            outcome, error = "queue_timeout", "Timed out waiting for a generation slot"
+            return
+        trace.admitted()
+
+        llama_request = {
+            "messages": messages,
+            "max_tokens": ROOM_AI_MAX_TOKENS,
+            "temperature": ROOM_AI_TEMPERATURE,
+            "stream": True
+        }
+        # The room keeps its backend and slot, so the shared prefix is reused
+        async with backend_pool.lease(room.id) as lease:
+            trace.sent()
+            response = await open_completion_stream(lease, llama_request, request_id)
+            trace.headers()
+            try:
+                if response.status_code != 200:
+                    metrics.ERRORS.inc("upstream_status")
+                    error = "LLama-Cpp Server error"
+                    return
+                deltas = timed_tokens(iter_completion_deltas(response.aiter_lines()), trace)
+                tokens = coalesce(deltas, ROOM_AI_FLUSH_INTERVAL_MS, ROOM_AI_FLUSH_MAX_TOKENS)
+                async for content in until_cancelled(tokens, generation):
+                    parts.append(content)
+                    # Serialized once, queued on every member's connection on every worker
+                    manager.broadcast_to_room({
+                        "type": "ai_token", "roomId": room.id, "requestId": request_id, "content": content
+                    }, room.id)
+            finally:
+                await response.aclose()
+        outcome = generation.reason or "ok"
+    except GenerationCancelled:
+        outcome = generation.reason
+    except asyncio.CancelledError:
+        outcome = "cancelled"
+        raise
+    except Exception as e:
+        metrics.ERRORS.inc(error_kind(e))
+        error = str(e)
+    finally:
+        content = "".join(parts)
+        truncated = outcome != "ok"
+        if content:
+            # Stored and numbered like any other message, so late joiners see it
+            rooms.post(room, ROOM_AI_USER_ID, ROOM_AI_USERNAME, content,
+                       {"requestId": request_id, "truncated": truncated})
+        # The whole answer again: a member whose queue dropped some ai_token frames repairs it
+        manager.broadcast_to_room({
+            "type": "ai_done", "roomId": room.id, "requestId": request_id, "truncated": truncated, "error": error,
+            "content": content
+        }, room.id)
+        rooms.ai_finished(room, request_id)
+        generations.finish(generation)
+        scheduler.release(ticket)
+        metrics.ACTIVE_STREAMS.dec()
+        trace.finish(outcome)
+
+def cancel_room_ai(room: Room):
+    if room.ai_request is None:
+        return
+    if not generations.cancel(room.id) and broker.shared:
+        broker.publish("generation.cancel", {"chat_id": room.id})
+
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
     user_id = None
@@ -355,6 +677,7 @@ async def websocket_endpoint(websocket: WebSocket):
         while True:
             data = await websocket.receive_text()
             message = json.loads(data)
+            received = time.monotonic()
             
             if message["type"] == "user_connect":
                 user_id = message["userId"]
@@ -366,204 +689,235 @@ async def websocket_endpoint(websocket: WebSocket):
                     username=username,
                     websocket=websocket
                 )
-                manager.active_connections[user_id] = websocket
+                manager.attach(websocket, user_id)
                 
                 # Send available rooms
-                rooms_data = []
-                for room_id, room in collaborative_rooms.items():
-                    rooms_data.append({
-                        "id": room.id,
-                        "name": room.name,
-                        "description": room.description,
-                        "private": room.private,
-                        "userCount": len(room_users.get(room_id, []))
-                    })
-                
-                await manager.send_personal_message({
+                manager.send_personal_message({
                     "type": "rooms_list",
-                    "rooms": rooms_data
+                    "rooms": rooms.summaries()
                 }, user_id)
             
             elif message["type"] == "get_rooms":
                 if user_id:
-                    rooms_data = []
-                    for room_id, room in collaborative_rooms.items():
-                        rooms_data.append({
-                            "id": room.id,
-                            "name": room.name,
-                            "description": room.description,
-                            "private": room.private,
-                            "userCount": len(room_users.get(room_id, []))
-                        })
-                    
-                    await manager.send_personal_message({
+                    manager.send_personal_message({
                         "type": "rooms_list",
-                        "rooms": rooms_data
+                        "rooms": rooms.summaries()
                     }, user_id)
             
             elif message["type"] == "create_room":
                 if user_id and user_id in connected_users:
-                    room_id = str(uuid.uuid4())
-                    room = CollaborativeRoom(
-                        id=room_id,
+                    room = rooms.create(
                         name=message["name"],
                         description=message.get("description", ""),
                         private=message.get("private", False),
-                        created_at=datetime.now(),
                         created_by=user_id
                     )
                     
-                    collaborative_rooms[room_id] = room
-                    collaborative_messages[room_id] = []
-                    room_users[room_id] = []
-                    
-                    await manager.send_personal_message({
+                    manager.send_personal_message({
                         "type": "room_created",
-                        "room": {
-                            "id": room.id,
-                            "name": room.name,
-                            "description": room.description,
-                            "private": room.private
-                        }
+                        "room": room.describe()
                     }, user_id)
             
             elif message["type"] == "join_room":
                 if user_id and user_id in connected_users:
-                    room_id = message["roomId"]
+                    room = rooms.get(message["roomId"])
                     
-                    if room_id in collaborative_rooms:
+                    if room is not None:
                         # Leave current room if any
-                        current_room = connected_users[user_id].currentRoom
-                        if current_room and current_room in room_users:
-                            if user_id in room_users[current_room]:
-                                room_users[current_room].remove(user_id)
-                                
-                                # Notify others in old room
-                                await manager.broadcast_to_room({
-                                    "type": "user_left",
-                                    "username": connected_users[user_id].username,
-                                    "users": [connected_users[uid].username for uid in room_users[current_room] if uid in connected_users]
-                                }, current_room, user_id)
+                        if connected_users[user_id].currentRoom != room.id:
+                            leave_current_room(user_id)
                         
                         # Join new room
-                        if room_id not in room_users:
-                            room_users[room_id] = []
-                        
-                        if user_id not in room_users[room_id]:
-                            room_users[room_id].append(user_id)
-                        
-                        connected_users[user_id].currentRoom = room_id
+                        user = connected_users[user_id]
+                        rooms.join(room, user_id, user.username)
+                        user.currentRoom = room.id
                         
-                        # Send room data to user
-                        room = collaborative_rooms[room_id]
-                        messages = collaborative_messages.get(room_id, [])
-                        users = [connected_users[uid].username for uid in room_users[room_id] if uid in connected_users]
-                        
-                        await manager.send_personal_message({
+                        # Send room data to user: the newest messages only, older ones via load_history
+                        messages = rooms.latest(room)
+                        manager.send_personal_message({
                             "type": "room_joined",
-                            "room": {
-                                "id": room.id,
-                                "name": room.name,
-                                "description": room.description,
-                                "private": room.private,
-                                "created_at": room.created_at.isoformat()
-                            },
-                            "messages": [
-                                {
-                                    "id": msg.id,
-                                    "userId": msg.userId,
-                                    "username": msg.username,
-                                    "content": msg.content,
-                                    "timestamp": msg.timestamp.isoformat()
-                                } for msg in messages[-50:]  # Last 50 messages
-                            ],
-                            "users": users
+                            "room": dict(room.describe(), created_at=room.info.created_at.isoformat()),
+                            "messages": messages,
+                            "has_more": bool(messages) and messages[0]["seq"] > 1,
+                            "users": room.roster
                         }, user_id)
                         
                         # Notify others in room
-                        await manager.broadcast_to_room({
+                        manager.broadcast_to_room({
                             "type": "user_joined",
-                            "username": connected_users[user_id].username,
-                            "users": users
-                        }, room_id, user_id)
+                            "username": user.username,
+                            "users": room.roster
+                        }, room.id, user_id)
             
             elif message["type"] == "leave_room":
                 if user_id and user_id in connected_users:
-                    current_room = connected_users[user_id].currentRoom
-                    if current_room and current_room in room_users:
-                        if user_id in room_users[current_room]:
-                            room_users[current_room].remove(user_id)
-                        
-                        connected_users[user_id].currentRoom = None
-                        
+                    if leave_current_room(user_id) is not None:
                         # Notify user
-                        await manager.send_personal_message({
+                        manager.send_personal_message({
                             "type": "room_left"
                         }, user_id)
-                        
-                        # Notify others in room
-                        users = [connected_users[uid].username for uid in room_users[current_room] if uid in connected_users]
-                        await manager.broadcast_to_room({
-                            "type": "user_left",
-                            "username": connected_users[user_id].username,
-                            "users": users
-                        }, current_room, user_id)
             
             elif message["type"] == "send_message":
                 if user_id and user_id in connected_users:
-                    current_room = connected_users[user_id].currentRoom
-                    if current_room:
-                        msg_id = str(uuid.uuid4())
-                        collaborative_message = CollaborativeMessage(
-                            id=msg_id,
-                            roomId=current_room,
-                            userId=user_id,
-                            username=connected_users[user_id].username,
-                            content=message["message"],
-                            timestamp=datetime.now()
-                        )
-                        
-                        if current_room not in collaborative_messages:
-                            collaborative_messages[current_room] = []
-                        
-                        collaborative_messages[current_room].append(collaborative_message)
-                        
-                        # Broadcast message to all users in room
-                        await manager.broadcast_to_room({
-                            "type": "new_message",
-                            "message": {
-                                "id": collaborative_message.id,
-                                "userId": collaborative_message.userId,
-                                "username": collaborative_message.username,
-                                "content": collaborative_message.content,
-                                "timestamp": collaborative_message.timestamp.isoformat()
-                            }
-                        }, current_room)
+                    user = connected_users[user_id]
+                    room = rooms.get(user.currentRoom) if user.currentRoom else None
+                    if room is not None:
+                        # Numbered and stored by the leader worker, then delivered
+                        # to the room on every worker (see rooms.on_message)
+                        rooms.post(room, user_id, user.username, message["message"])
+            
+            elif message["type"] == "load_history":
+                if user_id and user_id in connected_users:
+                    user = connected_users[user_id]
+                    room = rooms.get(user.currentRoom) if user.currentRoom else None
+                    if room is not None:
+                        limit = min(max(int(message.get("limit") or ROOM_JOIN_HISTORY), 1), ROOM_HISTORY_PAGE_MAX)
+                        before = message.get("before")
+                        messages, has_more = await rooms.history(room, int(before) if before else None, limit)
+                        manager.send_personal_message({
+                            "type": "history",
+                            "roomId": room.id,
+                            "messages": messages,
+                            "has_more": has_more
+                        }, user_id)
             
+            elif message["type"] == "ask_ai":
+                if user_id and user_id in connected_users:
+                    user = connected_users[user_id]
+                    room = rooms.get(user.currentRoom) if user.currentRoom else None
+                    if room is not None:
+                        ask_room_ai(room, user, (message.get("message") or "").strip())
+
+            elif message["type"] == "cancel_ai":
+                if user_id and user_id in connected_users:
+                    user = connected_users[user_id]
+                    room = rooms.get(user.currentRoom) if user.currentRoom else None
+                    if room is not None:
+                        cancel_room_ai(room)
+
             elif message["type"] == "update_username":
                 if user_id and user_id in connected_users:
-                    connected_users[user_id].username = message["username"]
+                    user = connected_users[user_id]
+                    user.username = message["username"]
+                    room = rooms.get(user.currentRoom) if user.currentRoom else None
+                    if room is not None:
+                        rooms.rename(room, user_id, user.username)
+
+            kind = message["type"] if message["type"] in WS_MESSAGE_TYPES else "other"
+            metrics.WS_HANDLE.observe(time.monotonic() - received, kind)
     
     except WebSocketDisconnect:
         if user_id:
             # Remove user from current room
             if user_id in connected_users:
-                current_room = connected_users[user_id].currentRoom
-                if current_room and current_room in room_users:
-                    if user_id in room_users[current_room]:
-                        room_users[current_room].remove(user_id)
-                    
-                    # Notify others in room
-                    users = [connected_users[uid].username for uid in room_users[current_room] if uid in connected_users]
-                    await manager.broadcast_to_room({
-                        "type": "user_left",
-                        "username": connected_users[user_id].username,
-                        "users": users
-                    }, current_room, user_id)
-                
+                leave_current_room(user_id)
                 del connected_users[user_id]
             
-            manager.disconnect(user_id)
+            manager.disconnect(user_id, websocket)
+
+# Multiplexed chat generation WebSocket (protocol in app/channel.py)
+CHAT_REQUEST_FIELDS = ("message", "chat_id", "model", "max_tokens", "temperature")
+
+def start_channel_generation(channel: ChatChannel, websocket: WebSocket, message: dict):
+    """Admit one "generate" message of a /ws/chat socket, or answer why not"""
+    request_id = message.get("id")
+    if not isinstance(request_id, str) or not request_id or len(request_id.encode("utf-8")) > MAX_ID_BYTES:
+        channel.send({"type": "error", "id": request_id, "error": f"id must be a string of 1 to {MAX_ID_BYTES} bytes"})
+        return
+    if request_id in channel.tasks:
+        channel.send({"type": "error", "id": request_id, "error": "A generation with this id is running"})
+        return
+    if len(channel.tasks) >= WS_CHAT_MAX_GENERATIONS:
+        channel.send({"type": "error", "id": request_id, "status": 429,
+                      "error": f"At most {WS_CHAT_MAX_GENERATIONS} generations per connection"})
+        return
+    try:
+        request = ChatRequest(**{field: message[field] for field in CHAT_REQUEST_FIELDS if field in message})
+    except ValidationError as e:
+        channel.send({"type": "error", "id": request_id, "status": 422, "error": str(e)})
+        return
+    try:
+        ticket = scheduler.submit(client_key(websocket), PRIORITY_INTERACTIVE)
+    except SchedulerFull as e:
+        metrics.ERRORS.inc("queue_full")
+        channel.send({"type": "error", "id": request_id, "status": e.status_code, "error": e.detail,
+                      "retry_after": e.retry_after})
+        return
+    channel.start(request_id, channel_generation(channel, request_id, request, ticket))
+
+async def channel_generation(channel: ChatChannel, request_id: str, request: ChatRequest, ticket: Ticket):
+    """One generation of a /ws/chat socket, streamed as frames tagged with its id"""
+    trace = Trace(new_request_id(), request.chat_id or "", "stream")
+    handed_off = False
+    try:
+        session = await chat_sessions.get(request.chat_id) if request.chat_id else None
+        if session is None:
+            session = chat_sessions.create()
+        chat_id = session.chat_id
+        trace.chat_id = chat_id
+
+        user_message = ChatMessage(role="user", content=request.message, timestamp=datetime.now())
+        chat_sessions.append(session, user_message)
+        channel.send({"type": "started", "id": request_id, "chat_id": chat_id, "seq": user_message.seq})
+
+        messages, prompt_tokens = await context_builder.build(chat_id, session.messages, request.max_tokens)
+        trace.prompt(len(messages), prompt_tokens)
+        llama_request = {
+            "messages": messages,
+            "max_tokens": request.max_tokens,
+            "temperature": request.temperature,
+            "stream": True
+        }
+
+        generation = generations.start(chat_id)
+        channel.generations[request_id] = generation
+        if request_id in channel.cancelled:
+            generation.cancel("cancelled")
+        # From here the event stream releases the ticket and finishes the trace
+        handed_off = True
+        ended = False
+        async with aclosing(stream_chat_events(session, llama_request, ticket, generation, trace)) as events:
+            async for event in events:
+                ended = channel.send_event(request_id, event)
+        if not ended:
+            channel.send({"type": "done", "id": request_id, "chat_id": chat_id})
+    except Exception as e:
+        metrics.ERRORS.inc(error_kind(e))
+        channel.send({"type": "error", "id": request_id, "error": str(e)})
+    finally:
+        if not handed_off:
+            scheduler.release(ticket)
+            trace.finish("error")
+
+@app.websocket("/ws/chat")
+async def chat_channel_endpoint(websocket: WebSocket):
+    """Chat generation over one WebSocket: concurrent replies tagged by id, chat list updates pushed"""
+    await websocket.accept()
+    channel = ChatChannel(websocket, websocket.query_params.get("frames") == "binary", chat_channels.discard)
+    chat_channels.add(channel)
+    try:
+        while True:
+            data = await websocket.receive_text()
+            try:
+                message = json.loads(data)
+            except ValueError:
+                message = None
+            message_type = message.get("type") if isinstance(message, dict) else None
+
+            if message_type == "generate":
+                start_channel_generation(channel, websocket, message)
+            elif message_type == "cancel":
+                if not channel.cancel(str(message.get("id"))):
+                    channel.send({"type": "error", "id": message.get("id"), "status": 404,
+                                  "error": "No generation in progress"})
+            elif message_type == "ping":
+                channel.send({"type": "pong"})
+            else:
+                channel.send({"type": "error", "error": "Unknown message"})
+    except WebSocketDisconnect:
+        pass
+    finally:
+        channel.close()
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,312 @@
+"""Prometheus metrics and per-request timing of the generation pipeline.
+
+Metrics live in process memory and ``/metrics`` renders them in the
+Prometheus text format; with several uvicorn workers each worker reports
+its own numbers. Gauges that mirror existing state (queue depth, sockets
+per room) are read from it at scrape time instead of being kept in step.
+
+A ``Trace`` follows one generation from arrival to the last token, feeds
+the histograms and, with METRICS_TRACE_LOG, logs its timings as one JSON
+line tagged with the request id that is also sent to llama-server.
+"""
+import json
+import logging
+import time
+import uuid
+from bisect import bisect_left
+from typing import AsyncIterator, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import httpx
+
+from app.conf import *
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+TOKEN_GAP_BUCKETS = (0.005, 0.01, 0.02, 0.03, 0.05, 0.075, 0.1, 0.15, 0.25, 0.5, 1.0, 2.5)
+RATE_BUCKETS = (1, 2, 5, 10, 15, 20, 30, 50, 75, 100, 150, 250)
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+TOKEN_BUCKETS = (64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384, 32768)
+
+Labels = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Metric:
+    """One metric family; label values are passed positionally"""
+
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        registry.append(self)
+
+    def _series(self, name: str, labels: Labels, value: float, extra: str = "") -> str:
+        pairs = [f'{k}="{_escape(v)}"' for k, v in zip(self.labels, labels)]
+        if extra:
+            pairs.append(extra)
+        selector = "{" + ",".join(pairs) + "}" if pairs else ""
+        return f"{name}{selector} {_number(value)}"
+
+    def samples(self) -> Iterable[str]:
+        return ()
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        super().__init__(name, help, labels)
+        self.values: Dict[Labels, float] = {}
+
+    def inc(self, *labels: str, amount: float = 1.0):
+        self.values[labels] = self.values.get(labels, 0.0) + amount
+
+    def samples(self) -> Iterable[str]:
+        values = self.values if self.values or self.labels else {(): 0.0}
+        for labels, value in values.items():
+            yield self._series(self.name, labels, value)
+
+
+class Gauge(Metric):
+    """A value set by the code, or read from ``collect`` at scrape time"""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (),
+                 collect: Optional[Callable[[], Dict[Labels, float]]] = None):
+        super().__init__(name, help, labels)
+        self.values: Dict[Labels, float] = {}
+        self.collect = collect
+
+    def set(self, value: float, *labels: str):
+        self.values[labels] = value
+
+    def inc(self, *labels: str, amount: float = 1.0):
+        self.values[labels] = self.values.get(labels, 0.0) + amount
+
+    def dec(self, *labels: str, amount: float = 1.0):
+        self.inc(*labels, amount=-amount)
+
+    def samples(self) -> Iterable[str]:
+        values = self.values
+        if self.collect is not None:
+            try:
+                values = self.collect()
+            except Exception:
+                logger.exception("Collecting %s failed", self.name)
+                values = {}
+        elif not values and not self.labels:
+            values = {(): 0.0}
+        for labels, value in values.items():
+            yield self._series(self.name, labels, value)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, buckets: Sequence[float], labels: Sequence[str] = ()):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+        self.values: Dict[Labels, List[float]] = {}  # per-bucket counts, then count and sum
+
+    def observe(self, value: float, *labels: str):
+        state = self.values.get(labels)
+        if state is None:
+            state = self.values[labels] = [0.0] * (len(self.buckets) + 2)
+        index = bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            state[index] += 1
+        state[-2] += 1
+        state[-1] += value
+
+    def samples(self) -> Iterable[str]:
+        for labels, state in self.values.items():
+            cumulative = 0.0
+            for bound, count in zip(self.buckets, state):
+                cumulative += count
+                yield self._series(self.name + "_bucket", labels, cumulative, f'le="{_number(bound)}"')
+            yield self._series(self.name + "_bucket", labels, state[-2], 'le="+Inf"')
+            yield self._series(self.name + "_count", labels, state[-2])
+            yield self._series(self.name + "_sum", labels, state[-1])
+
+
+registry: List[Metric] = []
+
+
+def render() -> str:
+    """Every metric in the Prometheus text exposition format"""
+    return "\n".join(metric.render() for metric in registry) + "\n"
+
+
+# Generation pipeline
+
+TTFT = Histogram("jennychat_ttft_seconds",
+                 "Time from sending the completion request to llama-server to the first token", LATENCY_BUCKETS)
+INTER_TOKEN = Histogram("jennychat_inter_token_seconds",
+                        "Time between consecutive tokens of a streamed completion", TOKEN_GAP_BUCKETS)
+TOKENS_PER_SECOND = Histogram("jennychat_tokens_per_second",
+                              "Generation speed of each completion after its first token", RATE_BUCKETS)
+QUEUE_TIME = Histogram("jennychat_queue_seconds",
+                       "Time a generation waited in the scheduler for a slot", LATENCY_BUCKETS)
+CONNECT_TIME = Histogram("jennychat_upstream_connect_seconds",
+                         "Time until llama-server answered with response headers", LATENCY_BUCKETS)
+GENERATION_TIME = Histogram("jennychat_generation_seconds",
+                            "Time from arrival to the end of a generation", LATENCY_BUCKETS, ("mode",))
+PROMPT_MESSAGES = Histogram("jennychat_prompt_messages", "Messages sent to llama-server per prompt", SIZE_BUCKETS)
+PROMPT_TOKENS = Histogram("jennychat_prompt_tokens", "Estimated tokens per prompt", TOKEN_BUCKETS)
+GENERATIONS = Counter("jennychat_generations_total", "Finished generations by outcome", ("mode", "outcome"))
+ACTIVE_STREAMS = Gauge("jennychat_active_streams", "Streamed completions currently open")
+ERRORS = Counter("jennychat_errors_total", "Errors by kind", ("kind",))
+SCHEDULER_RUNNING = Gauge("jennychat_scheduler_running", "Generations holding a slot")
+SCHEDULER_QUEUED = Gauge("jennychat_scheduler_queued", "Generations waiting for a slot")
+
+# Chat sessions
+
+SESSIONS_LOADED = Gauge("jennychat_sessions_loaded", "Chats whose messages are in memory")
+SESSION_MEMORY = Gauge("jennychat_session_memory_bytes", "Estimated memory used by loaded chats")
+SESSION_EVICTIONS = Counter("jennychat_session_evictions_total", "Idle chats dropped from memory")
+
+# Search
+
+SEARCH_TIME = Histogram("jennychat_search_seconds", "Time to answer /api/search", LATENCY_BUCKETS, ("mode",))
+SEARCH_INDEXED = Gauge("jennychat_search_indexed", "Messages in each search index", ("index",))
+
+# WebSockets
+
+WS_CONNECTIONS = Gauge("jennychat_ws_connections", "WebSockets connected to this worker")
+WS_ROOM_CONNECTIONS = Gauge("jennychat_ws_room_connections",
+                            "WebSockets connected to this worker, by room", ("room",))
+WS_FANOUT = Histogram("jennychat_ws_fanout_seconds",
+                      "Time from queuing a WebSocket message to the end of its send", LATENCY_BUCKETS)
+WS_HANDLE = Histogram("jennychat_ws_handle_seconds",
+                      "Time the /ws loop spent handling one client message", LATENCY_BUCKETS, ("type",))
+WS_DROPPED = Counter("jennychat_ws_dropped_total", "WebSocket messages dropped for slow clients")
+WS_CHAT_CONNECTIONS = Gauge("jennychat_ws_chat_connections", "/ws/chat sockets connected to this worker")
+WS_CHAT_GENERATIONS = Gauge("jennychat_ws_chat_generations", "Generations running on /ws/chat sockets of this worker")
+
+
+def new_request_id() -> str:
+    return uuid.uuid4().hex
+
+
+def error_kind(error: Exception) -> str:
+    """Label for ERRORS of an unexpected exception"""
+    if isinstance(error, httpx.TimeoutException):
+        return "upstream_timeout"
+    if isinstance(error, httpx.RequestError):
+        return "upstream_connect"
+    return "internal"
+
+
+class Trace:
+    """Timings of one generation, from arrival to its last token"""
+
+    __slots__ = ("request_id", "chat_id", "mode", "started", "queue", "connect", "ttft",
+                 "prompt_messages", "prompt_tokens", "tokens", "_sent", "_first", "_last")
+
+    def __init__(self, request_id: str, chat_id: str, mode: str):
+        self.request_id = request_id
+        self.chat_id = chat_id
+        self.mode = mode  # "stream" or "batch"
+        self.started = time.monotonic()
+        self.queue: Optional[float] = None
+        self.connect: Optional[float] = None
+        self.ttft: Optional[float] = None
+        self.prompt_messages = 0
+        self.prompt_tokens = 0
+        self.tokens = 0
+        self._sent = 0.0
+        self._first = 0.0
+        self._last = 0.0
+
+    def prompt(self, messages: int, tokens: int):
+        self.prompt_messages = messages
+        self.prompt_tokens = tokens
+        PROMPT_MESSAGES.observe(messages)
+        PROMPT_TOKENS.observe(tokens)
+
+    def admitted(self):
+        """The scheduler granted a slot"""
+        self.queue = time.monotonic() - self.started
+        QUEUE_TIME.observe(self.queue)
+
+    def sent(self):
+        """The completion request is about to go to llama-server"""
+        self._sent = time.monotonic()
+
+    def headers(self):
+        """llama-server answered with its response headers"""
+        self.connect = time.monotonic() - self._sent
+        CONNECT_TIME.observe(self.connect)
+
+    def token(self):
+        now = time.monotonic()
+        if self.tokens == 0:
+            self._first = now
+            self.ttft = now - self._sent
+            TTFT.observe(self.ttft)
+        else:
+            INTER_TOKEN.observe(now - self._last)
+        self._last = now
+        self.tokens += 1
+
+    def completed(self, tokens: int):
+        """A non-streamed completion arrived with ``tokens`` generated tokens"""
+        self._first = self._sent
+        self._last = time.monotonic()
+        self.tokens = tokens
+
+    def finish(self, outcome: str):
+        duration = time.monotonic() - self.started
+        GENERATION_TIME.observe(duration, self.mode)
+        GENERATIONS.inc(self.mode, outcome)
+        # Streamed: the gaps after the first token; batch: everything after sending
+        intervals = self.tokens - 1 if self.mode == "stream" else self.tokens
+        rate = None
+        if intervals > 0 and self._last > self._first:
+            rate = intervals / (self._last - self._first)
+            TOKENS_PER_SECOND.observe(rate)
+        if METRICS_TRACE_LOG:
+            logger.info(json.dumps({
+                "event": "generation",
+                "request_id": self.request_id,
+                "chat_id": self.chat_id,
+                "mode": self.mode,
+                "outcome": outcome,
+                "queue_s": _round(self.queue),
+                "connect_s": _round(self.connect),
+                "ttft_s": _round(self.ttft),
+                "duration_s": _round(duration),
+                "prompt_messages": self.prompt_messages,
+                "prompt_tokens": self.prompt_tokens,
+                "tokens": self.tokens,
+                "tokens_per_s": _round(rate),
+            }))
+
+
+def _round(value: Optional[float]) -> Optional[float]:
+    return None if value is None else round(value, 4)
+
+
+async def timed_tokens(tokens: AsyncIterator[str], trace: Trace) -> AsyncIterator[str]:
+    """Pass tokens through, recording when each one arrived"""
+    async for token in tokens:
+        trace.token()
+        yield token
@@ -0,0 +1,50 @@
+from fastapi import WebSocket
+from pydantic import BaseModel
+from typing import Optional
+from datetime import datetime
+
+
+class ChatMessage(BaseModel):
+    role: str  # "user", "assistant", "system"
+    content: str
+    timestamp: datetime = None
+    truncated: bool = False  # generation was stopped before it finished
+    seq: int = 0  # 1-based position in the chat, stable once assigned
+
+class ChatRequest(BaseModel):
+    message: str
+    chat_id: Optional[str] = None
+    model: Optional[str] = "default"
+    stream: bool = True
+    max_tokens: Optional[int] = 2048
+    temperature: Optional[float] = 0.7
+
+class ChatResponse(BaseModel):
+    chat_id: str
+    message: ChatMessage
+    model: str
+
+# Collaborative chat models
+class CollaborativeMessage(BaseModel):
+    id: str
+    roomId: str
+    userId: str
+    username: str
+    content: str
+    timestamp: datetime
+
+class CollaborativeRoom(BaseModel):
+    id: str
+    name: str
+    description: Optional[str] = ""
+    private: bool = False
+    created_at: datetime
+
+    created_by: str
+
+class ConnectedUser(BaseModel):
+    userId: str
+    username: str
+    websocket: WebSocket
+    currentRoom: Optional[str] = None
+    model_config = {"arbitrary_types_allowed": True}
@@ -0,0 +1,256 @@
+"""Event bus shared by every worker process.
+
+Rooms, presence and session metadata are kept in each worker's memory and
+changed through events published here, so they stay in sync when uvicorn
+runs several workers. ``LocalBroker`` is the single-process case.
+``UnixSocketBroker`` connects the workers on one host: the one holding the
+lock file serves a Unix socket and relays every event to the others, and if
+it goes away the survivors elect a new relay.
+
+Handlers are called as ``handler(payload, origin)`` where ``origin`` is the
+publishing worker's id; events are also delivered to the publisher itself,
+synchronously, before ``publish`` returns.
+"""
+import asyncio
+import json
+import logging
+import os
+import uuid
+from typing import Awaitable, Callable, Dict, List, Optional, Union
+
+from app.conf import *
+
+logger = logging.getLogger(__name__)
+
+Handler = Callable[[dict, str], Union[None, Awaitable[None]]]
+
+CONNECTED = "broker.connected"  # local only: (re)joined the bus
+WORKER_GONE = "worker.gone"  # {"worker": id}: its connections and presence are gone
+
+
+class Broker:
+    """Publish/subscribe between worker processes"""
+
+    shared = False  # True when other processes may hold part of the state
+
+    def __init__(self):
+        self.worker_id = uuid.uuid4().hex[:12]
+        self._handlers: Dict[str, List[Handler]] = {}
+
+    @property
+    def is_leader(self) -> bool:
+        """Whether this worker does the work that must happen exactly once"""
+        return True
+
+    def is_local(self, origin: str) -> bool:
+        return origin == self.worker_id
+
+    def subscribe(self, channel: str, handler: Handler):
+        self._handlers.setdefault(channel, []).append(handler)
+
+    async def start(self):
+        self._dispatch(CONNECTED, {}, self.worker_id)
+
+    async def close(self):
+        pass
+
+    def publish(self, channel: str, payload: dict):
+        """Deliver an event to every worker; never waits"""
+        self._dispatch(channel, payload, self.worker_id)
+
+    def _dispatch(self, channel: str, payload: dict, origin: str):
+        for handler in self._handlers.get(channel, ()):
+            try:
+                result = handler(payload, origin)
+                if asyncio.iscoroutine(result):
+                    asyncio.ensure_future(result).add_done_callback(self._log_failure)
+            except Exception:
+                logger.exception("Event handler for %s failed", channel)
+
+    @staticmethod
+    def _log_failure(task: asyncio.Future):
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Event handler failed", exc_info=task.exception())
+
+
+class LocalBroker(Broker):
+    """Everything in one process"""
+
+
+class UnixSocketBroker(Broker):
+    """Workers on one host, relayed by whichever of them holds the lock file"""
+
+    shared = True
+    _HELLO = "broker.hello"
+
+    def __init__(self, path: str = PUBSUB_SOCKET):
+        super().__init__()
+        self.path = path
+        self._lock_fd: Optional[int] = None
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._peers: Dict[asyncio.StreamWriter, str] = {}  # relay side: worker of each peer
+        self._relay: Optional[asyncio.StreamWriter] = None  # peer side: connection to the relay
+        self._relay_worker: Optional[str] = None
+        self._connected = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._closing = False
+
+    @property
+    def is_leader(self) -> bool:
+        return self._server is not None
+
+    async def start(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self._closing = False
+        self._connected = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+        await asyncio.wait_for(self._connected.wait(), PUBSUB_CONNECT_TIMEOUT)
+
+    async def close(self):
+        self._closing = True
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._relay is not None:
+            self._relay.close()
+            self._relay = None
+        if self._server is not None:
+            self._server.close()
+            for peer in list(self._peers):
+                peer.close()
+            self._peers.clear()
+            self._server = None
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)  # releases the lock
+            self._lock_fd = None
+
+    def publish(self, channel: str, payload: dict):
+        self._dispatch(channel, payload, self.worker_id)
+        line = self._encode(channel, payload)
+        if self._server is not None:
+            self._forward(line)
+        elif self._relay is not None:
+            self._relay.write(line)
+        else:
+            logger.warning("Not connected to the event relay, %s event only delivered locally", channel)
+
+    def _encode(self, channel: str, payload: dict) -> bytes:
+        return (json.dumps({"c": channel, "p": payload, "w": self.worker_id}) + "\n").encode("utf-8")
+
+    # Election
+
+    async def _run(self):
+        while not self._closing:
+            if self._take_lock():
+                await self._serve()
+                return
+            try:
+                reader, writer = await asyncio.open_unix_connection(self.path, limit=PUBSUB_MAX_MESSAGE)
+            except OSError:
+                # The relay is starting or just died; the lock decides who replaces it
+                await asyncio.sleep(PUBSUB_RETRY_INTERVAL)
+                continue
+            await self._follow(reader, writer)
+
+    def _take_lock(self) -> bool:
+        import fcntl  # Unix only, like the socket itself
+
+        fd = os.open(self.path + ".lock", os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        self._lock_fd = fd
+        return True
+
+    # Relay side
+
+    async def _serve(self):
+        try:
+            os.unlink(self.path)  # left behind by a relay that crashed
+        except FileNotFoundError:
+            pass
+        self._server = await asyncio.start_unix_server(self._serve_peer, path=self.path, limit=PUBSUB_MAX_MESSAGE)
+        logger.info("Worker %s is relaying events on %s", self.worker_id, self.path)
+        self._connected.set()
+        self._dispatch(CONNECTED, {}, self.worker_id)
+
+    async def _serve_peer(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        worker = None
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                envelope = json.loads(line)
+                if envelope["c"] == self._HELLO:
+                    worker = envelope["w"]
+                    self._peers[writer] = worker
+                    writer.write(self._encode(self._HELLO, {}))
+                    continue
+                self._forward(line, exclude=writer)
+                self._dispatch(envelope["c"], envelope["p"], envelope["w"])
+        except (OSError, ValueError, KeyError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            logger.warning("Dropping event peer %s after a bad read", worker, exc_info=True)
+        finally:
+            self._peers.pop(writer, None)
+            writer.close()
+            if worker is not None and not self._closing:
+                self.publish(WORKER_GONE, {"worker": worker})
+
+    def _forward(self, line: bytes, exclude: Optional[asyncio.StreamWriter] = None):
+        for peer in list(self._peers):
+            if peer is exclude:
+                continue
+            if peer.transport.get_write_buffer_size() > PUBSUB_MAX_BUFFER:
+                # A stuck worker must not make the relay buffer without bound
+                logger.warning("Event peer %s is not reading, disconnecting it", self._peers[peer])
+                peer.close()
+                self._peers.pop(peer, None)
+                continue
+            peer.write(line)
+
+    # Peer side
+
+    async def _follow(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        writer.write(self._encode(self._HELLO, {}))
+        self._relay = writer
+        self._connected.set()
+        self._dispatch(CONNECTED, {}, self.worker_id)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                envelope = json.loads(line)
+                if envelope["c"] == self._HELLO:
+                    self._relay_worker = envelope["w"]
+                    continue
+                self._dispatch(envelope["c"], envelope["p"], envelope["w"])
+        except (OSError, ValueError, KeyError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            logger.warning("Lost the event relay after a bad read", exc_info=True)
+        finally:
+            self._relay = None
+            writer.close()
+        if self._relay_worker is not None and not self._closing:
+            # The relay worker is gone with its sockets
+            self._dispatch(WORKER_GONE, {"worker": self._relay_worker}, self._relay_worker)
+            self._relay_worker = None
+
+
+def create_broker() -> Broker:
+    """Build the broker selected by PUBSUB_BACKEND"""
+    if PUBSUB_BACKEND == "local":
+        return LocalBroker()
+    if PUBSUB_BACKEND == "unix":
+        return UnixSocketBroker(PUBSUB_SOCKET)
+    raise ValueError(f"Unknown PUBSUB_BACKEND: {PUBSUB_BACKEND!r}")
@@ -0,0 +1,309 @@
+"""Collaborative rooms: membership, recent history and the durable backlog.
+
+Each room keeps its members in an insertion-ordered dict and caches the
+roster sent to clients, so joins and leaves are O(1). Only the newest
+ROOM_HISTORY_SIZE messages stay in memory; every message is also written to
+a SessionStore (one catalog record per room, one line per message), and
+older pages are read back from it on demand.
+
+Every change goes through the event broker, so each worker process holds
+the same rooms, rosters and recent messages. Messages are numbered and
+stored by the leader worker alone, which keeps sequence numbers unique.
+"""
+import uuid
+from collections import deque
+from datetime import datetime
+from typing import Callable, Deque, Dict, Iterator, List, Optional, Tuple
+
+from app.conf import *
+from app.models import CollaborativeRoom
+from app.pubsub import CONNECTED, WORKER_GONE, Broker
+from app.storage import SessionStore
+
+
+class Room:
+    """Members and recent messages of one room"""
+
+    def __init__(self, info: CollaborativeRoom, last_seq: int = 0):
+        self.info = info
+        self.members: Dict[str, str] = {}  # user_id -> username, in join order
+        self.workers: Dict[str, str] = {}  # user_id -> worker holding the user's socket
+        self.recent: Deque[dict] = deque(maxlen=ROOM_HISTORY_SIZE)
+        self.last_seq = last_seq
+        self.ai_request: Optional[str] = None  # request id of the AI answer being generated
+        self.ai_worker: Optional[str] = None
+        self._roster: Optional[List[str]] = None
+
+    @property
+    def id(self) -> str:
+        return self.info.id
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.members)
+
+    def __len__(self) -> int:
+        return len(self.members)
+
+    def __contains__(self, user_id: str) -> bool:
+        return user_id in self.members
+
+    @property
+    def roster(self) -> List[str]:
+        """Usernames of the members, rebuilt only after a change"""
+        if self._roster is None:
+            self._roster = list(self.members.values())
+        return self._roster
+
+    def join(self, user_id: str, username: str, worker: str = ""):
+        self.members[user_id] = username
+        self.workers[user_id] = worker
+        self._roster = None
+
+    def leave(self, user_id: str) -> bool:
+        if self.members.pop(user_id, None) is None:
+            return False
+        self.workers.pop(user_id, None)
+        self._roster = None
+        return True
+
+    def rename(self, user_id: str, username: str):
+        if user_id in self.members:
+            self.members[user_id] = username
+            self._roster = None
+
+    def describe(self) -> dict:
+        return {
+            "id": self.info.id,
+            "name": self.info.name,
+            "description": self.info.description,
+            "private": self.info.private,
+        }
+
+    def summary(self) -> dict:
+        return dict(self.describe(), userCount=len(self.members))
+
+
+class RoomRegistry:
+    """Every room, with history persisted through a SessionStore"""
+
+    def __init__(self, store: SessionStore, broker: Broker):
+        self.store = store
+        self.broker = broker
+        self.rooms: Dict[str, Room] = {}
+        # Called on every worker for its own sockets
+        self.on_message: Optional[Callable[[Room, dict], None]] = None
+        self.on_roster: Optional[Callable[[Room], None]] = None
+        self.on_ai_lost: Optional[Callable[[Room, str], None]] = None
+        broker.subscribe("room.created", self._on_created)
+        broker.subscribe("room.post", self._on_post)
+        broker.subscribe("room.message", self._on_message)
+        broker.subscribe("room.presence", self._on_presence)
+        broker.subscribe("room.ai", self._on_ai)
+        broker.subscribe("room.sync", self._on_sync)
+        broker.subscribe(WORKER_GONE, self._on_worker_gone)
+        broker.subscribe(CONNECTED, lambda payload, origin: broker.publish("room.sync", {}))
+
+    async def start(self):
+        await self.store.start()
+        self.rooms = {}
+        for meta in self.store.catalog().values():
+            room = Room(self._parse_meta(meta), meta.get("message_count", 0))
+            room_id = room.id
+            start = max(room.last_seq - ROOM_HISTORY_SIZE, 0)
+            room.recent.extend(await self.store.load_range(room_id, start, room.last_seq))
+            self.rooms[room_id] = room
+
+    async def close(self):
+        await self.store.close()
+
+    def get(self, room_id: str) -> Optional[Room]:
+        return self.rooms.get(room_id)
+
+    def __contains__(self, room_id: str) -> bool:
+        return room_id in self.rooms
+
+    def summaries(self) -> List[dict]:
+        return [room.summary() for room in self.rooms.values()]
+
+    def create(self, name: str, description: str, private: bool, created_by: str) -> Room:
+        room_id = str(uuid.uuid4())
+        self.broker.publish("room.created", {
+            "chat_id": room_id,  # the store's key field
+            "name": name,
+            "description": description,
+            "private": private,
+            "created_at": datetime.now().isoformat(),
+            "created_by": created_by,
+            "message_count": 0,
+        })
+        return self.rooms[room_id]
+
+    def post(self, room: Room, user_id: str, username: str, content: str, extra: Optional[dict] = None):
+        """Send a message to a room; every worker gets it through ``on_message``.
+
+        ``extra`` fields are stored with the message (e.g. the AI request id).
+        """
+        self.broker.publish("room.post", {
+            "room_id": room.id,
+            "userId": user_id,
+            "username": username,
+            "content": content,
+            "timestamp": datetime.now().isoformat(),
+            "extra": extra or {},
+        })
+
+    def join(self, room: Room, user_id: str, username: str):
+        self._presence(room, user_id, username, "join")
+
+    def leave(self, room: Room, user_id: str) -> bool:
+        if user_id not in room:
+            return False
+        self._presence(room, user_id, None, "leave")
+        return True
+
+    def rename(self, room: Room, user_id: str, username: str):
+        if user_id in room:
+            self._presence(room, user_id, username, "join")
+
+    def ai_started(self, room: Room, request_id: str) -> bool:
+        """Mark the room as getting an AI answer; False if one is already running"""
+        if room.ai_request is not None:
+            return False
+        self.broker.publish("room.ai", {"room_id": room.id, "request_id": request_id})
+        return True
+
+    def ai_finished(self, room: Room, request_id: str):
+        if room.ai_request == request_id:
+            self.broker.publish("room.ai", {"room_id": room.id, "request_id": None})
+
+    def _presence(self, room: Room, user_id: str, username: Optional[str], action: str):
+        self.broker.publish("room.presence", {
+            "room_id": room.id, "user_id": user_id, "username": username, "action": action
+        })
+
+    def latest(self, room: Room, limit: int = ROOM_JOIN_HISTORY) -> List[dict]:
+        recent = room.recent
+        return list(recent)[-limit:] if limit < len(recent) else list(recent)
+
+    async def history(self, room: Room, before: Optional[int], limit: int) -> Tuple[List[dict], bool]:
+        """Up to ``limit`` messages older than seq ``before``; returns (messages, older ones exist)"""
+        end = room.last_seq + 1 if before is None else min(before, room.last_seq + 1)
+        start = max(end - limit, 1)
+        if end <= start:
+            return [], False
+
+        oldest_recent = room.recent[0]["seq"] if room.recent else end
+        if start >= oldest_recent:
+            messages = [room.recent[seq - oldest_recent] for seq in range(start, end)]
+        else:
+            messages = await self.store.load_range(room.id, start - 1, end - 1)
+            if not messages:
+                # Nothing durable (memory store): only what is still in memory
+                messages = [m for m in room.recent if start <= m["seq"] < end]
+        return messages, bool(messages) and messages[0]["seq"] > 1
+
+    # Events
+
+    def _on_created(self, meta: dict, origin: str):
+        if meta["chat_id"] in self.rooms:
+            return
+        room = Room(self._parse_meta(meta), meta.get("message_count", 0))
+        self.rooms[room.id] = room
+        if self.broker.is_leader:
+            self._save_meta(room)
+        else:
+            self.store.observe_meta(meta)
+
+    def _on_post(self, payload: dict, origin: str):
+        if not self.broker.is_leader:
+            return
+        room = self.rooms.get(payload["room_id"])
+        if room is None:
+            return
+        message = {
+            "id": str(uuid.uuid4()),
+            "seq": room.last_seq + 1,
+            "userId": payload["userId"],
+            "username": payload["username"],
+            "content": payload["content"],
+            "timestamp": payload["timestamp"],
+        }
+        message.update(payload.get("extra") or {})
+        self.store.append_message(room.id, message)
+        self.broker.publish("room.message", {"room_id": room.id, "message": message})
+        self._save_meta(room)
+
+    def _on_message(self, payload: dict, origin: str):
+        room = self.rooms.get(payload["room_id"])
+        if room is None:
+            return
+        message = payload["message"]
+        room.last_seq = max(room.last_seq, message["seq"])
+        room.recent.append(message)
+        if self.on_message is not None:
+            self.on_message(room, message)
+
+    def _on_presence(self, payload: dict, origin: str):
+        room = self.rooms.get(payload["room_id"])
+        if room is None:
+            return
+        if payload["action"] == "join":
+            room.join(payload["user_id"], payload["username"], origin)
+        else:
+            room.leave(payload["user_id"])
+
+    def _on_ai(self, payload: dict, origin: str):
+        room = self.rooms.get(payload["room_id"])
+        if room is not None:
+            room.ai_request = payload["request_id"]
+            room.ai_worker = origin if payload["request_id"] else None
+
+    def _on_sync(self, payload: dict, origin: str):
+        """A worker (re)joined: tell it about our rooms and users"""
+        for room in list(self.rooms.values()):
+            if self.broker.is_leader:
+                self.broker.publish("room.created", self._meta(room))
+            for user_id, worker in list(room.workers.items()):
+                if self.broker.is_local(worker):
+                    self._presence(room, user_id, room.members[user_id], "join")
+            if room.ai_request is not None and self.broker.is_local(room.ai_worker):
+                self.broker.publish("room.ai", {"room_id": room.id, "request_id": room.ai_request})
+
+    def _on_worker_gone(self, payload: dict, origin: str):
+        for room in self.rooms.values():
+            gone = [user_id for user_id, worker in room.workers.items() if worker == payload["worker"]]
+            for user_id in gone:
+                room.leave(user_id)
+            if gone and self.on_roster is not None:
+                self.on_roster(room)
+            if room.ai_request is not None and room.ai_worker == payload["worker"]:
+                # The answer died with the worker generating it
+                request_id, room.ai_request, room.ai_worker = room.ai_request, None, None
+                if self.on_ai_lost is not None:
+                    self.on_ai_lost(room, request_id)
+
+    @staticmethod
+    def _parse_meta(meta: dict) -> CollaborativeRoom:
+        return CollaborativeRoom(
+            id=meta["chat_id"],
+            name=meta["name"],
+            description=meta.get("description", ""),
+            private=meta.get("private", False),
+            created_at=datetime.fromisoformat(meta["created_at"]),
+            created_by=meta.get("created_by", ""),
+        )
+
+    @staticmethod
+    def _meta(room: Room) -> dict:
+        return {
+            "chat_id": room.id,  # the store's key field
+            "name": room.info.name,
+            "description": room.info.description,
+            "private": room.info.private,
+            "created_at": room.info.created_at.isoformat(),
+            "created_by": room.info.created_by,
+            "message_count": room.last_seq,
+        }
+
+    def _save_meta(self, room: Room):
+        self.store.save_meta(self._meta(room))
@@ -0,0 +1,223 @@
+"""Admission control and fair queuing for generation requests"""
+import asyncio
+import itertools
+import math
+import time
+from collections import OrderedDict, deque
+from typing import Deque, Dict, List
+
+from app.conf import *
+
+PRIORITY_INTERACTIVE = 0  # streaming chat turns
+PRIORITY_BATCH = 1  # non-streaming / scripted requests
+
+
+class SchedulerFull(Exception):
+    """The request was refused; ``status_code`` is 429 or 503"""
+
+    def __init__(self, status_code: int, detail: str, retry_after: int):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+        self.retry_after = retry_after
+
+
+class Ticket:
+    """A request waiting for, or holding, a generation slot"""
+
+    __slots__ = ("user", "priority", "seq", "state", "granted_at", "changed")
+
+    def __init__(self, user: str, priority: int, seq: int):
+        self.user = user
+        self.priority = priority
+        self.seq = seq
+        self.state = "queued"  # queued -> running -> done
+        self.granted_at = 0.0
+        self.changed = asyncio.Event()
+
+    @property
+    def granted(self) -> bool:
+        return self.state == "running"
+
+
+class _PriorityQueue:
+    """Per-user FIFO queues served round-robin"""
+
+    def __init__(self):
+        self.users: Dict[str, Deque[Ticket]] = {}
+        self.rotation: "OrderedDict[str, None]" = OrderedDict()
+        self.size = 0
+
+    def push(self, ticket: Ticket):
+        queue = self.users.get(ticket.user)
+        if queue is None:
+            queue = self.users[ticket.user] = deque()
+            self.rotation[ticket.user] = None
+        queue.append(ticket)
+        self.size += 1
+
+    def pop(self) -> Ticket:
+        user = next(iter(self.rotation))
+        queue = self.users[user]
+        ticket = queue.popleft()
+        del self.rotation[user]
+        if queue:
+            self.rotation[user] = None  # back of the line
+        else:
+            del self.users[user]
+        self.size -= 1
+        return ticket
+
+    def remove(self, ticket: Ticket) -> bool:
+        queue = self.users.get(ticket.user)
+        if queue is None or ticket not in queue:
+            return False
+        queue.remove(ticket)
+        if not queue:
+            del self.users[ticket.user]
+            del self.rotation[ticket.user]
+        self.size -= 1
+        return True
+
+    def ahead_of(self, ticket: Ticket) -> int:
+        """Tickets served before this one under round-robin (if nobody else arrives)"""
+        own = self.users.get(ticket.user)
+        if own is None:
+            return 0
+        index = own.index(ticket)
+        ahead = index
+        before = True
+        for user in self.rotation:
+            if user == ticket.user:
+                before = False
+                continue
+            ahead += min(len(self.users[user]), index + 1 if before else index)
+        return ahead
+
+
+class GenerationScheduler:
+    """Limits concurrent generations and queues the rest fairly.
+
+    At most ``concurrency`` requests run at once, matched to the number of
+    llama-server slots. Waiting requests are served by priority (interactive
+    before batch) and, within a priority, round-robin across users so one
+    heavy caller cannot starve the others. When the queue is full, callers
+    are refused immediately with a Retry-After estimate instead of piling up
+    until the upstream timeout.
+    """
+
+    def __init__(self, concurrency: int = 1, max_queue: int = SCHEDULER_MAX_QUEUE,
+                 max_queue_per_user: int = SCHEDULER_MAX_QUEUE_PER_USER):
+        self.concurrency = max(1, concurrency)
+        self.max_queue = max_queue
+        self.max_queue_per_user = max_queue_per_user
+        self.running = 0
+        self._queues: List[_PriorityQueue] = [_PriorityQueue(), _PriorityQueue()]
+        self._seq = itertools.count()
+        self._service_time = 10.0  # EWMA of seconds a generation holds its slot
+
+    def configure(self, concurrency: int):
+        """Change the number of concurrent generations (e.g. once slots are known)"""
+        self.concurrency = max(1, concurrency)
+        self._dispatch()
+
+    @property
+    def queued(self) -> int:
+        return sum(q.size for q in self._queues)
+
+    def retry_after(self) -> int:
+        """Rough seconds until a new request would be admitted"""
+        return max(1, math.ceil((self.queued + 1) * self._service_time / self.concurrency))
+
+    def submit(self, user: str, priority: int = PRIORITY_INTERACTIVE) -> Ticket:
+        """Admit a request or raise SchedulerFull"""
+        priority = min(max(priority, 0), len(self._queues) - 1)
+        queue = self._queues[priority]
+        ticket = Ticket(user, priority, next(self._seq))
+
+        if self.running < self.concurrency and self.queued == 0:
+            self._grant(ticket)
+            return ticket
+
+        waiting = queue.users.get(user)
+        if waiting is not None and len(waiting) >= self.max_queue_per_user:
+            raise SchedulerFull(429, "Too many queued requests for this user", self.retry_after())
+        if self.queued >= self.max_queue:
+            raise SchedulerFull(503, "Server busy, generation queue is full", self.retry_after())
+
+        queue.push(ticket)
+        return ticket
+
+    def position(self, ticket: Ticket) -> int:
+        """1-based queue position, 0 once the ticket is running"""
+        if ticket.state != "queued":
+            return 0
+        ahead = sum(q.size for q in self._queues[:ticket.priority])
+        return ahead + self._queues[ticket.priority].ahead_of(ticket) + 1
+
+    async def wait(self, ticket: Ticket, timeout: float = SCHEDULER_QUEUE_TIMEOUT) -> bool:
+        """Wait until the ticket runs; False on timeout (the ticket is dropped)"""
+        deadline = time.monotonic() + timeout
+        while ticket.state == "queued":
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                self.release(ticket)
+                return False
+            ticket.changed.clear()
+            try:
+                await asyncio.wait_for(ticket.changed.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+        return ticket.granted
+
+    async def positions(self, ticket: Ticket, timeout: float = SCHEDULER_QUEUE_TIMEOUT):
+        """Yield the queue position whenever it changes, until the ticket runs"""
+        deadline = time.monotonic() + timeout
+        last = None
+        while ticket.state == "queued":
+            position = self.position(ticket)
+            if position != last:
+                last = position
+                yield position
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                self.release(ticket)
+                return
+            ticket.changed.clear()
+            try:
+                await asyncio.wait_for(ticket.changed.wait(), min(remaining, SCHEDULER_POSITION_INTERVAL))
+            except asyncio.TimeoutError:
+                pass
+
+    def release(self, ticket: Ticket):
+        """Give back a slot or leave the queue; safe to call more than once"""
+        if ticket.state == "running":
+            self.running -= 1
+            elapsed = time.monotonic() - ticket.granted_at
+            self._service_time = 0.9 * self._service_time + 0.1 * elapsed
+        elif ticket.state == "queued":
+            self._queues[ticket.priority].remove(ticket)
+        ticket.state = "done"
+        ticket.changed.set()
+        self._dispatch()
+
+    def _grant(self, ticket: Ticket):
+        ticket.state = "running"
+        ticket.granted_at = time.monotonic()
+        self.running += 1
+        ticket.changed.set()
+
+    def _dispatch(self):
+        moved = False
+        while self.running < self.concurrency:
+            queue = next((q for q in self._queues if q.size), None)
+            if queue is None:
+                break
+            self._grant(queue.pop())
+            moved = True
+        if moved:
+            # Positions shifted for everyone still waiting
+            for queue in self._queues:
+                for waiting in queue.users.values():
+                    for ticket in waiting:
+                        ticket.changed.set()
@@ -0,0 +1,733 @@
+"""Search over the messages of every chat.
+
+Two indexes answer /api/search. ``TextIndex`` is an inverted index over
+message content ranked with BM25, kept current from the "session.message"
+events, so a query only visits the posting lists of its own terms. It is
+saved to SEARCH_DIR now and then, and at startup only the messages added
+since it was saved are read from the store; without a saved index (or with
+SEARCH_PERSIST_INDEX off) every chat is read once. ``VectorIndex`` holds one
+embedding per message, computed in batches by llama-server's /embedding
+endpoint and kept in a float32 matrix memory-mapped from SEARCH_DIR; a
+query is one matrix-vector product and a partial sort. The two rankings
+are merged with reciprocal rank fusion.
+
+The vector index needs numpy; without it, or when llama-server does not
+serve embeddings, search is text only. With several workers the leader
+computes the embeddings and the others map the same files.
+"""
+import asyncio
+import heapq
+import json
+import logging
+import math
+import os
+import re
+import sys
+import time
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+from operator import itemgetter
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Set, Tuple
+
+import httpx
+
+from app.conf import *
+from app.pubsub import Broker
+from app.sessions import SessionRegistry, StoredMessage, message_to_dict
+from app.upstream import get_llama_client
+
+logger = logging.getLogger(__name__)
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+RRF_K = 60  # rank offset of reciprocal rank fusion
+SPARSE_TERM_RATIO = 16  # a term this many times more frequent than the hits so far only rescores them
+MAX_MATCHES = 20  # character ranges returned per hit
+COMPACT_RATIO = 0.1  # share of deleted messages that makes the text index worth compacting
+INDEX_FORMAT = 1  # of the saved text index
+
+_WORD_RE = re.compile(r"\w+")
+
+Key = Tuple[str, int]  # (chat_id, seq)
+
+
+def _numpy_available() -> bool:
+    try:
+        import numpy  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercased words; single letters are left out"""
+    return [word for word in _WORD_RE.findall(text.lower()) if len(word) > 1 or word.isdigit()]
+
+
+class TextIndex:
+    """Inverted index of message content with BM25 ranking.
+
+    Messages are numbered in the order they are added and a posting list is
+    a pair of arrays (message numbers, term frequencies), so adding a
+    message appends to the lists of its own terms and nothing else.
+    """
+
+    def __init__(self):
+        self.chats: List[str] = []
+        self._chat_numbers: Dict[str, int] = {}
+        self.doc_chat = array("I")
+        self.doc_seq = array("I")
+        self.doc_length = array("I")
+        self.postings: Dict[str, Tuple[array, array]] = {}
+        self.total_length = 0
+        self.last_seq: Dict[int, int] = {}  # highest seq indexed, per chat number
+        self.chat_docs = array("I")  # messages indexed, per chat number
+        self.removed: Set[int] = set()  # deleted chats, whose messages are skipped until compacted
+        self.removed_docs = 0
+
+    def __len__(self) -> int:
+        return len(self.doc_seq)
+
+    def _chat_number(self, chat_id: str) -> int:
+        number = self._chat_numbers.get(chat_id)
+        if number is None:
+            number = self._chat_numbers[chat_id] = len(self.chats)
+            self.chats.append(chat_id)
+            self.chat_docs.append(0)
+        return number
+
+    def indexed(self, chat_id: str) -> int:
+        """Highest seq indexed for a chat, 0 if none"""
+        number = self._chat_numbers.get(chat_id)
+        return 0 if number is None else self.last_seq.get(number, 0)
+
+    def add(self, chat_id: str, seq: int, content: str) -> bool:
+        """Index one message; False if it was already indexed or its chat deleted"""
+        number = self._chat_number(chat_id)
+        if number in self.removed or seq <= self.last_seq.get(number, 0):
+            return False
+        self.last_seq[number] = seq
+
+        doc = len(self.doc_seq)
+        counts: Dict[str, int] = {}
+        for term in tokenize(content):
+            counts[term] = counts.get(term, 0) + 1
+        for term, count in counts.items():
+            posting = self.postings.get(term)
+            if posting is None:
+                posting = self.postings[term] = (array("I"), array("I"))
+            posting[0].append(doc)
+            posting[1].append(count)
+        length = sum(counts.values())
+        self.doc_chat.append(number)
+        self.doc_seq.append(seq)
+        self.doc_length.append(length)
+        self.total_length += length
+        self.chat_docs[number] += 1
+        return True
+
+    def remove_chat(self, chat_id: str):
+        number = self._chat_number(chat_id)
+        if number not in self.removed:
+            self.removed.add(number)
+            self.removed_docs += self.chat_docs[number]
+
+    @property
+    def needs_compaction(self) -> bool:
+        return self.removed_docs > len(self) * COMPACT_RATIO
+
+    def compacted(self) -> "TextIndex":
+        """A copy without the chats that were removed, messages renumbered"""
+        index = TextIndex()
+        chat_map: Dict[int, int] = {}
+        for number, chat_id in enumerate(self.chats):
+            if number not in self.removed:
+                chat_map[number] = index._chat_number(chat_id)
+                if number in self.last_seq:
+                    index.last_seq[chat_map[number]] = self.last_seq[number]
+        doc_map = array("i", [-1]) * len(self)  # old message number -> new one, -1 if dropped
+        for doc, (number, seq, length) in enumerate(zip(self.doc_chat, self.doc_seq, self.doc_length)):
+            new_number = chat_map.get(number)
+            if new_number is not None:
+                doc_map[doc] = len(index.doc_seq)
+                index.doc_chat.append(new_number)
+                index.doc_seq.append(seq)
+                index.doc_length.append(length)
+                index.chat_docs[new_number] += 1
+                index.total_length += length
+        for term, (docs, freqs) in self.postings.items():
+            kept_docs, kept_freqs = array("I"), array("I")
+            for doc, freq in zip(docs, freqs):
+                new_doc = doc_map[doc]
+                if new_doc >= 0:
+                    kept_docs.append(new_doc)
+                    kept_freqs.append(freq)
+            if kept_docs:
+                index.postings[term] = (kept_docs, kept_freqs)
+        return index
+
+    def save(self, path: Path):
+        """Write the index to ``path``, replaced atomically; removed chats must be compacted away first"""
+        if self.removed:
+            raise ValueError("compact the index before saving it")
+        header = {
+            "format": INDEX_FORMAT,
+            "itemsize": self.doc_seq.itemsize,
+            "byteorder": sys.byteorder,
+            "chats": self.chats,
+            "last_seq": [self.last_seq.get(number, 0) for number in range(len(self.chats))],
+            "docs": len(self),
+            "terms": [[term, len(docs)] for term, (docs, _) in self.postings.items()],
+        }
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(path.name + ".tmp")
+        with open(tmp_path, "wb") as f:
+            f.write(json.dumps(header).encode("utf-8") + b"\n")
+            for values in (self.doc_chat, self.doc_seq, self.doc_length):
+                values.tofile(f)
+            for docs, freqs in self.postings.values():
+                docs.tofile(f)
+                freqs.tofile(f)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: Path) -> Optional["TextIndex"]:
+        """An index written by ``save``; None if there is none or it cannot be used"""
+        index = cls()
+        try:
+            with open(path, "rb") as f:
+                header = json.loads(f.readline())
+                if (header.get("format") != INDEX_FORMAT or header["itemsize"] != index.doc_seq.itemsize
+                        or header["byteorder"] != sys.byteorder):
+                    logger.info("The saved search index has another format, rebuilding it")
+                    return None
+                for chat_id, last_seq in zip(header["chats"], header["last_seq"]):
+                    number = index._chat_number(chat_id)
+                    if last_seq:
+                        index.last_seq[number] = last_seq
+                for values in (index.doc_chat, index.doc_seq, index.doc_length):
+                    values.fromfile(f, header["docs"])
+                for term, size in header["terms"]:
+                    docs, freqs = array("I"), array("I")
+                    docs.fromfile(f, size)
+                    freqs.fromfile(f, size)
+                    index.postings[term] = (docs, freqs)
+            for number in index.doc_chat:
+                index.chat_docs[number] += 1
+        except FileNotFoundError:
+            return None
+        except (OSError, EOFError, ValueError, KeyError, TypeError, IndexError) as e:
+            logger.warning("Ignoring the saved search index %s: %s", path, e)
+            return None
+        index.total_length = sum(index.doc_length)
+        return index
+
+    def key(self, doc: int) -> Key:
+        return self.chats[self.doc_chat[doc]], self.doc_seq[doc]
+
+    def search(self, query: str, limit: int) -> List[Tuple[int, float]]:
+        """Best ``limit`` messages for a query as (message number, score)"""
+        count = len(self.doc_seq)
+        terms = set(tokenize(query))
+        if not count or not terms:
+            return []
+        average = self.total_length / count or 1.0
+        lengths = self.doc_length
+        postings = sorted((self.postings[t] for t in terms if t in self.postings), key=lambda p: len(p[0]))
+
+        scores: Dict[int, float] = {}
+        for docs, freqs in postings:
+            matched = len(docs)
+            idf = math.log(1.0 + (count - matched + 0.5) / (matched + 0.5))
+            if scores and matched > len(scores) * SPARSE_TERM_RATIO:
+                # Common term: look up the candidates instead of walking its whole list
+                pairs = []
+                for doc in scores:
+                    i = bisect_left(docs, doc)
+                    if i < matched and docs[i] == doc:
+                        pairs.append((doc, freqs[i]))
+            elif matched > SEARCH_MAX_POSTINGS:
+                # Too common to rank everything it occurs in: the newest messages win
+                pairs = zip(docs[-SEARCH_MAX_POSTINGS:], freqs[-SEARCH_MAX_POSTINGS:])
+            else:
+                pairs = zip(docs, freqs)
+            for doc, tf in pairs:
+                norm = BM25_K1 * (1.0 - BM25_B + BM25_B * lengths[doc] / average)
+                scores[doc] = scores.get(doc, 0.0) + idf * tf * (BM25_K1 + 1.0) / (tf + norm)
+
+        hits = scores.items()
+        if self.removed:
+            removed, doc_chat = self.removed, self.doc_chat
+            hits = [(doc, score) for doc, score in hits if doc_chat[doc] not in removed]
+        return heapq.nlargest(limit, hits, key=itemgetter(1))
+
+
+class VectorIndex:
+    """Message embeddings, one row per message, in a memory-mapped float32 matrix.
+
+    ``vectors.f32`` holds the rows and grows by SEARCH_VECTOR_CHUNK rows;
+    ``vectors.jsonl`` starts with the dimension and then lists the
+    (chat_id, seq) of every row, in order. Rows are written before their
+    keys, so a row is in use once its key line is complete.
+    """
+
+    def __init__(self, directory: Path):
+        self.directory = directory
+        self.matrix_path = directory / "vectors.f32"
+        self.keys_path = directory / "vectors.jsonl"
+        self.dim = 0
+        self.matrix = None  # numpy.memmap of every allocated row
+        self.keys: List[Key] = []
+        self.last_seq: Dict[str, int] = {}  # highest seq embedded, per chat
+        self._keys_offset = 0
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def load(self):
+        """Read the rows added since the last call, by this worker or another one"""
+        if not self.keys_path.exists():
+            return
+        with open(self.keys_path, "rb") as f:
+            f.seek(self._keys_offset)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break  # still being written
+                self._keys_offset += len(line)
+                record = json.loads(line)
+                if isinstance(record, dict):
+                    self.dim = record["dim"]
+                else:
+                    self._add_key(record[0], record[1])
+        self._map()
+
+    def reset(self):
+        """Forget every row, e.g. after the embedding model changed"""
+        self.matrix = None
+        for path in (self.matrix_path, self.keys_path):
+            if path.exists():
+                path.unlink()
+        self.dim = 0
+        self.keys = []
+        self.last_seq = {}
+        self._keys_offset = 0
+
+    def append(self, keys: Sequence[Key], vectors):
+        """Store the unit-length ``vectors`` of ``keys``; ValueError on a dimension change"""
+        if not self.dim:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            self.dim = int(vectors.shape[1])
+            self._write_keys(json.dumps({"dim": self.dim}) + "\n")
+        elif vectors.shape[1] != self.dim:
+            raise ValueError(f"embedding size changed from {self.dim} to {vectors.shape[1]}")
+
+        start, end = len(self.keys), len(self.keys) + len(keys)
+        capacity = 0 if self.matrix is None else len(self.matrix)
+        if end > capacity:
+            capacity = max(end, capacity + SEARCH_VECTOR_CHUNK)
+            with open(self.matrix_path, "ab") as f:
+                f.truncate(capacity * self.dim * 4)
+            self._map()
+        self.matrix[start:end] = vectors
+        self.matrix.flush()
+        self._write_keys("".join(json.dumps([chat_id, seq]) + "\n" for chat_id, seq in keys))
+        for chat_id, seq in keys:
+            self._add_key(chat_id, seq)
+
+    def clear_chat(self, chat_id: str):
+        """Zero the rows of a deleted chat so they stop matching"""
+        rows = [row for row, (key_chat, _) in enumerate(self.keys) if key_chat == chat_id]
+        if rows and self.matrix is not None:
+            self.matrix[rows] = 0.0
+            self.matrix.flush()
+        self.last_seq.pop(chat_id, None)
+
+    def search(self, vector, limit: int) -> List[Tuple[int, float]]:
+        """Rows most similar to a unit-length vector as (row, cosine similarity), unrelated ones left out"""
+        import numpy
+
+        rows, matrix = len(self.keys), self.matrix
+        if not rows or matrix is None or vector.shape[0] != self.dim:
+            return []
+        scores = matrix[:rows] @ vector
+        k = min(limit, rows)
+        top = numpy.argpartition(-scores, k - 1)[:k] if k < rows else numpy.arange(rows)
+        top = top[numpy.argsort(-scores[top])]
+        return [(int(row), float(scores[row])) for row in top if scores[row] > 0.0]
+
+    def _add_key(self, chat_id: str, seq: int):
+        self.keys.append((chat_id, seq))
+        if seq > self.last_seq.get(chat_id, 0):
+            self.last_seq[chat_id] = seq
+
+    def _write_keys(self, text: str):
+        data = text.encode("utf-8")
+        with open(self.keys_path, "ab") as f:
+            f.write(data)
+        self._keys_offset += len(data)
+
+    def _map(self):
+        import numpy
+
+        size = self.matrix_path.stat().st_size if self.dim and self.matrix_path.exists() else 0
+        capacity = size // (self.dim * 4) if self.dim else 0
+        if not capacity:
+            self.matrix = None
+        elif self.matrix is None or len(self.matrix) != capacity:
+            self.matrix = numpy.memmap(self.matrix_path, dtype=numpy.float32, mode="r+",
+                                       shape=(capacity, self.dim))
+
+
+class EmbeddingsUnsupported(Exception):
+    """llama-server has no /embedding endpoint (it was started without --embedding)"""
+
+
+async def embed(texts: List[str]):
+    """Unit-length embeddings of ``texts`` from llama-server, as a numpy matrix"""
+    import numpy
+
+    response = await get_llama_client().post("/embedding", json={"content": texts}, timeout=SEARCH_EMBED_TIMEOUT)
+    if response.status_code in (404, 501):
+        raise EmbeddingsUnsupported(f"status {response.status_code}")
+    response.raise_for_status()
+    results = response.json()
+    if isinstance(results, dict):
+        results = [results]
+    vectors = []
+    for result in sorted(results, key=lambda r: r.get("index", 0)):
+        vector = result["embedding"]
+        if vector and isinstance(vector[0], list):
+            vector = vector[0]  # pooled embedding, nested per sequence
+        vectors.append(vector)
+    if len(vectors) != len(texts):
+        raise ValueError(f"{len(vectors)} embeddings for {len(texts)} inputs")
+
+    matrix = numpy.asarray(vectors, dtype=numpy.float32)
+    norms = numpy.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0.0] = 1.0
+    return matrix / norms
+
+
+def fuse(rankings: Dict[str, List[Key]]) -> List[Tuple[Key, float, List[str]]]:
+    """Reciprocal rank fusion: (key, score, names of the rankings it came from), best first"""
+    scores: Dict[Key, float] = {}
+    sources: Dict[Key, List[str]] = {}
+    for name, keys in rankings.items():
+        for rank, key in enumerate(keys, 1):
+            scores[key] = scores.get(key, 0.0) + 1.0 / (RRF_K + rank)
+            sources.setdefault(key, []).append(name)
+    return [(key, score, sources[key]) for key, score in sorted(scores.items(), key=itemgetter(1), reverse=True)]
+
+
+def match_ranges(content: str, terms: Set[str]) -> List[Tuple[int, int]]:
+    """Character ranges of the query terms in a message"""
+    ranges = []
+    for match in _WORD_RE.finditer(content):
+        if match.group().lower() in terms:
+            ranges.append(match.span())
+            if len(ranges) >= MAX_MATCHES:
+                break
+    return ranges
+
+
+class SearchService:
+    """Keeps both indexes current with the chats and answers queries"""
+
+    def __init__(self, sessions: SessionRegistry, broker: Broker, directory: str = SEARCH_DIR,
+                 semantic: bool = SEARCH_SEMANTIC):
+        self.sessions = sessions
+        self.broker = broker
+        self.text = TextIndex()
+        self.index_path = Path(directory) / "text.idx"
+        self.vectors: Optional[VectorIndex] = None
+        if semantic and _numpy_available():
+            self.vectors = VectorIndex(Path(directory))
+        elif semantic:
+            logger.warning("SEARCH_SEMANTIC is enabled but the 'numpy' package is not installed, search is text only")
+        self.indexing = False  # the text index is still being built from the store
+        self._frozen = False  # the text index is being compacted or saved
+        self._dirty = False  # changed since it was saved
+        self._backlog: List[tuple] = []  # events received while building or frozen
+        self._pending: "OrderedDict[str, int]" = OrderedDict()  # chat_id -> first seq left to embed
+        self._tasks: List[asyncio.Task] = []
+        broker.subscribe("session.message", self._on_message)
+        broker.subscribe("session.deleted", self._on_deleted)
+        broker.subscribe("search.vectors", self._on_vectors)
+
+    @property
+    def semantic(self) -> bool:
+        return self.vectors is not None
+
+    async def start(self):
+        """Load the embeddings on disk and index the stored chats in the background"""
+        if self.vectors is not None:
+            if self.sessions.store.durable:
+                await asyncio.to_thread(self.vectors.load)
+            else:
+                await asyncio.to_thread(self.vectors.reset)  # rows of chats that are gone
+        self.indexing = True
+        self._tasks = [asyncio.create_task(self._build()), asyncio.create_task(self._checkpoint_loop())]
+        if self.vectors is not None:
+            self._tasks.append(asyncio.create_task(self._embed_loop()))
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if not self.indexing:
+            await self._checkpoint()
+
+    async def search(self, query: str, limit: int, mode: str = "hybrid") -> List[dict]:
+        """Best messages for a query; ``mode`` is "hybrid", "text" or "semantic" """
+        candidates = max(limit, SEARCH_CANDIDATES)
+        rankings: Dict[str, List[Key]] = {}
+        if mode in ("hybrid", "text"):
+            rankings["text"] = [self.text.key(doc) for doc, _ in self.text.search(query, candidates)]
+        if mode in ("hybrid", "semantic") and self.vectors is not None and len(self.vectors):
+            vectors = self.vectors
+            try:
+                vector = (await embed([query]))[0]
+            except (httpx.HTTPError, EmbeddingsUnsupported, ValueError, KeyError) as e:
+                logger.warning("Embedding the search query failed: %s", e)
+            else:
+                rows = await asyncio.to_thread(vectors.search, vector, candidates)
+                rankings["semantic"] = [vectors.keys[row] for row, _ in rows]
+
+        catalog = self.sessions.catalog
+        fused = [hit for hit in fuse(rankings) if hit[0][0] in catalog][:limit]
+        terms = set(tokenize(query))
+        hits = await asyncio.gather(*(self._hit(key, score, sources, terms) for key, score, sources in fused))
+        return [hit for hit in hits if hit is not None]
+
+    async def _hit(self, key: Key, score: float, sources: List[str], terms: Set[str]) -> Optional[dict]:
+        chat_id, seq = key
+        session = self.sessions.sessions.get(chat_id)
+        if session is not None and seq <= len(session.messages):
+            message = session.messages[seq - 1]
+        else:
+            records = await self.sessions.store.load_range(chat_id, seq - 1, seq)
+            if not records:
+                return None
+            message = StoredMessage.from_record(seq, records[0])
+        meta = self.sessions.catalog.get(chat_id)
+        if meta is None:
+            return None
+
+        content = message.content
+        matches = match_ranges(content, terms)
+        start = max(0, matches[0][0] - SEARCH_SNIPPET_CHARS // 4) if matches else 0
+        hit = message_to_dict(message)
+        del hit["content"]
+        hit.update({
+            "chat_id": chat_id,
+            "title": meta["title"],
+            "score": round(score, 6),
+            "sources": sources,
+            "matches": matches,  # [start, end) in the message content
+            "snippet": content[start:start + SEARCH_SNIPPET_CHARS],
+            "snippet_start": start,
+        })
+        return hit
+
+    # Indexing
+
+    async def _build(self):
+        started = time.monotonic()
+        store = self.sessions.store
+        catalog = self.sessions.catalog
+        try:
+            if self._persistent:
+                index = await asyncio.to_thread(TextIndex.load, self.index_path)
+                if index is not None and any(index.indexed(chat_id) > meta["message_count"]
+                                             for chat_id, meta in catalog.items()):
+                    logger.warning("The saved search index is ahead of the chat store, rebuilding it")
+                elif index is not None:
+                    self.text = index
+                    for chat_id in index.chats:
+                        if chat_id not in catalog:
+                            index.remove_chat(chat_id)
+            saved = len(self.text)
+            # Only what was added since the index was saved is read
+            for chat_id in list(catalog):
+                meta = catalog.get(chat_id)
+                if meta is None:
+                    continue
+                first = self.text.indexed(chat_id) + 1
+                if first == 1:
+                    await self._add_records(chat_id, 1, await store.load_messages(chat_id) or [])
+                elif first <= meta["message_count"]:
+                    records = await store.load_range(chat_id, first - 1, meta["message_count"])
+                    await self._add_records(chat_id, first, records)
+                self._queue_embedding(chat_id, meta["message_count"])
+            self._dirty = len(self.text) != saved or bool(self.text.removed)
+        finally:
+            self.indexing = False
+            self._replay()
+        logger.info("Search index built: %d messages, %d read from the store, in %.1fs",
+                    len(self.text), len(self.text) - saved, time.monotonic() - started)
+        await self._checkpoint()
+
+    def _replay(self):
+        backlog, self._backlog = self._backlog, []
+        for event in backlog:
+            if event[0] == "message":
+                self._add(*event[1:])
+            else:
+                self._remove(event[1])
+
+    @property
+    def _persistent(self) -> bool:
+        # A store that does not keep every message would leave the saved index ahead of it
+        return SEARCH_PERSIST_INDEX and self.sessions.store.durable
+
+    async def _checkpoint(self):
+        """Compact the text index when enough of it is deleted chats, and save it on the leader"""
+        save = self._persistent and self._dirty and self.broker.is_leader
+        if self._frozen or not (save or self.text.needs_compaction):
+            return
+        if save:
+            # Messages must be in the store before the saved index counts them
+            await self.sessions.store.flush()
+        # Queries keep using the index as it is; changes wait in the backlog
+        self._frozen = True
+        self._dirty = False
+        job = asyncio.ensure_future(asyncio.to_thread(self._compact_and_save, self.text, save))
+        try:
+            try:
+                self.text = await asyncio.shield(job)
+            except asyncio.CancelledError:
+                # The thread still reads the index: it must not change before it is done
+                await asyncio.wait([job])
+                raise
+        except OSError as e:
+            self._dirty = True
+            logger.warning("Saving the search index failed: %s", e)
+        finally:
+            self._frozen = False
+            self._replay()
+
+    def _compact_and_save(self, index: TextIndex, save: bool) -> TextIndex:
+        if index.removed:
+            index = index.compacted()
+        if save:
+            index.save(self.index_path)
+        return index
+
+    async def _checkpoint_loop(self):
+        while True:
+            await asyncio.sleep(SEARCH_INDEX_SAVE_INTERVAL)
+            if not self.indexing:
+                await self._checkpoint()
+
+    async def _add_records(self, chat_id: str, first: int, records: List[dict]):
+        # On the event loop, so a query never sees a half-added message, in slices
+        # so queries are answered meanwhile
+        for start in range(0, len(records), SEARCH_BUILD_BATCH):
+            for seq, record in enumerate(records[start:start + SEARCH_BUILD_BATCH], first + start):
+                self.text.add(chat_id, seq, record.get("content") or "")
+            await asyncio.sleep(0)
+
+    def _add(self, chat_id: str, seq: int, content: str):
+        if self.text.add(chat_id, seq, content):
+            self._dirty = True
+            self._queue_embedding(chat_id, seq)
+
+    def _remove(self, chat_id: str):
+        self.text.remove_chat(chat_id)
+        self._dirty = True
+        self._pending.pop(chat_id, None)
+
+    def _queue_embedding(self, chat_id: str, last_seq: int):
+        if self.vectors is None or chat_id in self._pending:
+            return
+        first = self.vectors.last_seq.get(chat_id, 0) + 1
+        if first <= last_seq:
+            self._pending[chat_id] = first
+
+    async def _embed_loop(self):
+        delay = SEARCH_EMBED_INTERVAL
+        while self.vectors is not None:
+            await asyncio.sleep(delay)
+            if not self._pending or not self.broker.is_leader:
+                continue
+            try:
+                await self._embed_batch()
+                delay = SEARCH_EMBED_INTERVAL
+            except EmbeddingsUnsupported as e:
+                logger.warning("llama-server does not serve embeddings (%s), search is text only; "
+                               "start it with --embedding to enable semantic search", e)
+                self.vectors = None
+            except (httpx.HTTPError, ValueError, KeyError) as e:
+                delay = min(delay * 2, 60.0)
+                logger.warning("Computing embeddings failed, retrying in %.0fs: %s", delay, e)
+
+    async def _embed_batch(self):
+        vectors, store, catalog = self.vectors, self.sessions.store, self.sessions.catalog
+        await asyncio.to_thread(vectors.load)  # rows written by a previous leader
+
+        taken: Dict[str, int] = {}
+        keys: List[Key] = []
+        texts: List[str] = []
+        while self._pending and len(texts) < SEARCH_EMBED_BATCH:
+            chat_id, first = self._pending.popitem(last=False)
+            meta = catalog.get(chat_id)
+            if meta is None:
+                continue
+            taken[chat_id] = first
+            first = max(first, vectors.last_seq.get(chat_id, 0) + 1)
+            end = min(meta["message_count"], first - 1 + SEARCH_EMBED_BATCH - len(texts))
+            for seq, record in enumerate(await store.load_range(chat_id, first - 1, end), first):
+                content = (record.get("content") or "").strip()
+                if content:
+                    keys.append((chat_id, seq))
+                    texts.append(content[:SEARCH_EMBED_MAX_CHARS])
+            if end < meta["message_count"]:
+                self._pending[chat_id] = end + 1
+                self._pending.move_to_end(chat_id, last=False)
+        if not texts:
+            return
+
+        try:
+            matrix = await embed(texts)
+            try:
+                await asyncio.to_thread(vectors.append, keys, matrix)
+            except ValueError as e:
+                logger.warning("Rebuilding the vector index: %s", e)
+                await asyncio.to_thread(vectors.reset)
+                # Every chat starts over from its first message, this batch included:
+                # appending it now would mark the messages before it as embedded
+                for chat_id in catalog:
+                    self._pending[chat_id] = 1
+        except Exception:
+            # Put the batch back to be tried again
+            for chat_id, first in taken.items():
+                self._pending[chat_id] = first
+                self._pending.move_to_end(chat_id, last=False)
+            raise
+        self.broker.publish("search.vectors", {"rows": len(vectors)})
+
+    # Changes made by this and other workers
+
+    def _on_message(self, payload: dict, origin: str):
+        content = payload["message"].get("content") or ""
+        if self.indexing or self._frozen:
+            self._backlog.append(("message", payload["chat_id"], payload["seq"], content))
+        else:
+            self._add(payload["chat_id"], payload["seq"], content)
+
+    async def _on_deleted(self, payload: dict, origin: str):
+        chat_id = payload["chat_id"]
+        if self.indexing or self._frozen:
+            self._backlog.append(("deleted", chat_id))
+        else:
+            self._remove(chat_id)
+        vectors = self.vectors
+        if vectors is not None and self.broker.is_leader:
+            await asyncio.to_thread(vectors.clear_chat, chat_id)
+
+    async def _on_vectors(self, payload: dict, origin: str):
+        if self.vectors is not None and not self.broker.is_local(origin):
+            await asyncio.to_thread(self.vectors.load)
@@ -0,0 +1,479 @@
+"""Chat session registry: in-memory cache in front of a SessionStore.
+
+Loaded chats are kept compact: a message is a slotted record with an
+interned role and an integer timestamp, and pydantic models are only built
+at the API edge. Loaded chats form an LRU within CHAT_MEMORY_BUDGET bytes;
+once it is exceeded, chats idle for CHAT_EVICT_IDLE seconds are dropped and
+read back from the store when next needed.
+
+Changes are published on the event broker so that every worker process
+sees the same chat list and keeps the chats it has loaded current; only the
+worker that made a change writes it to the store.
+"""
+import asyncio
+import bisect
+import sys
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from app.conf import *
+from app.metrics import SESSION_EVICTIONS
+from app.models import ChatMessage
+from app.pubsub import Broker
+from app.storage import SessionStore
+
+MESSAGE_OVERHEAD = 120  # bytes per message besides its content: record, list slot, timestamp
+SESSION_OVERHEAD = 600  # bytes per loaded chat besides its messages
+
+
+def to_epoch_us(moment: Optional[datetime]) -> Optional[int]:
+    if moment is None:
+        return None
+    return int(moment.replace(microsecond=0).timestamp()) * 1_000_000 + moment.microsecond
+
+
+def from_epoch_us(value: Optional[int]) -> Optional[datetime]:
+    if value is None:
+        return None
+    return datetime.fromtimestamp(value // 1_000_000).replace(microsecond=value % 1_000_000)
+
+
+class StoredMessage:
+    """One message of a loaded chat, as small as a Python object gets"""
+
+    __slots__ = ("seq", "role", "content", "ts", "truncated")
+
+    def __init__(self, seq: int, role: str, content: str, ts: Optional[int], truncated: bool = False):
+        self.seq = seq  # 1-based position in the chat, stable once assigned
+        self.role = sys.intern(role)  # a handful of distinct values, shared by every message
+        self.content = content
+        self.ts = ts  # microseconds since the epoch
+        self.truncated = truncated
+
+    @classmethod
+    def from_record(cls, seq: int, record: dict) -> "StoredMessage":
+        timestamp = record.get("timestamp")
+        return cls(seq, record["role"], record["content"],
+                   to_epoch_us(datetime.fromisoformat(timestamp)) if timestamp else None,
+                   record.get("truncated", False))
+
+    @property
+    def timestamp(self) -> Optional[datetime]:
+        return from_epoch_us(self.ts)
+
+    @property
+    def size(self) -> int:
+        return sys.getsizeof(self.content) + MESSAGE_OVERHEAD
+
+    def to_record(self) -> dict:
+        """Store representation"""
+        timestamp = self.timestamp
+        record = {"role": self.role, "content": self.content,
+                  "timestamp": timestamp.isoformat() if timestamp else None}
+        if self.truncated:
+            record["truncated"] = True
+        return record
+
+    def to_model(self) -> ChatMessage:
+        return ChatMessage(role=self.role, content=self.content, timestamp=self.timestamp,
+                           truncated=self.truncated, seq=self.seq)
+
+
+def message_to_dict(message: StoredMessage) -> dict:
+    """API representation of a message, cheaper than a pydantic dump"""
+    timestamp = message.timestamp
+    return {
+        "seq": message.seq,
+        "role": message.role,
+        "content": message.content,
+        "timestamp": timestamp.isoformat() if timestamp else None,
+        "truncated": message.truncated,
+    }
+
+
+class Session:
+    """A loaded chat: its metadata and messages"""
+
+    __slots__ = ("chat_id", "title", "messages", "created_at", "updated_at", "size", "last_used")
+
+    def __init__(self, chat_id: str, title: str, messages: List[StoredMessage],
+                 created_at: datetime, updated_at: datetime):
+        self.chat_id = chat_id
+        self.title = title
+        self.messages = messages
+        self.created_at = created_at
+        self.updated_at = updated_at
+        self.size = SESSION_OVERHEAD + sum(m.size for m in messages)  # estimated bytes
+        self.last_used = time.monotonic()
+
+
+class RecencyIndex:
+    """Chats ordered by last update, with their list entries prebuilt.
+
+    Kept as a sorted list of ``(updated_at, chat_id)`` keys: an update moves
+    one key to the end, and a page is a bisect plus a slice, so listing no
+    longer walks and sorts every session.
+    """
+
+    def __init__(self):
+        self._keys: List[Tuple[float, str]] = []
+        self._entries: Dict[str, Tuple[Tuple[float, str], dict]] = {}
+        self.version = 0
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def update(self, meta: dict):
+        chat_id = meta["chat_id"]
+        self._discard(chat_id)
+        key = (meta["updated_at"].timestamp(), chat_id)
+        if not self._keys or key >= self._keys[-1]:
+            self._keys.append(key)
+        else:
+            bisect.insort(self._keys, key)
+        self._entries[chat_id] = (key, self._summary(meta))
+        self.version += 1
+
+    def remove(self, chat_id: str):
+        if self._discard(chat_id):
+            self.version += 1
+
+    def rebuild(self, metas):
+        entries = [((m["updated_at"].timestamp(), m["chat_id"]), m) for m in metas]
+        entries.sort(key=lambda e: e[0])
+        self._keys = [key for key, _ in entries]
+        self._entries = {meta["chat_id"]: (key, self._summary(meta)) for key, meta in entries}
+        self.version += 1
+
+    def page(self, limit: int, before: Optional[str] = None) -> Tuple[List[dict], Optional[str]]:
+        """Newest chats first, older than the ``before`` cursor; returns (chats, next cursor)"""
+        end = len(self._keys)
+        if before:
+            end = bisect.bisect_left(self._keys, self.decode_cursor(before))
+        start = max(0, end - limit)
+        chats = [self._entries[chat_id][1] for _, chat_id in reversed(self._keys[start:end])]
+        next_cursor = self.encode_cursor(self._keys[start]) if start > 0 else None
+        return chats, next_cursor
+
+    @staticmethod
+    def _summary(meta: dict) -> dict:
+        return {
+            "chat_id": meta["chat_id"],
+            "title": meta["title"],
+            "message_count": meta["message_count"],
+            "updated_at": meta["updated_at"].isoformat()
+        }
+
+    @staticmethod
+    def encode_cursor(key: Tuple[float, str]) -> str:
+        return f"{key[0]!r}:{key[1]}"
+
+    @staticmethod
+    def decode_cursor(cursor: str) -> Tuple[float, str]:
+        """Raises ValueError for a malformed cursor"""
+        timestamp, _, chat_id = cursor.partition(":")
+        return float(timestamp), chat_id
+
+    def _discard(self, chat_id: str) -> bool:
+        entry = self._entries.pop(chat_id, None)
+        if entry is None:
+            return False
+        index = bisect.bisect_left(self._keys, entry[0])
+        del self._keys[index]
+        return True
+
+
+class SessionRegistry:
+    """Tracks every chat and keeps the recently used sessions in memory.
+
+    The catalog (title, timestamps, message count) of every chat is known up
+    front; messages are only read from the store the first time a chat is
+    requested. Every mutation goes through the registry so the store sees an
+    append-only stream of changes.
+    """
+
+    def __init__(self, store: SessionStore, broker: Broker, memory_budget: int = CHAT_MEMORY_BUDGET,
+                 evict_idle: float = CHAT_EVICT_IDLE):
+        self.store = store
+        self.broker = broker
+        self.memory_budget = memory_budget
+        self.evict_idle = evict_idle
+        self.sessions: "OrderedDict[str, Session]" = OrderedDict()  # least recently used first
+        self.memory = 0  # estimated bytes of every loaded session
+        self.catalog: Dict[str, dict] = {}
+        self.index = RecencyIndex()
+        self._epoch = uuid.uuid4().hex[:8]
+        self._loading: Dict[str, asyncio.Future] = {}
+        broker.subscribe("session.meta", self._on_meta)
+        broker.subscribe("session.message", self._on_message)
+        broker.subscribe("session.deleted", self._on_deleted)
+
+    async def start(self):
+        await self.store.start()
+        self.sessions = OrderedDict()
+        self.memory = 0
+        self.catalog = {}
+        for chat_id, meta in self.store.catalog().items():
+            self.catalog[chat_id] = self._parse_meta(meta)
+        # One sort at startup, then the index is maintained incrementally
+        self.index.rebuild(self.catalog.values())
+
+    async def close(self):
+        await self.store.close()
+
+    def __contains__(self, chat_id: str) -> bool:
+        return chat_id in self.catalog
+
+    def __len__(self) -> int:
+        return len(self.catalog)
+
+    def summaries(self) -> Iterator[dict]:
+        """Metadata of every chat, loaded or not"""
+        return iter(self.catalog.values())
+
+    @property
+    def etag(self) -> str:
+        """Changes whenever the chat list changes, and on every restart"""
+        return f'"chats-{self._epoch}-{self.index.version}"'
+
+    def session_etag(self, chat_id: str) -> Optional[str]:
+        """Changes whenever the chat gets a message or a new title"""
+        meta = self.catalog.get(chat_id)
+        if meta is None:
+            return None
+        return f'"chat-{self._epoch}-{meta["version"]}"'
+
+    @staticmethod
+    def window(session: Session, limit: Optional[int] = None, before: Optional[int] = None,
+               since: Optional[int] = None) -> Tuple[List[StoredMessage], bool]:
+        """Slice of a chat by sequence number; returns (messages, older ones exist).
+
+        ``since`` returns the messages after that seq, ``before`` the ones
+        preceding it, and ``limit`` keeps the newest of them. Seq ``n`` is
+        ``messages[n - 1]``, so this is a slice, not a scan.
+        """
+        messages = session.messages
+        end = len(messages)
+        if before is not None:
+            end = min(max(before - 1, 0), end)
+        start = min(max(since, 0), end) if since is not None else 0
+        if limit is not None:
+            start = max(start, end - limit)
+        return messages[start:end], start > 0
+
+    async def get(self, chat_id: str) -> Optional[Session]:
+        """Return a session, loading it from the store when it is not in memory"""
+        session = self.sessions.get(chat_id)
+        if session is not None:
+            self._touch(session)
+            return session
+        if chat_id not in self.catalog:
+            return None
+
+        # Concurrent first touches share a single load
+        future = self._loading.get(chat_id)
+        if future is None:
+            future = asyncio.ensure_future(self._load(chat_id))
+            self._loading[chat_id] = future
+            future.add_done_callback(lambda _: self._loading.pop(chat_id, None))
+        return await asyncio.shield(future)
+
+    async def _load(self, chat_id: str) -> Optional[Session]:
+        records = await self.store.load_messages(chat_id) or []
+        # Messages appended on other workers reach the store a flush interval later
+        for _ in range(CHAT_LOAD_RETRIES):
+            meta = self.catalog.get(chat_id)
+            if meta is None or len(records) >= meta["message_count"]:
+                break
+            await asyncio.sleep(CHAT_STORE_FLUSH_INTERVAL)
+            records = await self.store.load_messages(chat_id) or []
+        meta = self.catalog.get(chat_id)
+        if meta is None:
+            return None  # deleted while loading
+        if chat_id in self.sessions:
+            return self.sessions[chat_id]
+
+        messages = [StoredMessage.from_record(position, r) for position, r in enumerate(records, 1)]
+        session = Session(chat_id, meta["title"], messages, meta["created_at"], meta["updated_at"])
+        if len(messages) < meta["message_count"]:
+            return session  # still behind the catalog: served uncached, read again on next access
+        self._add(session)
+        return session
+
+    def create(self, title: Optional[str] = None) -> Session:
+        """Create and register an empty chat session"""
+        chat_id = str(uuid.uuid4())
+        now = datetime.now()
+        session = Session(chat_id, title or f"Chat {len(self.catalog) + 1}", [], now, now)
+        self._add(session)
+        self.catalog[chat_id] = {
+            "chat_id": chat_id,
+            "title": session.title,
+            "created_at": now,
+            "updated_at": now,
+            "message_count": 0,
+            "version": 0,
+        }
+        self._save_meta(chat_id)
+        return session
+
+    def append(self, session: Session, message: ChatMessage):
+        """Add a message to a session and persist it; sets ``message.seq``"""
+        chat_id = session.chat_id
+        meta = self.catalog.get(chat_id)
+        message.seq = len(session.messages) + 1
+        stored = StoredMessage(message.seq, message.role, message.content, to_epoch_us(message.timestamp),
+                               message.truncated)
+        self._append(session, stored)
+        if meta is None:
+            return  # chat was deleted meanwhile, keep the reply off disk
+
+        current = self.sessions.get(chat_id)
+        if current is None:
+            if len(session.messages) > meta["message_count"]:
+                # Evicted while a reply was generated; this copy is complete
+                self._add(session)
+        elif current is not session:
+            # Evicted and loaded again meanwhile: keep the loaded copy current too
+            self._append(current, stored)
+
+        session.updated_at = message.timestamp or datetime.now()
+        meta["updated_at"] = session.updated_at
+        meta["message_count"] = len(session.messages)
+        record = stored.to_record()
+        self.store.append_message(chat_id, record)
+        self.broker.publish("session.message", {"chat_id": chat_id, "seq": message.seq, "message": record})
+        self._save_meta(chat_id)
+
+    def rename(self, chat_id: str, title: str) -> bool:
+        """Change the title of a chat"""
+        meta = self.catalog.get(chat_id)
+        if meta is None:
+            return False
+
+        now = datetime.now()
+        meta["title"] = title
+        meta["updated_at"] = now
+        session = self.sessions.get(chat_id)
+        if session is not None:
+            session.title = title
+            session.updated_at = now
+        self._save_meta(chat_id)
+        return True
+
+    def delete(self, chat_id: str) -> bool:
+        """Remove a chat from memory and from the store"""
+        if chat_id not in self.catalog:
+            return False
+
+        del self.catalog[chat_id]
+        self.index.remove(chat_id)
+        self._drop(chat_id)
+        self.store.delete(chat_id)
+        self.broker.publish("session.deleted", {"chat_id": chat_id})
+        return True
+
+    # Memory
+
+    def _touch(self, session: Session):
+        session.last_used = time.monotonic()
+        self.sessions.move_to_end(session.chat_id)
+
+    def _add(self, session: Session):
+        session.last_used = time.monotonic()
+        self.sessions[session.chat_id] = session
+        self.memory += session.size
+        self._evict()
+
+    def _append(self, session: Session, message: StoredMessage):
+        session.messages.append(message)
+        session.size += message.size
+        if self.sessions.get(session.chat_id) is session:
+            self.memory += message.size
+            self._touch(session)
+            self._evict()
+
+    def _drop(self, chat_id: str):
+        session = self.sessions.pop(chat_id, None)
+        if session is not None:
+            self.memory -= session.size
+
+    def _evict(self):
+        """Drop the least recently used idle sessions while over the memory budget"""
+        if not self.store.durable or not self.memory_budget:
+            return  # nothing to load them back from
+        now = time.monotonic()
+        while self.memory > self.memory_budget and self.sessions:
+            session = next(iter(self.sessions.values()))
+            if now - session.last_used < self.evict_idle:
+                break  # every other session was used even more recently
+            self._drop(session.chat_id)
+            SESSION_EVICTIONS.inc()
+
+    def _save_meta(self, chat_id: str):
+        meta = self.catalog[chat_id]
+        meta["version"] += 1
+        self.index.update(meta)
+        record = {
+            "chat_id": chat_id,
+            "title": meta["title"],
+            "created_at": meta["created_at"].isoformat(),
+            "updated_at": meta["updated_at"].isoformat(),
+            "message_count": meta["message_count"],
+        }
+        self.store.save_meta(record)
+        self.broker.publish("session.meta", record)
+
+    @staticmethod
+    def _parse_meta(meta: dict) -> dict:
+        return {
+            "chat_id": meta["chat_id"],
+            "title": meta["title"],
+            "created_at": datetime.fromisoformat(meta["created_at"]),
+            "updated_at": datetime.fromisoformat(meta["updated_at"]),
+            "message_count": meta.get("message_count", 0),
+            "version": 0,
+        }
+
+    # Changes made by other workers
+
+    def _on_meta(self, record: dict, origin: str):
+        if self.broker.is_local(origin):
+            return
+        chat_id = record["chat_id"]
+        self.store.observe_meta(record)
+        meta = self._parse_meta(record)
+        previous = self.catalog.get(chat_id)
+        if previous is not None:
+            meta["version"] = previous["version"]
+        meta["version"] += 1
+        self.catalog[chat_id] = meta
+        self.index.update(meta)
+        session = self.sessions.get(chat_id)
+        if session is not None:
+            session.title = meta["title"]
+            session.updated_at = meta["updated_at"]
+
+    def _on_message(self, payload: dict, origin: str):
+        if self.broker.is_local(origin):
+            return
+        session = self.sessions.get(payload["chat_id"])
+        if session is None:
+            return  # loaded from the store when first needed
+        if payload["seq"] != len(session.messages) + 1:
+            # Out of step (e.g. both workers appended at once): reload on next access
+            self._drop(payload["chat_id"])
+            return
+        self._append(session, StoredMessage.from_record(payload["seq"], payload["message"]))
+
+    def _on_deleted(self, payload: dict, origin: str):
+        if self.broker.is_local(origin):
+            return
+        chat_id = payload["chat_id"]
+        if self.catalog.pop(chat_id, None) is not None:
+            self.index.remove(chat_id)
+        self._drop(chat_id)
+        self.store.observe_delete(chat_id)
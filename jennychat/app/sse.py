@@ -0,0 +1,116 @@
+"""Server-Sent Events helpers for streaming chat completions"""
+import asyncio
+import json
+import time
+from typing import AsyncIterator, List, Optional
+
+
+async def iter_sse_data(lines: AsyncIterator[str]) -> AsyncIterator[str]:
+    """Incrementally decode an SSE stream into the payload of each event.
+
+    Works over already split lines (e.g. ``response.aiter_lines()``), so
+    several events in one network chunk and events split across chunks are
+    both handled. Multi-line ``data:`` fields are joined with newlines.
+    """
+    data: List[str] = []
+    async for line in lines:
+        if not line:
+            # Blank line terminates the event
+            if data:
+                yield "\n".join(data)
+                data = []
+            continue
+        if line.startswith(":"):
+            continue  # comment / keep-alive
+        field, _, value = line.partition(":")
+        if field != "data":
+            continue
+        if value.startswith(" "):
+            value = value[1:]
+        data.append(value)
+
+    # Stream closed without a trailing blank line
+    if data:
+        yield "\n".join(data)
+
+
+async def iter_completion_deltas(lines: AsyncIterator[str]) -> AsyncIterator[str]:
+    """Yield content deltas from an OpenAI-compatible chat completion stream"""
+    async for data in iter_sse_data(lines):
+        if data == "[DONE]":
+            break
+        try:
+            parsed = json.loads(data)
+        except json.JSONDecodeError:
+            continue
+        choices = parsed.get("choices") if isinstance(parsed, dict) else None
+        if choices:
+            content = (choices[0].get("delta") or {}).get("content")
+            if content:
+                yield content
+
+
+async def coalesce(tokens: AsyncIterator[str], interval_ms: float, max_tokens: int) -> AsyncIterator[str]:
+    """Group tokens so they are flushed every ``interval_ms`` or ``max_tokens``.
+
+    A flush is triggered by whichever limit is hit first, also when the
+    upstream goes quiet, so a slow token never sits in the buffer for longer
+    than the interval.
+    """
+    if interval_ms <= 0 and max_tokens <= 1:
+        async for token in tokens:
+            yield token
+        return
+
+    interval = interval_ms / 1000.0
+    iterator = tokens.__aiter__()
+    buffer: List[str] = []
+    deadline: Optional[float] = None
+    pending: Optional[asyncio.Future] = None
+
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(iterator.__anext__())
+
+            timeout = None
+            if buffer and deadline is not None:
+                timeout = max(0.0, deadline - time.monotonic())
+
+            done, _ = await asyncio.wait({pending}, timeout=timeout)
+            if not done:
+                # Interval elapsed while waiting for the next token
+                yield "".join(buffer)
+                buffer = []
+                deadline = None
+                continue
+
+            try:
+                token = pending.result()
+            except StopAsyncIteration:
+                pending = None
+                break
+            pending = None
+
+            if not buffer:
+                deadline = time.monotonic() + interval
+            buffer.append(token)
+            if len(buffer) >= max_tokens or time.monotonic() >= deadline:
+                yield "".join(buffer)
+                buffer = []
+                deadline = None
+
+        if buffer:
+            yield "".join(buffer)
+    finally:
+        if pending is not None and not pending.done():
+            pending.cancel()
+            try:
+                await pending
+            except (asyncio.CancelledError, StopAsyncIteration):
+                pass
+
+
+def sse_event(payload: dict) -> str:
+    """Format one SSE ``data:`` event"""
+    return f"data: {json.dumps(payload)}\n\n"
@@ -0,0 +1,96 @@
+// Chat generation over one persistent WebSocket (/ws/chat, protocol in app/channel.py).
+// Several replies can stream at once, each tagged with the id chosen in generate().
+export class ChatChannel {
+    constructor(path = '/ws/chat') {
+        const protocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
+        // Token frames come as binary: 0x01, id length, id, UTF-8 text
+        this.url = `${protocol}//${window.location.host}${path}?frames=binary`;
+        this.socket = null;
+        this.handlers = new Map(); // request id -> { onStarted, onQueued, onToken, onDone, onCancelled, onError }
+        this.nextId = 1;
+        this.reconnectAttempts = 0;
+        this.maxReconnectDelay = 30000;
+        this.decoder = new TextDecoder();
+        this.onChat = null; // chat created, renamed or updated, on any tab
+        this.onChatDeleted = null;
+        this.connect();
+    }
+
+    get isOpen() {
+        return this.socket?.readyState === WebSocket.OPEN;
+    }
+
+    connect() {
+        this.socket = new WebSocket(this.url);
+        this.socket.binaryType = 'arraybuffer';
+        this.socket.onopen = () => {
+            this.reconnectAttempts = 0;
+        };
+        this.socket.onmessage = (event) => this.handleFrame(event.data);
+        this.socket.onclose = () => {
+            // Replies in flight are lost with the socket; the server keeps what was generated
+            for (const handler of this.handlers.values()) {
+                handler.onError?.('Connection lost');
+            }
+            this.handlers.clear();
+            const delay = Math.min(1000 * 2 ** this.reconnectAttempts++, this.maxReconnectDelay);
+            setTimeout(() => this.connect(), delay);
+        };
+    }
+
+    generate(body, handlers) {
+        const id = String(this.nextId++);
+        this.handlers.set(id, handlers);
+        this.socket.send(JSON.stringify({ type: 'generate', id, ...body }));
+        return id;
+    }
+
+    cancel(id) {
+        if (this.isOpen && this.handlers.has(id)) {
+            this.socket.send(JSON.stringify({ type: 'cancel', id }));
+        }
+    }
+
+    handleFrame(data) {
+        if (data instanceof ArrayBuffer) {
+            const bytes = new Uint8Array(data);
+            const idLength = bytes[1];
+            const id = this.decoder.decode(bytes.subarray(2, 2 + idLength));
+            this.handlers.get(id)?.onToken?.(this.decoder.decode(bytes.subarray(2 + idLength)));
+            return;
+        }
+
+        const message = JSON.parse(data);
+        if (Array.isArray(message)) {
+            this.handlers.get(message[0])?.onToken?.(message[1]);
+            return;
+        }
+        const handler = this.handlers.get(message.id);
+        switch (message.type) {
+            case 'started':
+                handler?.onStarted?.(message.chat_id);
+                break;
+            case 'queued':
+                handler?.onQueued?.(message.position);
+                break;
+            case 'done':
+                this.handlers.delete(message.id);
+                handler?.onDone?.(message.chat_id);
+                break;
+            case 'cancelled':
+                this.handlers.delete(message.id);
+                handler?.onCancelled?.(message.truncated);
+                break;
+            case 'error':
+                this.handlers.delete(message.id);
+                handler?.onError?.(message.error);
+                break;
+            case 'chat':
+                this.onChat?.(message.chat);
+                break;
+            case 'chat_deleted':
+                this.onChatDeleted?.(message.chat_id);
+                break;
+        }
+    }
+}
@@ -1,10 +1,20 @@
 import { marked } from 'marked';
+import { ChatChannel } from './chat-channel.js';
 
 export class ChatManager {
     constructor() {
         this.apiBase = '/api';
         this.currentChatId = null;
         this.isStreaming = false;
+        this.abortController = null;
+        this.channelRequestId = null; // reply streaming over the channel
+        this.messagePageSize = 50;
+        this.chatCache = new Map(); // chat_id -> { title, messages, lastSeq, hasMore }
+        // Replies stream over one WebSocket when it is open, over HTTP otherwise;
+        // it also keeps the chat list in step with other tabs and devices
+        this.channel = new ChatChannel();
+        this.channel.onChat = (chat) => this.updateChatListItem(chat);
+        this.channel.onChatDeleted = (chatId) => this.removeChatListItem(chatId);
         this.initializeElements();
         this.setupEventListeners();
         this.loadModels();
@@ -33,7 +43,14 @@ export class ChatManager {
 
     setupEventListeners() {
         // Chat controls
-        this.elements.sendButton?.addEventListener('click', () => this.sendMessage());
+        this.elements.sendButton?.addEventListener('click', () => {
+            // The send button doubles as Stop while a reply is being generated
+            if (this.isStreaming) {
+                this.stopGeneration();
+            } else {
+                this.sendMessage();
+            }
+        });
         this.elements.messageInput?.addEventListener('keydown', (e) => {
             if (e.key === 'Enter' && !e.shiftKey) {
                 e.preventDefault();
@@ -55,45 +72,87 @@ export class ChatManager {
         this.loadChats();
     }
 
-    async loadChats() {
+    async loadChats(more = false) {
         try {
-            const response = await fetch(`${this.apiBase}/chats`);
+            // The list is revalidated with its ETag, unchanged pages come back as 304
+            const cursor = more && this.nextChatCursor ? `?before=${encodeURIComponent(this.nextChatCursor)}` : '';
+            const response = await fetch(`${this.apiBase}/chats${cursor}`);
             const data = await response.json();
             
-            this.renderChatList(data.chats);
+            this.nextChatCursor = data.next_cursor || null;
+            this.renderChatList(data.chats, more);
         } catch (error) {
             console.error('Error loading chats:', error);
             this.showNotification('Failed to load chats', 'error');
         }
     }
 
-    renderChatList(chats) {
+    renderChatList(chats, append = false) {
         const chatList = document.getElementById('chatList');
         if (!chatList) return;
 
-        chatList.innerHTML = '';
+        if (append) {
+            chatList.querySelector('.load-more-chats')?.remove();
+        } else {
+            chatList.innerHTML = '';
+        }
         
-        if (chats.length === 0) {
+        if (chats.length === 0 && !append) {
             chatList.innerHTML = '<li style="text-align: center; color: #c5aeff; font-style: italic;">No chats yet. Create your first chat!</li>';
             return;
         }
 
-        chats.forEach(chat => {
-            const li = document.createElement('li');
-            li.dataset.chatId = chat.chat_id;
-            li.onclick = () => this.selectChat(li);
-            
-            const date = new Date(chat.updated_at).toLocaleDateString();
-            li.innerHTML = `
-                <div style="display: flex; justify-content: space-between; align-items: center;">
-                    <span>${chat.title}</span>
-                    <small style="color: #8a63d2;">${date}</small>
-                </div>
-                <small style="color: #c5aeff; opacity: 0.7;">${chat.message_count} messages</small>
-            `;
-            
-            chatList.appendChild(li);
-        });
+        chats.forEach(chat => chatList.appendChild(this.createChatListItem(chat)));
+
+        if (this.nextChatCursor) {
+            const more = document.createElement('li');
+            more.className = 'load-more-chats';
+            more.style.cssText = 'text-align: center; color: #c5aeff; cursor: pointer;';
+            more.textContent = 'Load older chats';
+            more.onclick = () => this.loadChats(true);
+            chatList.appendChild(more);
+        }
+    }
+
+    createChatListItem(chat) {
+        const li = document.createElement('li');
+        li.dataset.chatId = chat.chat_id;
+        li.onclick = () => this.selectChat(li);
+        
+        const date = new Date(chat.updated_at).toLocaleDateString();
+        li.innerHTML = `
+            <div style="display: flex; justify-content: space-between; align-items: center;">
+                <span>${chat.title}</span>
+                <small style="color: #8a63d2;">${date}</small>
+            </div>
+            <small style="color: #c5aeff; opacity: 0.7;">${chat.message_count} messages</small>
+        `;
+        return li;
+    }
+
+    updateChatListItem(chat) {
+        // Pushed by the server: the chat moves to the top, as the most recently updated
+        const chatList = document.getElementById('chatList');
+        if (!chatList) return;
+        const previous = chatList.querySelector(`li[data-chat-id="${CSS.escape(chat.chat_id)}"]`);
+        const li = this.createChatListItem(chat);
+        if (previous?.classList.contains('selected-chat')) {
+            li.classList.add('selected-chat');
+        }
+        previous?.remove();
+        chatList.querySelector('li:not([data-chat-id]):not(.load-more-chats)')?.remove(); // "No chats yet"
+        chatList.prepend(li);
+
+        const cached = this.chatCache.get(chat.chat_id);
+        if (cached) cached.title = chat.title;
+        if (chat.chat_id === this.currentChatId) {
+            this.elements.chatTitle.textContent = chat.title;
+        }
+    }
+
+    removeChatListItem(chatId) {
+        document.querySelector(`#chatList li[data-chat-id="${CSS.escape(chatId)}"]`)?.remove();
+        this.chatCache.delete(chatId);
     }
 
     async selectChat(element) {
@@ -108,18 +167,37 @@ export class ChatManager {
         this.currentChatId = chatId;
         
         try {
-            const response = await fetch(`${this.apiBase}/chats/${chatId}`);
+            // Only fetch what is new for chats seen before, the last page otherwise
+            let cached = this.chatCache.get(chatId);
+            const query = cached ? `since=${cached.lastSeq}` : `limit=${this.messagePageSize}`;
+            const response = await fetch(`${this.apiBase}/chats/${chatId}?${query}`);
+            if (!response.ok) throw new Error(`HTTP ${response.status}`);
             const chatData = await response.json();
             
-            this.elements.chatTitle.textContent = chatData.title;
-            this.renderMessages(chatData.messages);
+            if (cached) {
+                cached.messages.push(...chatData.messages);
+                cached.title = chatData.title;
+                cached.lastSeq = chatData.last_seq;
+            } else {
+                cached = {
+                    title: chatData.title,
+                    messages: chatData.messages,
+                    lastSeq: chatData.last_seq,
+                    hasMore: chatData.has_more
+                };
+                this.chatCache.set(chatId, cached);
+            }
+            if (this.currentChatId !== chatId) return;
+            
+            this.elements.chatTitle.textContent = cached.title;
+            this.renderMessages(cached.messages, cached.hasMore);
         } catch (error) {
             console.error('Error loading chat:', error);
             this.showNotification('Failed to load chat', 'error');
         }
     }
 
-    renderMessages(messages) {
+    renderMessages(messages, hasMore = false) {
         this.elements.chatMessages.innerHTML = '';
         
         if (messages.length === 0) {
@@ -127,6 +205,9 @@ export class ChatManager {
             return;
         }
 
+        if (hasMore) {
+            this.elements.chatMessages.appendChild(this.createLoadOlderButton());
+        }
         messages.forEach(message => {
             this.addMessageToChat(message, false);
         });
@@ -134,7 +215,48 @@ export class ChatManager {
         this.scrollToBottom();
     }
 
-    addMessageToChat(message, animate = true) {
+    createLoadOlderButton() {
+        const button = document.createElement('div');
+        button.className = 'load-older-messages';
+        button.style.cssText = 'text-align: center; color: #c5aeff; cursor: pointer; padding: 8px;';
+        button.textContent = 'Load earlier messages';
+        button.onclick = () => this.loadOlderMessages();
+        return button;
+    }
+
+    async loadOlderMessages() {
+        const chatId = this.currentChatId;
+        const cached = this.chatCache.get(chatId);
+        if (!cached || !cached.hasMore || cached.messages.length === 0) return;
+
+        try {
+            const before = cached.messages[0].seq;
+            const response = await fetch(`${this.apiBase}/chats/${chatId}?before=${before}&limit=${this.messagePageSize}`);
+            if (!response.ok) throw new Error(`HTTP ${response.status}`);
+            const chatData = await response.json();
+
+            cached.messages.unshift(...chatData.messages);
+            cached.hasMore = chatData.has_more;
+            if (this.currentChatId !== chatId) return;
+
+            // Prepend without moving what the user is looking at
+            const container = this.elements.chatMessages;
+            const previousHeight = container.scrollHeight;
+            container.querySelector('.load-older-messages')?.remove();
+            const fragment = document.createDocumentFragment();
+            if (cached.hasMore) {
+                fragment.appendChild(this.createLoadOlderButton());
+            }
+            chatData.messages.forEach(message => fragment.appendChild(this.createMessageElement(message)));
+            container.insertBefore(fragment, container.firstChild);
+            container.scrollTop += container.scrollHeight - previousHeight;
+        } catch (error) {
+            console.error('Error loading older messages:', error);
+            this.showNotification('Failed to load older messages', 'error');
+        }
+    }
+
+    createMessageElement(message) {
         const messageDiv = document.createElement('div');
         messageDiv.className = `message ${message.role}`;
         
@@ -153,7 +275,11 @@ export class ChatManager {
         
         messageDiv.appendChild(headerDiv);
         messageDiv.appendChild(contentDiv);
-        
+        return messageDiv;
+    }
+
+    addMessageToChat(message, animate = true) {
+        const messageDiv = this.createMessageElement(message);
         this.elements.chatMessages.appendChild(messageDiv);
         
         if (animate) {
@@ -185,8 +311,10 @@ export class ChatManager {
 
         // Clear input
         this.elements.messageInput.value = '';
-        this.elements.sendButton.disabled = true;
+        this.elements.sendButton.textContent = '⏹';
+        this.elements.sendButton.title = 'Stop';
         this.isStreaming = true;
+        this.abortController = new AbortController();
 
         try {
             const requestBody = {
@@ -196,33 +324,45 @@ export class ChatManager {
                 stream: isStreaming
             };
 
-            if (isStreaming) {
+            if (isStreaming && this.channel.isOpen) {
+                await this.handleChannelResponse(requestBody);
+            } else if (isStreaming) {
                 await this.handleStreamingResponse(requestBody);
             } else {
                 await this.handleNormalResponse(requestBody);
             }
         } catch (error) {
-            console.error('Error sending message:', error);
-            this.showNotification('Failed to send message', 'error');
+            if (error.name === 'AbortError') {
+                this.showNotification('Generation stopped', 'info');
+            } else {
+                console.error('Error sending message:', error);
+                this.showNotification('Failed to send message', 'error');
+            }
         } finally {
-            this.elements.sendButton.disabled = false;
+            this.elements.sendButton.textContent = '📤';
+            this.elements.sendButton.title = 'Send Message';
             this.isStreaming = false;
+            this.abortController = null;
         }
     }
 
-    async handleStreamingResponse(requestBody) {
-        const response = await fetch(`${this.apiBase}/chat`, {
-            method: 'POST',
-            headers: {
-                'Content-Type': 'application/json',
-            },
-            body: JSON.stringify(requestBody)
-        });
-
-        if (!response.ok) {
-            throw new Error('Failed to send message');
+    async stopGeneration() {
+        if (this.channelRequestId) {
+            this.channel.cancel(this.channelRequestId);
+            return;
+        }
+        // Tell the server first so the model stops even if the abort is not noticed
+        if (this.currentChatId) {
+            try {
+                await fetch(`${this.apiBase}/chat/${this.currentChatId}/cancel`, { method: 'POST' });
+            } catch (error) {
+                console.error('Error cancelling generation:', error);
+            }
         }
+        this.abortController?.abort();
+    }
 
+    createStreamingMessage() {
         // Create assistant message container
         const assistantMessageDiv = document.createElement('div');
         assistantMessageDiv.className = 'message assistant';
@@ -243,18 +383,38 @@ export class ChatManager {
         typingDiv.className = 'typing-indicator active';
         typingDiv.textContent = 'AI is typing...';
         this.elements.chatMessages.appendChild(typingDiv);
+        return { contentDiv, typingDiv };
+    }
+
+    async handleStreamingResponse(requestBody) {
+        const response = await fetch(`${this.apiBase}/chat`, {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+            },
+            body: JSON.stringify(requestBody),
+            signal: this.abortController?.signal
+        });
 
+        if (!response.ok) {
+            throw new Error('Failed to send message');
+        }
+
+        const { contentDiv, typingDiv } = this.createStreamingMessage();
         const reader = response.body.getReader();
         const decoder = new TextDecoder();
         let assistantContent = '';
+        let buffer = '';
 
         try {
             while (true) {
                 const { done, value } = await reader.read();
                 if (done) break;
 
-                const chunk = decoder.decode(value);
-                const lines = chunk.split('\n');
+                // Keep the trailing partial line until the next chunk arrives
+                buffer += decoder.decode(value, { stream: true });
+                const lines = buffer.split('\n');
+                buffer = lines.pop();
 
                 for (const line of lines) {
                     if (line.startsWith('data: ')) {
@@ -263,13 +423,19 @@ export class ChatManager {
 
                         try {
                             const parsed = JSON.parse(data);
+                            if (parsed.chat_id) {
+                                this.currentChatId = parsed.chat_id;
+                            }
+                            if (parsed.queued) {
+                                typingDiv.textContent = `Waiting for the AI (position ${parsed.position} in queue)...`;
+                            }
                             if (parsed.content) {
+                                typingDiv.textContent = 'AI is typing...';
                                 assistantContent += parsed.content;
                                 contentDiv.innerHTML = marked(assistantContent);
                                 this.scrollToBottom();
                             }
-                            if (parsed.done) {
-                                this.currentChatId = parsed.chat_id;
+                            if (parsed.done || parsed.cancelled) {
                                 break;
                             }
                         } catch (e) {
@@ -284,13 +450,54 @@ export class ChatManager {
         }
     }
 
+    handleChannelResponse(requestBody) {
+        const { contentDiv, typingDiv } = this.createStreamingMessage();
+        let assistantContent = '';
+
+        return new Promise((resolve, reject) => {
+            const finish = () => {
+                this.channelRequestId = null;
+                typingDiv.remove();
+                this.scrollToBottom();
+            };
+            this.channelRequestId = this.channel.generate(requestBody, {
+                onStarted: (chatId) => {
+                    this.currentChatId = chatId;
+                },
+                onQueued: (position) => {
+                    typingDiv.textContent = `Waiting for the AI (position ${position} in queue)...`;
+                },
+                onToken: (content) => {
+                    typingDiv.textContent = 'AI is typing...';
+                    assistantContent += content;
+                    contentDiv.innerHTML = marked(assistantContent);
+                    this.scrollToBottom();
+                },
+                onDone: () => {
+                    finish();
+                    resolve();
+                },
+                onCancelled: () => {
+                    finish();
+                    this.showNotification('Generation stopped', 'info');
+                    resolve();
+                },
+                onError: (error) => {
+                    finish();
+                    reject(new Error(error));
+                }
+            });
+        });
+    }
+
     async handleNormalResponse(requestBody) {
         const response = await fetch(`${this.apiBase}/chat`, {
             method: 'POST',
             headers: {
                 'Content-Type': 'application/json',
             },
-            body: JSON.stringify(requestBody)
+            body: JSON.stringify(requestBody),
+            signal: this.abortController?.signal
         });
 
         if (!response.ok) {
@@ -343,6 +550,7 @@ export class ChatManager {
                 throw new Error('Failed to delete chat');
             }
 
+            this.chatCache.delete(this.currentChatId);
             this.currentChatId = null;
             this.elements.chatTitle.textContent = 'AI Assistant';
             this.elements.chatMessages.innerHTML = '<div class="welcome-message"><p>Welcome to JennyLab AI Chat! Start a conversation with the AI assistant.</p></div>';
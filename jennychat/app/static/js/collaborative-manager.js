@@ -2,6 +2,8 @@ export class CollaborativeManager {
     constructor() {
         this.socket = null;
         this.currentRoom = null;
+        this.oldestSeq = null;
+        this.aiAnswers = new Map();  // requestId -> element being streamed
         this.username = localStorage.getItem('collaborative_username') || '';
         this.userId = this.generateUserId();
         this.reconnectAttempts = 0;
@@ -173,6 +175,15 @@ export class CollaborativeManager {
             case 'new_message':
                 this.addCollaborativeMessage(data.message);
                 break;
+            case 'ai_started':
+                this.handleAiStarted(data);
+                break;
+            case 'ai_token':
+                this.handleAiToken(data);
+                break;
+            case 'ai_done':
+                this.handleAiDone(data);
+                break;
             case 'user_joined':
                 this.handleUserJoined(data);
                 break;
@@ -185,6 +196,9 @@ export class CollaborativeManager {
             case 'room_created':
                 this.handleRoomCreated(data);
                 break;
+            case 'history':
+                this.handleHistory(data);
+                break;
             case 'error':
                 this.showNotification(data.message, 'error');
                 break;
@@ -256,7 +270,12 @@ export class CollaborativeManager {
         this.elements.collaborativeChatTitle.textContent = `${data.room.private ? '🔒' : '🌐'} ${data.room.name}`;
         
         this.elements.collaborativeMessages.innerHTML = '';
+        this.aiAnswers.clear();
+        this.oldestSeq = data.messages && data.messages.length > 0 ? data.messages[0].seq : null;
         if (data.messages && data.messages.length > 0) {
+            if (data.has_more) {
+                this.elements.collaborativeMessages.appendChild(this.createLoadHistoryButton());
+            }
             data.messages.forEach(message => {
                 this.addCollaborativeMessage(message, false);
             });
@@ -288,6 +307,7 @@ export class CollaborativeManager {
 
     handleRoomLeft() {
         this.currentRoom = null;
+        this.aiAnswers.clear();
         this.elements.collaborativeChatTitle.textContent = 'Select a Room';
         this.elements.userCount.textContent = '0 users';
         this.elements.collaborativeMessages.innerHTML = `
@@ -304,15 +324,92 @@ export class CollaborativeManager {
         if (!message || !this.currentRoom) return;
 
         if (this.socket && this.socket.readyState === WebSocket.OPEN) {
+            // "@jenny ..." posts the message and asks the AI to answer the room
             this.socket.send(JSON.stringify({
-                type: 'send_message',
+                type: /^@jenny\b/i.test(message) ? 'ask_ai' : 'send_message',
                 message: message
             }));
             this.elements.collaborativeMessageInput.value = '';
         }
     }
 
-    addCollaborativeMessage(message, animate = true) {
+    handleAiStarted(data) {
+        if (!this.currentRoom || data.roomId !== this.currentRoom.id) return;
+        const element = this.createCollaborativeMessageElement({
+            userId: 'jenny',
+            username: 'Jenny',
+            content: '',
+            timestamp: new Date().toISOString()
+        });
+        element.classList.add('streaming');
+        this.aiAnswers.set(data.requestId, element);
+        this.elements.collaborativeMessages.appendChild(element);
+        this.scrollCollaborativeToBottom();
+    }
+
+    handleAiToken(data) {
+        const element = this.aiAnswers.get(data.requestId);
+        if (!element) return;
+        element.querySelector('.message-content').textContent += data.content;
+        this.scrollCollaborativeToBottom();
+    }
+
+    handleAiDone(data) {
+        const element = this.aiAnswers.get(data.requestId);
+        if (data.error) {
+            this.showNotification(data.error, 'error');
+        }
+        if (element && data.content !== undefined) {
+            // Tokens may have been dropped on the way if this client fell behind
+            element.querySelector('.message-content').textContent = data.content;
+        }
+        if (element && !element.querySelector('.message-content').textContent) {
+            element.remove();
+            this.aiAnswers.delete(data.requestId);
+        }
+        // Otherwise kept until the stored message replaces it (new_message)
+    }
+
+    createLoadHistoryButton() {
+        const button = document.createElement('div');
+        button.className = 'load-room-history';
+        button.style.cssText = 'text-align: center; color: #c5aeff; cursor: pointer; padding: 8px;';
+        button.textContent = 'Load earlier messages';
+        button.onclick = () => this.loadHistory();
+        return button;
+    }
+
+    loadHistory() {
+        if (!this.currentRoom || !this.oldestSeq) return;
+
+        if (this.socket && this.socket.readyState === WebSocket.OPEN) {
+            this.socket.send(JSON.stringify({
+                type: 'load_history',
+                before: this.oldestSeq
+            }));
+        }
+    }
+
+    handleHistory(data) {
+        if (!this.currentRoom || data.roomId !== this.currentRoom.id) return;
+
+        // Prepend without moving what the user is looking at
+        const container = this.elements.collaborativeMessages;
+        const previousHeight = container.scrollHeight;
+        container.querySelector('.load-room-history')?.remove();
+        const fragment = document.createDocumentFragment();
+        if (data.has_more) {
+            fragment.appendChild(this.createLoadHistoryButton());
+        }
+        data.messages.forEach(message => fragment.appendChild(this.createCollaborativeMessageElement(message)));
+        container.insertBefore(fragment, container.firstChild);
+        container.scrollTop += container.scrollHeight - previousHeight;
+        if (data.messages.length > 0) {
+            this.oldestSeq = data.messages[0].seq;
+        }
+    }
+
+    createCollaborativeMessageElement(message) {
         const messageDiv = document.createElement('div');
         messageDiv.className = `collaborative-message ${message.userId === this.userId ? 'own' : 'other'}`;
         
@@ -325,7 +422,18 @@ export class CollaborativeManager {
             </div>
             <div class="message-content">${this.escapeHtml(message.content)}</div>
         `;
-        
+        return messageDiv;
+    }
+
+    addCollaborativeMessage(message, animate = true) {
+        const messageDiv = this.createCollaborativeMessageElement(message);
+        const streamed = message.requestId && this.aiAnswers.get(message.requestId);
+        if (streamed) {
+            // The AI answer was already shown while it streamed
+            this.aiAnswers.delete(message.requestId);
+            streamed.replaceWith(messageDiv);
+            return;
+        }
         this.elements.collaborativeMessages.appendChild(messageDiv);
         
         if (animate) {
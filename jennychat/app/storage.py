@@ -0,0 +1,414 @@
+"""Persistence backends for chat sessions.
+
+A store keeps a catalog (one metadata record per chat) plus the messages of
+each chat. The registry in ``app.sessions`` reads the catalog at startup
+and loads messages lazily, the first time a chat is touched.
+"""
+import asyncio
+import json
+import logging
+import os
+import re
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+from app.conf import *
+
+try:
+    import fcntl
+except ImportError:  # Windows: a single worker, nothing to coordinate
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+_CHAT_ID_RE = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+
+class SessionStore:
+    """Interface for chat session persistence"""
+
+    durable = False  # whether load_messages returns everything that was appended
+
+    async def start(self):
+        pass
+
+    async def close(self):
+        pass
+
+    def catalog(self) -> Dict[str, dict]:
+        """Metadata of every stored chat, keyed by chat_id"""
+        return {}
+
+    async def load_messages(self, chat_id: str) -> Optional[List[dict]]:
+        """Messages of a stored chat, or None if it is unknown"""
+        return None
+
+    async def load_range(self, chat_id: str, start: int, end: int) -> List[dict]:
+        """Messages ``start`` to ``end`` (0-based, end excluded) of a stored chat"""
+        return (await self.load_messages(chat_id) or [])[start:end]
+
+    def save_meta(self, meta: dict):
+        """Record new or changed chat metadata"""
+
+    def append_message(self, chat_id: str, message: dict):
+        """Record one new message of a chat"""
+
+    def delete(self, chat_id: str):
+        """Forget a chat and its messages"""
+
+    def observe_meta(self, meta: dict):
+        """Metadata that another worker process has already written"""
+
+    def observe_delete(self, chat_id: str):
+        """A chat that another worker process has already deleted"""
+
+    async def flush(self):
+        """Persist everything that is still buffered"""
+
+    async def compact(self):
+        """Reclaim space used by superseded records"""
+
+
+class MemorySessionStore(SessionStore):
+    """Keeps nothing: sessions only live in the registry and die with the process"""
+
+
+class JsonlSessionStore(SessionStore):
+    """Append-only JSONL files with batched write-behind.
+
+    Layout of the history directory::
+
+        catalog.jsonl      one metadata record per change, last one wins
+        <chat_id>.jsonl    one line per message, only ever appended to
+
+    Mutations are buffered in memory and written by a background task every
+    ``flush_interval`` seconds, off the request path. Appending a message
+    costs one line in the chat file; metadata updates to the same chat
+    within a batch collapse into a single catalog line. ``compact`` rewrites
+    the catalog once it holds many superseded records. ``load_range`` seeks
+    through a sparse index of line offsets instead of reading whole files.
+
+    Several worker processes may append to the same files; only the one for
+    which ``is_leader()`` is true compacts the catalog. Catalog appends and
+    the rewrite hold a lock on the file, so no worker's records are lost
+    when it is replaced.
+    """
+
+    durable = True
+    CATALOG_FILE = "catalog.jsonl"
+    INDEX_STRIDE = 256  # lines between two indexed offsets
+
+    def __init__(self, directory: Path, flush_interval: float = 0.5, compact_interval: float = 600.0,
+                 is_leader: Callable[[], bool] = lambda: True):
+        self.directory = Path(directory)
+        self.is_leader = is_leader
+        self.flush_interval = flush_interval
+        self.compact_interval = compact_interval
+        self._catalog: Dict[str, dict] = {}
+        self._catalog_lines = 0
+        self._pending_meta: Dict[str, dict] = {}
+        self._pending_messages: Dict[str, List[dict]] = {}
+        self._pending_deletes: set = set()
+        self._offsets: Dict[str, List[int]] = {}  # chat_id -> offset of every INDEX_STRIDE-th line
+        self._lines: Dict[str, int] = {}  # chat_id -> lines on disk, for indexed files
+        self._indexed: Dict[str, int] = {}  # chat_id -> bytes covered by the index
+        self._io_lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._tasks: List[asyncio.Task] = []
+        self._closing = False
+
+    # Lifecycle
+
+    async def start(self):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._io_lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        # Only the catalog is read up front, never the chat files
+        self._catalog, self._catalog_lines = await asyncio.to_thread(self._read_catalog)
+        self._closing = False
+        self._tasks = [
+            asyncio.create_task(self._flush_loop()),
+            asyncio.create_task(self._compact_loop()),
+        ]
+
+    async def close(self):
+        self._closing = True
+        self._wakeup.set()
+        flush_task, compact_task = self._tasks or (None, None)
+        self._tasks = []
+        if compact_task is not None:
+            compact_task.cancel()
+            try:
+                await compact_task
+            except asyncio.CancelledError:
+                pass
+        if flush_task is not None:
+            # Let the writer drain on its own rather than cancelling a write
+            await flush_task
+        await self.flush()
+
+    # Reads
+
+    def catalog(self) -> Dict[str, dict]:
+        return dict(self._catalog)
+
+    async def load_messages(self, chat_id: str) -> Optional[List[dict]]:
+        if chat_id not in self._catalog:
+            return None
+        async with self._io_lock:
+            messages = await asyncio.to_thread(self._read_chat, chat_id)
+            # Buffered messages are not on disk yet
+            messages.extend(self._pending_messages.get(chat_id, []))
+        return messages
+
+    async def load_range(self, chat_id: str, start: int, end: int) -> List[dict]:
+        if chat_id not in self._catalog or end <= start:
+            return []
+        async with self._io_lock:
+            if chat_id not in self._offsets or end > self._lines[chat_id]:
+                # Also picks up lines appended by other workers
+                await asyncio.to_thread(self._index_chat, chat_id)
+            on_disk = self._lines[chat_id]
+            messages = []
+            if start < on_disk:
+                messages = await asyncio.to_thread(self._read_range, chat_id, start, min(end, on_disk))
+            if end > on_disk:
+                pending = self._pending_messages.get(chat_id, [])
+                messages.extend(pending[max(start - on_disk, 0):end - on_disk])
+        return messages
+
+    # Buffered writes
+
+    def save_meta(self, meta: dict):
+        chat_id = meta["chat_id"]
+        self._catalog[chat_id] = meta
+        self._pending_meta[chat_id] = meta
+        self._pending_deletes.discard(chat_id)
+        self._wakeup.set()
+
+    def append_message(self, chat_id: str, message: dict):
+        self._pending_messages.setdefault(chat_id, []).append(message)
+        self._wakeup.set()
+
+    def delete(self, chat_id: str):
+        self._catalog.pop(chat_id, None)
+        self._pending_meta.pop(chat_id, None)
+        self._pending_messages.pop(chat_id, None)
+        self._forget_index(chat_id)
+        self._pending_deletes.add(chat_id)
+        self._wakeup.set()
+
+    def observe_meta(self, meta: dict):
+        self._catalog[meta["chat_id"]] = meta
+
+    def observe_delete(self, chat_id: str):
+        self._catalog.pop(chat_id, None)
+        self._pending_meta.pop(chat_id, None)
+        self._pending_messages.pop(chat_id, None)
+        self._forget_index(chat_id)
+
+    def _forget_index(self, chat_id: str):
+        self._offsets.pop(chat_id, None)
+        self._lines.pop(chat_id, None)
+        self._indexed.pop(chat_id, None)
+
+    async def flush(self):
+        async with self._io_lock:
+            if not (self._pending_meta or self._pending_messages or self._pending_deletes):
+                return
+            meta, self._pending_meta = self._pending_meta, {}
+            messages, self._pending_messages = self._pending_messages, {}
+            deletes, self._pending_deletes = self._pending_deletes, set()
+            await asyncio.to_thread(self._write_batch, meta, messages, deletes)
+
+    async def compact(self):
+        async with self._io_lock:
+            # Superseded records only matter once they dominate the catalog
+            if not self.is_leader() or self._catalog_lines <= 2 * len(self._catalog) + 100:
+                return
+            self._catalog_lines = await asyncio.to_thread(self._rewrite_catalog)
+
+    # Background jobs
+
+    async def _flush_loop(self):
+        while True:
+            await self._wakeup.wait()
+            if not self._closing:
+                # Let more mutations pile up so they share one write
+                await asyncio.sleep(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Failed to flush chat history")
+            if self._closing:
+                return
+
+    async def _compact_loop(self):
+        while not self._closing:
+            await asyncio.sleep(self.compact_interval)
+            try:
+                await self.compact()
+            except Exception:
+                logger.exception("Failed to compact chat history")
+
+    # File I/O (runs in a worker thread)
+
+    def _chat_path(self, chat_id: str) -> Path:
+        if not _CHAT_ID_RE.match(chat_id):
+            raise ValueError(f"Invalid chat id: {chat_id!r}")
+        return self.directory / f"{chat_id}.jsonl"
+
+    @staticmethod
+    def _read_lines(path: Path):
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    # Torn write from a crash, skip it
+                    logger.warning("Skipping corrupt record in %s", path)
+
+    def _read_catalog(self):
+        catalog: Dict[str, dict] = {}
+        lines = 0
+        path = self.directory / self.CATALOG_FILE
+        if not path.exists():
+            return catalog, lines
+        for record in self._read_lines(path):
+            lines += 1
+            chat_id = record.get("chat_id")
+            if not chat_id:
+                continue
+            if record.get("deleted"):
+                catalog.pop(chat_id, None)
+            else:
+                catalog[chat_id] = record
+        return catalog, lines
+
+    def _read_chat(self, chat_id: str) -> List[dict]:
+        path = self._chat_path(chat_id)
+        if not path.exists():
+            return []
+        return list(self._read_lines(path))
+
+    def _index_chat(self, chat_id: str):
+        """Index the chat file, continuing from where the last pass stopped"""
+        offsets = self._offsets.get(chat_id, [])
+        lines = self._lines.get(chat_id, 0)
+        offset = self._indexed.get(chat_id, 0)
+        path = self._chat_path(chat_id)
+        if path.exists():
+            with open(path, "rb") as f:
+                f.seek(offset)
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break  # still being written
+                    if lines % self.INDEX_STRIDE == 0:
+                        offsets.append(offset)
+                    offset += len(line)
+                    lines += 1
+        self._offsets[chat_id] = offsets
+        self._lines[chat_id] = lines
+        self._indexed[chat_id] = offset
+
+    def _read_range(self, chat_id: str, start: int, end: int) -> List[dict]:
+        block = start // self.INDEX_STRIDE
+        messages = []
+        with open(self._chat_path(chat_id), "rb") as f:
+            f.seek(self._offsets[chat_id][block])
+            for number, line in enumerate(f, block * self.INDEX_STRIDE):
+                if number >= end:
+                    break
+                if number >= start:
+                    try:
+                        messages.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        logger.warning("Skipping corrupt record in %s", chat_id)
+        return messages
+
+    def _write_batch(self, meta: Dict[str, dict], messages: Dict[str, List[dict]], deletes: set):
+        for chat_id, records in messages.items():
+            lines = [(json.dumps(r) + "\n").encode("utf-8") for r in records]
+            with open(self._chat_path(chat_id), "ab") as f:
+                offsets = self._offsets.get(chat_id)
+                if offsets is not None and f.tell() == self._indexed[chat_id]:
+                    # Keep the sparse index of this file current
+                    offset = f.tell()
+                    count = self._lines[chat_id]
+                    for line in lines:
+                        if count % self.INDEX_STRIDE == 0:
+                            offsets.append(offset)
+                        offset += len(line)
+                        count += 1
+                    self._lines[chat_id] = count
+                    self._indexed[chat_id] = offset
+                f.write(b"".join(lines))
+
+        catalog_records = list(meta.values())
+        catalog_records.extend({"chat_id": chat_id, "deleted": True} for chat_id in deletes)
+        if catalog_records:
+            with self._locked_catalog() as f:
+                f.write("".join(json.dumps(r) + "\n" for r in catalog_records))
+                f.flush()
+                os.fsync(f.fileno())
+            self._catalog_lines += len(catalog_records)
+
+        for chat_id in deletes:
+            try:
+                self._chat_path(chat_id).unlink()
+            except FileNotFoundError:
+                pass
+
+    @contextmanager
+    def _locked_catalog(self):
+        """The catalog opened for appending, locked against every other worker"""
+        path = self.directory / self.CATALOG_FILE
+        while True:
+            f = open(path, "a", encoding="utf-8")
+            if fcntl is None:
+                break
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                if os.fstat(f.fileno()).st_ino == os.stat(path).st_ino:
+                    break
+            except FileNotFoundError:
+                pass
+            f.close()  # replaced by a compaction while waiting for the lock
+        try:
+            yield f
+        finally:
+            f.close()  # releases the lock
+
+    def _rewrite_catalog(self) -> int:
+        """Rewrite the catalog with one record per chat; returns its line count"""
+        path = self.directory / self.CATALOG_FILE
+        tmp = path.with_suffix(".jsonl.tmp")
+        with self._locked_catalog():
+            # Read under the lock, so records other workers appended are kept
+            catalog, _ = self._read_catalog()
+            with open(tmp, "w", encoding="utf-8") as f:
+                f.write("".join(json.dumps(r) + "\n" for r in catalog.values()))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, path)
+        return len(catalog)
+
+
+def create_session_store(directory: str = CHAT_HISTORY_DIR,
+                         is_leader: Callable[[], bool] = lambda: True) -> SessionStore:
+    """Build the store selected by CHAT_STORE_BACKEND"""
+    if CHAT_STORE_BACKEND == "memory":
+        return MemorySessionStore()
+    if CHAT_STORE_BACKEND == "jsonl":
+        return JsonlSessionStore(
+            directory,
+            flush_interval=CHAT_STORE_FLUSH_INTERVAL,
+            compact_interval=CHAT_STORE_COMPACT_INTERVAL,
+            is_leader=is_leader,
+        )
+    raise ValueError(f"Unknown CHAT_STORE_BACKEND: {CHAT_STORE_BACKEND!r}")
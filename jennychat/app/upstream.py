@@ -0,0 +1,320 @@
+"""Connections to the LLama-Cpp Server backends.
+
+Every backend has one pooled keep-alive client, created when the app starts.
+``BackendPool`` routes chat requests to the least loaded healthy backend,
+keeps a chat on the same backend while it can (its prompt is cached there)
+and ejects or re-admits backends based on background health probes.
+"""
+import asyncio
+import logging
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, List, Optional, Set
+
+import httpx
+
+from app.conf import *
+
+logger = logging.getLogger(__name__)
+
+def _http2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def create_llama_client(base_url: str = LLAMA_CPP_SERVER_URL) -> httpx.AsyncClient:
+    """Build a pooled keep-alive client for LLama-Cpp Server"""
+    http2 = LLAMA_CPP_HTTP2
+    if http2 and not _http2_available():
+        logger.warning("LLAMA_CPP_HTTP2 is enabled but the 'h2' package is not installed, using HTTP/1.1")
+        http2 = False
+
+    return httpx.AsyncClient(
+        base_url=base_url,
+        http2=http2,
+        limits=httpx.Limits(
+            max_connections=LLAMA_CPP_MAX_CONNECTIONS,
+            max_keepalive_connections=LLAMA_CPP_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=LLAMA_CPP_KEEPALIVE_EXPIRY,
+        ),
+        timeout=httpx.Timeout(
+            LLAMA_CPP_READ_TIMEOUT,
+            connect=LLAMA_CPP_CONNECT_TIMEOUT,
+            pool=LLAMA_CPP_POOL_TIMEOUT,
+        ),
+    )
+
+
+class SlotAffinity:
+    """Pins each chat to a llama-server slot so its cached prompt is reused.
+
+    Chats get a stable ``id_slot`` with least-recently-used reassignment once
+    every slot is taken. A chat whose slot is busy with another request is
+    sent with ``id_slot=-1`` so it does not queue behind it; llama-server
+    then picks the idle slot with the best prefix match on its own. If the
+    server rejects the hints they are dropped for the rest of the process.
+    """
+
+    def __init__(self, slots: int = 1, enabled: bool = True):
+        self.slots = max(1, slots)
+        self.enabled = enabled
+        self._assigned: "OrderedDict[str, int]" = OrderedDict()
+        self._busy: Set[int] = set()
+
+    async def discover(self, client: httpx.AsyncClient):
+        """Read the slot count from llama-server's /props"""
+        try:
+            response = await client.get("/props", timeout=5.0)
+            if response.status_code == 200:
+                self.slots = max(1, int(response.json().get("total_slots", self.slots)))
+        except (httpx.HTTPError, ValueError, TypeError):
+            logger.info("Could not read slot count from LLama-Cpp Server, assuming %d", self.slots)
+
+    def acquire(self, chat_id: str) -> int:
+        """Slot to request for this chat, -1 when it should go to any slot"""
+        slot = self._assigned.get(chat_id)
+        if slot is not None:
+            self._assigned.move_to_end(chat_id)
+        else:
+            if len(self._assigned) < self.slots:
+                taken = set(self._assigned.values())
+                slot = next(s for s in range(self.slots) if s not in taken)
+            else:
+                _, slot = self._assigned.popitem(last=False)
+            self._assigned[chat_id] = slot
+
+        if slot in self._busy:
+            return -1
+        self._busy.add(slot)
+        return slot
+
+    def release(self, slot: int):
+        self._busy.discard(slot)
+
+    def forget(self, chat_id: str):
+        self._assigned.pop(chat_id, None)
+
+    def apply(self, payload: dict, slot: int) -> dict:
+        """Add prompt cache hints to a completion request"""
+        if self.enabled:
+            payload["cache_prompt"] = True
+            payload["id_slot"] = slot
+        return payload
+
+    def rejected(self, response: httpx.Response, payload: dict) -> bool:
+        """True if the server refused the hints; they are stripped from payload"""
+        if not self.enabled or "id_slot" not in payload or response.status_code not in (400, 422):
+            return False
+        body = response.text.lower()
+        if "slot" not in body and "cache_prompt" not in body:
+            return False
+        logger.warning("LLama-Cpp Server rejected cache_prompt/id_slot, disabling slot affinity")
+        self.enabled = False
+        payload.pop("cache_prompt", None)
+        payload.pop("id_slot", None)
+        return True
+
+
+class LlamaBackend:
+    """One llama-server process: its client, slot map, load and health"""
+
+    def __init__(self, url: str):
+        self.url = url.rstrip("/")
+        self.client: Optional[httpx.AsyncClient] = None
+        self.slots = SlotAffinity(LLAMA_CPP_SLOTS, enabled=LLAMA_CPP_SLOT_AFFINITY)
+        self.outstanding = 0
+        self.healthy = True
+        self.failures = 0
+        self.models: List[dict] = []
+
+    async def start(self):
+        if self.client is None:
+            self.client = create_llama_client(self.url)
+        await self.slots.discover(self.client)
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    def record_success(self):
+        if not self.healthy:
+            logger.info("LLama-Cpp backend %s is back, re-admitting it", self.url)
+        self.healthy = True
+        self.failures = 0
+
+    def record_failure(self):
+        self.failures += 1
+        if self.healthy and self.failures >= LLAMA_CPP_EJECT_AFTER_FAILURES:
+            logger.warning("LLama-Cpp backend %s failed %d times, ejecting it", self.url, self.failures)
+            self.healthy = False
+
+    async def probe(self):
+        """Check /health and refresh the model list from /v1/models"""
+        try:
+            health = await self.client.get("/health", timeout=LLAMA_CPP_HEALTH_TIMEOUT)
+            # 503 means the model is still loading
+            if health.status_code != 200:
+                self.record_failure()
+                return
+            response = await self.client.get("/v1/models", timeout=LLAMA_CPP_HEALTH_TIMEOUT)
+            if response.status_code != 200:
+                self.record_failure()
+                return
+            self.models = response.json().get("data", [])
+        except (httpx.HTTPError, ValueError):
+            self.record_failure()
+            return
+        self.record_success()
+
+
+class Lease:
+    """A backend (and slot) reserved for one chat completion"""
+
+    def __init__(self, backend: LlamaBackend, chat_id: Optional[str]):
+        self.backend = backend
+        self.client = backend.client
+        self.slot = backend.slots.acquire(chat_id) if chat_id else -1
+
+    def apply(self, payload: dict) -> dict:
+        return self.backend.slots.apply(payload, self.slot)
+
+
+class BackendPool:
+    """Least-outstanding-requests routing with session stickiness"""
+
+    def __init__(self, urls: List[str]):
+        self.backends = [LlamaBackend(url) for url in urls]
+        self._sticky: "OrderedDict[str, LlamaBackend]" = OrderedDict()
+        self._next = 0
+        self._health_task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        await asyncio.gather(*(b.start() for b in self.backends))
+        if len(self.backends) > 1:
+            await asyncio.gather(*(b.probe() for b in self.backends))
+        self._health_task = asyncio.create_task(self._health_loop())
+
+    async def close(self):
+        if self._health_task is not None:
+            self._health_task.cancel()
+            try:
+                await self._health_task
+            except asyncio.CancelledError:
+                pass
+            self._health_task = None
+        await asyncio.gather(*(b.close() for b in self.backends))
+
+    async def _health_loop(self):
+        while True:
+            await asyncio.sleep(LLAMA_CPP_HEALTH_INTERVAL)
+            await asyncio.gather(*(b.probe() for b in self.backends))
+
+    def total_slots(self) -> int:
+        """Generation slots across every backend"""
+        return sum(b.slots.slots for b in self.backends)
+
+    def healthy(self) -> List[LlamaBackend]:
+        """Backends currently admitted, or all of them if every one is down"""
+        return [b for b in self.backends if b.healthy] or self.backends
+
+    def pick(self, chat_id: Optional[str] = None) -> LlamaBackend:
+        """Backend for a request, without reserving it"""
+        candidates = self.healthy()
+        least = min(b.outstanding for b in candidates)
+
+        sticky = self._sticky.get(chat_id) if chat_id else None
+        if sticky is not None and sticky in candidates \
+                and sticky.outstanding - least <= LLAMA_CPP_STICKY_MAX_IMBALANCE:
+            self._sticky.move_to_end(chat_id)
+            return sticky
+
+        # Round-robin between equally loaded backends
+        idle = [b for b in candidates if b.outstanding == least]
+        self._next = (self._next + 1) % len(idle)
+        backend = idle[self._next]
+        if chat_id:
+            if sticky is not None:
+                sticky.slots.forget(chat_id)
+            self._sticky[chat_id] = backend
+            self._sticky.move_to_end(chat_id)
+            if len(self._sticky) > LLAMA_CPP_STICKY_SESSIONS:
+                self._sticky.popitem(last=False)
+        return backend
+
+    @asynccontextmanager
+    async def lease(self, chat_id: Optional[str] = None) -> AsyncIterator[Lease]:
+        """Reserve the best backend for one completion"""
+        backend = self.pick(chat_id)
+        lease = Lease(backend, chat_id)
+        backend.outstanding += 1
+        try:
+            yield lease
+        except httpx.TransportError:
+            backend.record_failure()
+            raise
+        finally:
+            backend.outstanding -= 1
+            backend.slots.release(lease.slot)
+
+    def forget(self, chat_id: str):
+        backend = self._sticky.pop(chat_id, None)
+        if backend is not None:
+            backend.slots.forget(chat_id)
+
+    async def list_models(self) -> List[dict]:
+        """Models of every healthy backend, merged by id"""
+        async def fetch(backend: LlamaBackend) -> List[dict]:
+            try:
+                response = await backend.client.get("/v1/models", timeout=10.0)
+                if response.status_code == 200:
+                    backend.models = response.json().get("data", [])
+            except (httpx.HTTPError, ValueError):
+                pass
+            return backend.models
+
+        merged: Dict[str, dict] = {}
+        for models in await asyncio.gather(*(fetch(b) for b in self.healthy())):
+            for model in models:
+                merged.setdefault(model.get("id"), model)
+        return list(merged.values())
+
+
+backend_pool = BackendPool(LLAMA_CPP_SERVER_URLS)
+
+
+def get_llama_client(chat_id: Optional[str] = None) -> httpx.AsyncClient:
+    """Client of the backend a chat is routed to, for auxiliary calls"""
+    return backend_pool.pick(chat_id).client
+
+
+def _request_headers(request_id: Optional[str]) -> Optional[Dict[str, str]]:
+    """Tags the upstream request so its llama-server log lines can be matched"""
+    return {REQUEST_ID_HEADER: request_id} if request_id else None
+
+
+async def post_completion(lease: Lease, payload: dict, request_id: Optional[str] = None) -> httpx.Response:
+    """POST /v1/chat/completions, retrying once without rejected cache hints"""
+    headers = _request_headers(request_id)
+    response = await lease.client.post("/v1/chat/completions", json=lease.apply(payload), headers=headers)
+    if lease.backend.slots.rejected(response, payload):
+        response = await lease.client.post("/v1/chat/completions", json=payload, headers=headers)
+    return response
+
+
+async def open_completion_stream(lease: Lease, payload: dict, request_id: Optional[str] = None) -> httpx.Response:
+    """Start a streaming completion; the caller must ``aclose()`` the response"""
+    client = lease.client
+    headers = _request_headers(request_id)
+    request = client.build_request("POST", "/v1/chat/completions", json=lease.apply(payload), headers=headers)
+    response = await client.send(request, stream=True)
+    if response.status_code in (400, 422):
+        await response.aread()
+    if lease.backend.slots.rejected(response, payload):
+        await response.aclose()
+        request = client.build_request("POST", "/v1/chat/completions", json=payload, headers=headers)
+        response = await client.send(request, stream=True)
+    return response
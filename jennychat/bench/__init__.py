@@ -0,0 +1 @@
+"""Load benchmarks for JennyChat against a mock llama-server (see bench.run)"""
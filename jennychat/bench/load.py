@@ -0,0 +1,241 @@
+"""Load generators for the JennyChat HTTP and WebSocket APIs.
+
+Each scenario drives a running server with a fixed number of concurrent
+clients and returns a ``Stats`` with per-request latencies; ``bench.run``
+starts the servers and prints the report.
+"""
+import asyncio
+import itertools
+import json
+import math
+import time
+import uuid
+from typing import Callable, Dict, List, Optional
+
+import httpx
+
+
+def percentile(values: List[float], p: float) -> Optional[float]:
+    """Nearest-rank percentile, None without samples"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = math.ceil(p / 100.0 * len(ordered))
+    return ordered[min(max(rank, 1), len(ordered)) - 1]
+
+
+class Stats:
+    """Latencies and errors of one scenario"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.latency: List[float] = []  # seconds, end to end
+        self.ttft: List[float] = []  # seconds to the first streamed token
+        self.errors = 0
+        self.elapsed = 0.0
+        self.extra: Dict[str, float] = {}
+
+    @property
+    def requests(self) -> int:
+        return len(self.latency) + self.errors
+
+    def summary(self) -> dict:
+        return dict({
+            "scenario": self.name,
+            "requests": self.requests,
+            "errors": self.errors,
+            "throughput": len(self.latency) / self.elapsed if self.elapsed else 0.0,
+            "ttft_p50": percentile(self.ttft, 50),
+            "ttft_p99": percentile(self.ttft, 99),
+            "latency_p50": percentile(self.latency, 50),
+            "latency_p99": percentile(self.latency, 99),
+        }, **self.extra)
+
+
+async def run_workers(stats: Stats, concurrency: int, requests: int, call: Callable[[int], "asyncio.Future"]):
+    """Run ``requests`` calls of ``call(worker)``, ``concurrency`` at a time"""
+    counter = itertools.count()
+
+    async def worker(index: int):
+        while next(counter) < requests:
+            try:
+                await call(index)
+            except (httpx.HTTPError, ValueError, KeyError, OSError):
+                stats.errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(i) for i in range(concurrency)))
+    stats.elapsed = time.perf_counter() - started
+
+
+async def chat(base_url: str, concurrency: int, requests: int, stream: bool, max_tokens: int = 64) -> Stats:
+    """POST /api/chat; every worker keeps talking in its own chat"""
+    stats = Stats("chat stream" if stream else "chat")
+    chat_ids: Dict[int, str] = {}
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(base_url=base_url, timeout=300.0, limits=limits) as client:
+        async def call(worker: int):
+            body = {"message": f"Benchmark message from worker {worker}", "stream": stream,
+                    "max_tokens": max_tokens, "chat_id": chat_ids.get(worker)}
+            headers = {"x-user-id": f"bench-{worker}"}
+            started = time.perf_counter()
+            if not stream:
+                response = await client.post("/api/chat", json=body, headers=headers)
+                response.raise_for_status()
+                chat_ids[worker] = response.json()["chat_id"]
+                stats.latency.append(time.perf_counter() - started)
+                return
+
+            first = None
+            async with client.stream("POST", "/api/chat", json=body, headers=headers) as response:
+                response.raise_for_status()
+                async for line in response.aiter_lines():
+                    if not line.startswith("data: "):
+                        continue
+                    event = json.loads(line[6:])
+                    if "error" in event:
+                        raise ValueError(event["error"])
+                    chat_ids[worker] = event.get("chat_id", chat_ids.get(worker))
+                    if first is None and event.get("content"):
+                        first = time.perf_counter() - started
+            if first is None:
+                raise ValueError("stream ended without content")
+            stats.ttft.append(first)
+            stats.latency.append(time.perf_counter() - started)
+
+        await run_workers(stats, concurrency, requests, call)
+    return stats
+
+
+async def chat_list(base_url: str, concurrency: int, requests: int, sessions: int, page_size: int = 50) -> Stats:
+    """GET /api/chats once ``sessions`` chats exist; every tenth call walks every page"""
+    stats = Stats("chat list")
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(base_url=base_url, timeout=60.0, limits=limits) as client:
+        existing = len((await client.get("/api/chats", params={"limit": 500})).json()["chats"])
+        await run_workers(Stats("seed"), concurrency, max(0, sessions - existing),
+                          lambda worker: client.post("/api/chats"))
+
+        async def call(worker: int):
+            started = time.perf_counter()
+            params = {"limit": page_size}
+            while True:
+                response = await client.get("/api/chats", params=params)
+                response.raise_for_status()
+                cursor = response.json()["next_cursor"]
+                if not cursor or worker % 10:
+                    break
+                params["before"] = cursor
+            stats.latency.append(time.perf_counter() - started)
+
+        await run_workers(stats, concurrency, requests, call)
+    stats.extra["sessions"] = sessions
+    return stats
+
+
+async def rooms(base_url: str, room_count: int, members: int, messages: int, interval: float = 0.05) -> Stats:
+    """``members`` WebSocket clients in each room, each sending ``messages`` messages.
+
+    Latency is measured from sending a message to its arrival at each member
+    of the room, the sender included; throughput counts deliveries.
+    """
+    import websockets  # also what uvicorn uses for WebSockets
+
+    stats = Stats("ws rooms")
+    ws_url = base_url.replace("http", "ws", 1).rstrip("/") + "/ws"
+    sent_at: Dict[str, float] = {}
+    expected = room_count * members * messages * members
+    done = asyncio.Event()
+
+    async def receive(socket):
+        async for raw in socket:
+            event = json.loads(raw)
+            if event.get("type") != "new_message":
+                continue
+            started = sent_at.get(event["message"]["content"])
+            if started is not None:
+                stats.latency.append(time.perf_counter() - started)
+                if len(stats.latency) >= expected:
+                    done.set()
+
+    async def connect(user_id: str):
+        socket = await websockets.connect(ws_url, max_size=None)
+        await socket.send(json.dumps({"type": "user_connect", "userId": user_id, "username": user_id}))
+        while json.loads(await socket.recv())["type"] != "rooms_list":
+            pass
+        return socket
+
+    async def join(socket, room_id: str):
+        await socket.send(json.dumps({"type": "join_room", "roomId": room_id}))
+        while json.loads(await socket.recv())["type"] != "room_joined":
+            pass
+
+    async def talk(socket, user_id: str):
+        for i in range(messages):
+            content = f"{user_id}:{i}"
+            sent_at[content] = time.perf_counter()
+            await socket.send(json.dumps({"type": "send_message", "message": content}))
+            await asyncio.sleep(interval)
+
+    sockets = []
+    try:
+        for r in range(room_count):
+            owner = await connect(f"bench-{r}-0")
+            await owner.send(json.dumps({"type": "create_room", "name": f"bench {r}"}))
+            while True:
+                event = json.loads(await owner.recv())
+                if event["type"] == "room_created":
+                    room_id = event["room"]["id"]
+                    break
+            room_sockets = [(owner, f"bench-{r}-0")]
+            room_sockets += [(await connect(f"bench-{r}-{m}"), f"bench-{r}-{m}") for m in range(1, members)]
+            for socket, _ in room_sockets:
+                await join(socket, room_id)
+            sockets.extend(room_sockets)
+
+        readers = [asyncio.create_task(receive(socket)) for socket, _ in sockets]
+        started = time.perf_counter()
+        await asyncio.gather(*(talk(socket, user_id) for socket, user_id in sockets))
+        try:
+            await asyncio.wait_for(done.wait(), 30.0)
+        except asyncio.TimeoutError:
+            pass
+        stats.elapsed = time.perf_counter() - started
+        stats.errors = expected - len(stats.latency)  # deliveries that never arrived
+        for reader in readers:
+            reader.cancel()
+    finally:
+        await asyncio.gather(*(socket.close() for socket, _ in sockets), return_exceptions=True)
+    stats.extra["connections"] = len(sockets)
+    return stats
+
+
+async def session_memory(base_url: str, rss: Callable[[], int], sessions: int, turns: int,
+                         concurrency: int = 8) -> Stats:
+    """Resident memory added per chat session of ``turns`` exchanges"""
+    stats = Stats("memory")
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, timeout=300.0, limits=limits) as client:
+        before = rss()
+
+        async def call(worker: int):
+            chat_id = None
+            started = time.perf_counter()
+            for turn in range(turns):
+                response = await client.post("/api/chat", json={
+                    "message": f"Turn {turn} of a memory benchmark {uuid.uuid4().hex}",
+                    "stream": False, "max_tokens": 8, "chat_id": chat_id,
+                })
+                response.raise_for_status()
+                chat_id = response.json()["chat_id"]
+            stats.latency.append(time.perf_counter() - started)
+
+        await run_workers(stats, concurrency, sessions, call)
+        await asyncio.sleep(1.0)  # let write-behind batches drain
+        after = rss()
+    stats.extra["sessions"] = sessions
+    stats.extra["rss_mb"] = after / 2 ** 20
+    stats.extra["bytes_per_session"] = (after - before) / sessions if sessions else 0.0
+    return stats
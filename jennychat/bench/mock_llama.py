@@ -0,0 +1,154 @@
+"""Stand-in for llama-server, so JennyChat can be loaded without a model.
+
+Serves /v1/chat/completions (streamed or not), /v1/models, /health, /props,
+/tokenize and /embedding (hashed bag of words). Replies wait ``--latency`` seconds (prompt processing), then
+produce tokens at ``--token-rate`` per second; at most ``--slots`` requests
+generate at once and the rest queue, like llama-server's slots. With
+``--chunk-bytes`` the SSE stream is cut into writes of that size, so events
+arrive split across network chunks.
+
+    python -m bench.mock_llama --port 8080 --token-rate 50 --latency 0.2
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import time
+from typing import AsyncIterator, List
+
+from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse
+
+EMBEDDING_SIZE = 64
+WORDS = ("Jenny", " is", " a", " mock", " model", " that", " streams", " tokens", " for", " load", " tests", ".")
+
+app = FastAPI(title="mock llama-server")
+settings = argparse.Namespace(token_rate=50.0, latency=0.1, chunk_bytes=0, reply_tokens=64, slots=4,
+                              model="mock-model")
+slots: asyncio.Semaphore = None
+
+
+def reply_tokens(max_tokens) -> List[str]:
+    count = settings.reply_tokens if not max_tokens else min(settings.reply_tokens, int(max_tokens))
+    return [WORDS[i % len(WORDS)] for i in range(max(count, 1))]
+
+
+def prompt_tokens(messages: list) -> int:
+    return sum(len(str(m.get("content", "")).split()) + 4 for m in messages)
+
+
+def sse(payload) -> bytes:
+    data = payload if isinstance(payload, str) else json.dumps(payload)
+    return f"data: {data}\n\n".encode("utf-8")
+
+
+def get_slots() -> asyncio.Semaphore:
+    global slots
+    if slots is None:
+        slots = asyncio.Semaphore(settings.slots)
+    return slots
+
+
+async def generate(tokens: List[str], created: int) -> AsyncIterator[bytes]:
+    """SSE events of a streamed completion, paced and optionally fragmented"""
+    interval = 1.0 / settings.token_rate if settings.token_rate > 0 else 0.0
+    buffer = b""
+    async with get_slots():
+        await asyncio.sleep(settings.latency)
+        for token in tokens:
+            buffer += sse({
+                "object": "chat.completion.chunk", "created": created, "model": settings.model,
+                "choices": [{"index": 0, "delta": {"content": token}, "finish_reason": None}],
+            })
+            size = settings.chunk_bytes
+            while size and len(buffer) >= size:
+                yield buffer[:size]
+                buffer = buffer[size:]
+            if not size:
+                yield buffer
+                buffer = b""
+            await asyncio.sleep(interval)
+        buffer += sse({
+            "object": "chat.completion.chunk", "created": created, "model": settings.model,
+            "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+        })
+        yield buffer + sse("[DONE]")
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    tokens = reply_tokens(body.get("max_tokens"))
+    created = int(time.time())
+    if body.get("stream"):
+        return StreamingResponse(generate(tokens, created), media_type="text/event-stream")
+
+    async with get_slots():
+        rate = settings.token_rate
+        await asyncio.sleep(settings.latency + (len(tokens) / rate if rate > 0 else 0.0))
+    return {
+        "object": "chat.completion", "created": created, "model": settings.model,
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(tokens)},
+                     "finish_reason": "stop"}],
+        "usage": {"prompt_tokens": prompt_tokens(body.get("messages", [])), "completion_tokens": len(tokens)},
+    }
+
+
+@app.get("/v1/models")
+async def models():
+    return {"object": "list", "data": [{"id": settings.model, "object": "model", "owned_by": "bench"}]}
+
+
+@app.get("/health")
+async def health():
+    return {"status": "ok"}
+
+
+@app.get("/props")
+async def props():
+    return {"total_slots": settings.slots}
+
+
+@app.post("/tokenize")
+async def tokenize(request: Request):
+    content = (await request.json()).get("content", "")
+    return {"tokens": list(range(len(content.split())))}
+
+
+@app.post("/embedding")
+async def embedding(request: Request):
+    content = (await request.json()).get("content", "")
+    texts = content if isinstance(content, list) else [content]
+    results = []
+    for index, text in enumerate(texts):
+        vector = [0.0] * EMBEDDING_SIZE
+        for word in str(text).lower().split():
+            vector[int(hashlib.md5(word.encode("utf-8")).hexdigest(), 16) % EMBEDDING_SIZE] += 1.0
+        results.append({"index": index, "embedding": [vector]})
+    return results
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--token-rate", type=float, default=settings.token_rate,
+                        help="tokens per second per request (0 = as fast as possible)")
+    parser.add_argument("--latency", type=float, default=settings.latency,
+                        help="seconds before the first token")
+    parser.add_argument("--chunk-bytes", type=int, default=settings.chunk_bytes,
+                        help="split the SSE stream into writes of this size (0 = one write per token)")
+    parser.add_argument("--reply-tokens", type=int, default=settings.reply_tokens,
+                        help="tokens per reply, capped by the request's max_tokens")
+    parser.add_argument("--slots", type=int, default=settings.slots, help="requests generating at once")
+    parser.add_argument("--model", default=settings.model)
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    args = parse_args()
+    for name in ("token_rate", "latency", "chunk_bytes", "reply_tokens", "slots", "model"):
+        setattr(settings, name, getattr(args, name))
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
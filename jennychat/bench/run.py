@@ -0,0 +1,182 @@
+"""Benchmark JennyChat against the mock llama-server and print a report.
+
+With ``--spawn`` the mock llama-server and JennyChat are started as
+subprocesses in a scratch directory, so chat_history starts empty, with the
+mock listening where LLAMA_CPP_SERVER_URLS points. Without it ``--url``
+names a running server, and ``--pid`` its process for the memory scenario.
+
+    cd jennychat
+    python -m bench.run --spawn
+    python -m bench.run --spawn --scenarios stream --concurrency 64 --token-rate 20 --chunk-bytes 7
+    python -m bench.run --url http://127.0.0.1:8000 --pid 1234 --json before.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from typing import Iterator, List, Optional, Tuple
+from urllib.parse import urlparse
+
+import httpx
+
+from bench import load
+
+SCENARIOS = ("chat", "stream", "chats", "ws", "memory")
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))  # the jennychat directory
+
+
+def rss(pid: int) -> int:
+    """Resident set size of a process in bytes (Linux /proc)"""
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+    raise OSError(f"No VmRSS for process {pid}")
+
+
+def wait_ready(url: str, timeout: float = 30.0):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            if httpx.get(url, timeout=1.0).status_code < 500:
+                return
+        except httpx.HTTPError:
+            pass
+        if time.monotonic() > deadline:
+            raise RuntimeError(f"{url} did not come up within {timeout:.0f}s")
+        time.sleep(0.2)
+
+
+@contextmanager
+def spawn(args: argparse.Namespace) -> Iterator[Tuple[str, int]]:
+    """Start the mock llama-server and JennyChat; yields (JennyChat URL, its pid)"""
+    from app.conf import LLAMA_CPP_SERVER_URLS
+
+    llama = urlparse(LLAMA_CPP_SERVER_URLS[0])
+    workdir = tempfile.mkdtemp(prefix="jennychat-bench-")
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [ROOT, os.environ.get("PYTHONPATH")])))
+    mock_cmd = [
+        sys.executable, "-m", "bench.mock_llama", "--host", llama.hostname, "--port", str(llama.port or 80),
+        "--token-rate", str(args.token_rate), "--latency", str(args.latency),
+        "--chunk-bytes", str(args.chunk_bytes), "--reply-tokens", str(args.reply_tokens),
+        "--slots", str(args.slots),
+    ]
+    app_cmd = [
+        sys.executable, "-m", "uvicorn", "app.main:app", "--host", "127.0.0.1", "--port", str(args.port),
+        "--log-level", "warning",
+    ]
+    processes: List[subprocess.Popen] = []
+    try:
+        processes.append(subprocess.Popen(mock_cmd, cwd=workdir, env=env))
+        wait_ready(f"http://{llama.hostname}:{llama.port or 80}/health")
+        processes.append(subprocess.Popen(app_cmd, cwd=workdir, env=env))
+        url = f"http://127.0.0.1:{args.port}"
+        wait_ready(url + "/api/chats")
+        yield url, processes[-1].pid
+    finally:
+        for process in reversed(processes):
+            process.terminate()
+            try:
+                process.wait(10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+
+async def run(args: argparse.Namespace, url: str, pid: Optional[int]) -> List[dict]:
+    results = []
+    for scenario in args.scenarios:
+        if scenario == "chat":
+            stats = await load.chat(url, args.concurrency, args.requests, stream=False, max_tokens=args.max_tokens)
+        elif scenario == "stream":
+            stats = await load.chat(url, args.concurrency, args.requests, stream=True, max_tokens=args.max_tokens)
+        elif scenario == "chats":
+            stats = await load.chat_list(url, args.concurrency, args.requests, args.sessions)
+        elif scenario == "ws":
+            stats = await load.rooms(url, args.rooms, args.members, args.messages)
+        elif pid is None:
+            print("memory: skipped, needs --spawn or --pid", file=sys.stderr)
+            continue
+        else:
+            stats = await load.session_memory(url, lambda: rss(pid), args.memory_sessions, args.turns)
+        results.append(stats.summary())
+        print(f"{scenario}: done in {stats.elapsed:.1f}s", file=sys.stderr)
+    return results
+
+
+def report(results: List[dict]) -> str:
+    """Results as a fixed-width table; times in milliseconds"""
+    def ms(value: Optional[float]) -> str:
+        return "-" if value is None else f"{value * 1000:.1f}"
+
+    lines = [f"{'scenario':<12} {'requests':>8} {'errors':>6} {'per sec':>9} "
+             f"{'ttft p50':>9} {'ttft p99':>9} {'e2e p50':>9} {'e2e p99':>9}"]
+    notes = []
+    for r in results:
+        lines.append(f"{r['scenario']:<12} {r['requests']:>8} {r['errors']:>6} {r['throughput']:>9.1f} "
+                     f"{ms(r['ttft_p50']):>9} {ms(r['ttft_p99']):>9} "
+                     f"{ms(r['latency_p50']):>9} {ms(r['latency_p99']):>9}")
+        if "bytes_per_session" in r:
+            notes.append(f"memory: {r['bytes_per_session'] / 1024:.1f} KiB per session "
+                         f"({r['sessions']} sessions, RSS {r['rss_mb']:.1f} MiB)")
+        if "connections" in r:
+            notes.append(f"ws rooms: {r['connections']} connections, throughput counts deliveries")
+    return "\n".join(lines + notes)
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--spawn", action="store_true", help="start the mock llama-server and JennyChat")
+    parser.add_argument("--url", default="http://127.0.0.1:8000", help="JennyChat to load (without --spawn)")
+    parser.add_argument("--pid", type=int, help="JennyChat process, for the memory scenario (without --spawn)")
+    parser.add_argument("--port", type=int, default=8000, help="port of the spawned JennyChat")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS),
+                        help="comma separated, from: " + ", ".join(SCENARIOS))
+    parser.add_argument("--json", help="also write the results to this file")
+
+    group = parser.add_argument_group("load")
+    group.add_argument("--concurrency", type=int, default=16)
+    group.add_argument("--requests", type=int, default=200, help="requests per HTTP scenario")
+    group.add_argument("--max-tokens", type=int, default=64)
+    group.add_argument("--sessions", type=int, default=2000, help="chats that exist during the chat list scenario")
+    group.add_argument("--rooms", type=int, default=4)
+    group.add_argument("--members", type=int, default=25, help="WebSocket clients per room")
+    group.add_argument("--messages", type=int, default=10, help="messages sent by each member")
+    group.add_argument("--memory-sessions", type=int, default=200)
+    group.add_argument("--turns", type=int, default=5, help="exchanges per session in the memory scenario")
+
+    group = parser.add_argument_group("mock llama-server (with --spawn)")
+    group.add_argument("--token-rate", type=float, default=50.0)
+    group.add_argument("--latency", type=float, default=0.1)
+    group.add_argument("--chunk-bytes", type=int, default=0)
+    group.add_argument("--reply-tokens", type=int, default=64)
+    group.add_argument("--slots", type=int, default=4)
+
+    args = parser.parse_args(argv)
+    args.scenarios = [s.strip() for s in args.scenarios.split(",") if s.strip()]
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error("unknown scenarios: " + ", ".join(sorted(unknown)))
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.spawn:
+        with spawn(args) as (url, pid):
+            results = asyncio.run(run(args, url, pid))
+    else:
+        results = asyncio.run(run(args, args.url, args.pid))
+
+    print(report(results))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"args": vars(args), "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
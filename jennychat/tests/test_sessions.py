@@ -0,0 +1,48 @@
+"""SessionRegistry shared by several workers"""
+import asyncio
+
+from app.models import ChatMessage
+from app.pubsub import UnixSocketBroker
+from app.sessions import SessionRegistry
+from app.storage import JsonlSessionStore
+
+
+async def start_worker(directory, socket_path):
+    broker = UnixSocketBroker(str(socket_path))
+    registry = SessionRegistry(JsonlSessionStore(directory, is_leader=lambda: broker.is_leader), broker)
+    await broker.start()
+    await registry.start()
+    return broker, registry
+
+
+async def stop_worker(broker, registry):
+    await registry.close()
+    await broker.close()
+
+
+def test_load_waits_for_messages_not_yet_flushed_by_another_worker(tmp_path):
+    async def scenario():
+        directory, socket_path = tmp_path / "chats", tmp_path / "pubsub.sock"
+        a = await start_worker(directory, socket_path)
+        b = await start_worker(directory, socket_path)
+        broker_a, registry_a = a
+        broker_b, registry_b = b
+        try:
+            session = registry_a.create("shared")
+            registry_a.append(session, ChatMessage(role="user", content="hello"))
+            registry_a.append(session, ChatMessage(role="assistant", content="hi there"))
+            await asyncio.sleep(0.05)  # events reach worker B, the store flush has not happened yet
+            assert registry_b.catalog[session.chat_id]["message_count"] == 2
+
+            loaded = await registry_b.get(session.chat_id)
+            assert [m.content for m in loaded.messages] == ["hello", "hi there"]
+            assert registry_b.sessions[session.chat_id] is loaded
+
+            reply = ChatMessage(role="user", content="again")
+            registry_b.append(loaded, reply)
+            assert reply.seq == 3
+        finally:
+            await stop_worker(*b)
+            await stop_worker(*a)
+
+    asyncio.run(scenario())